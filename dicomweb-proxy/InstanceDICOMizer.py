@@ -12,6 +12,7 @@ from pydicom.dataset import FileDataset, FileMetaDataset
 from pydicom.uid import UID
 import base64
 import boto3
+from dicom_keywords import keyword_tags , dictionary_vr
 
 class InstanceDICOMizer():
 
@@ -34,7 +35,7 @@ class InstanceDICOMizer():
     def DICOMize(self, SOPInstanceUID, metadata, first_frame_only : bool = False) -> FileDataset:
         try:
             series_key = next(iter(metadata["Study"]["Series"].keys()))
-            vrlist = []       
+            vrlist = {}       
             file_meta = FileMetaDataset()
             ds = FileDataset(None, {}, file_meta=file_meta, preamble=b"\0" * 128)
             self.getDICOMVRs(metadata["Study"]["Series"][series_key]["Instances"][SOPInstanceUID]["DICOMVRs"] , vrlist)
@@ -76,10 +77,9 @@ class InstanceDICOMizer():
 
         
     def getDICOMVRs(self,taglevel, vrlist):
-        pydicom_dict_update = {}
         for theKey in taglevel:
-            vrlist.append( [ theKey , taglevel[theKey] ])
-            InstanceDICOMizer.logger.debug(f"[{__name__}][getDICOMVRs] - List of private tags VRs: {vrlist}\r\n")
+            vrlist[theKey] = taglevel[theKey]
+        InstanceDICOMizer.logger.debug(f"[{__name__}][getDICOMVRs] - List of private tags VRs: {vrlist}\r\n")
             #Let's update the pydicom dict as well since we may need to re-create the DICOM object in the future.
         #     pydicom_dict_update[eval(hex(int(theKey, 16)))] = (taglevel[theKey] , '1' , theKey ,'', theKey )
         # print(pydicom_dict_update)
@@ -91,13 +91,15 @@ class InstanceDICOMizer():
     def getTags(self,tagLevel, ds , vrlist):    
         for theKey in tagLevel:
             try:
-                try:
-                    tagvr = pydicom.datadict.dictionary_VR(theKey)
-                except:  #In case the vr is not in the pydicom dictionnary, it might be a private tag , listed in the vrlist
-                    tagvr = None
-                    for vr in vrlist:
-                        if theKey == vr[0]:
-                            tagvr = vr[1]
+                tag_entry = keyword_tags.get(theKey)
+                if tag_entry is not None:
+                    tagvr = tag_entry[1]
+                    element_tag = tag_entry[2]
+                else:
+                    element_tag = theKey
+                    tagvr = dictionary_vr(theKey)
+                    if tagvr is None:  #In case the vr is not in the pydicom dictionnary, it might be a private tag , listed in the vrlist
+                        tagvr = vrlist.get(theKey)
                 datavalue=tagLevel[theKey]
                 if(tagvr == 'SQ'):
                     seqs = []
@@ -119,7 +121,7 @@ class InstanceDICOMizer():
                     base64_str = tagLevel[theKey]
                     base64_bytes = base64_str.encode('utf-8')
                     datavalue = base64.b64decode(base64_bytes)
-                data_element = DataElement(theKey , tagvr , datavalue )
+                data_element = DataElement(element_tag , tagvr , datavalue )
                 if data_element.tag.group != 2: #This filters Metadata header tags
                     if (data_element.tag.group % 2) == 0: #This filters private tags. Will check later how to add them dynanically to the pydicom dict.
                         try:
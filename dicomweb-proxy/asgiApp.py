@@ -0,0 +1,407 @@
+"""
+asgiApp Module : Event loop entry point serving the QIDO-RS, metadata and frames routes, selected with SERVING_MODE=asgi.
+
+These routes spend most of their time waiting on MySQL and AHI. Here they are coroutines : queries go through an aiomysql
+pool and AHI is called over aiohttp with requests signed by the botocore SigV4 signer, so a waiting request costs a
+coroutine instead of one of the waitress threads. CPU bound steps (metadata parsing, serialization, decoding, cache
+files IO) are handed to threads and to the decode processes. The other routes are served by the Flask app through a
+WSGI bridge, sharing the caches, the frame fetcher and the decode pool of the main module.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import asyncio
+import concurrent.futures
+import contextlib
+import logging
+import ssl
+import time
+import orjson
+import aiohttp
+import aiomysql
+import botocore.session
+from botocore.auth import SigV4Auth
+from botocore.awsrequest import AWSRequest
+import uvicorn
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import Response, StreamingResponse
+from starlette.routing import Route, Mount
+from pydicom import uid
+import sql_queries
+from http_response_code import HTTP_CODES
+from metadataCache import metadataCache
+from cacheIndex import cacheIndex
+from responseCompression import responseCompression
+from qidoSerializer import qidoSerializer
+from proxyMetrics import proxyMetrics
+
+logger = logging.getLogger(__name__)
+proxy = None                # main module : caches, frame fetcher and decode pool shared with the Flask routes.
+settings = {}
+sql_pool = None
+ahi_client = None
+ahi_concurrency = None      # asyncio.Semaphore bounding the AHI calls in flight.
+inflight_metadata = {}      # cache key -> Future of the metadata fetch running on the event loop.
+inflight_frames = {}        # frame key -> Future of the frame fetch running on the event loop.
+
+
+class asyncAHIClient:
+    """AHI runtime calls used by the event loop routes : GetImageSetMetadata and GetImageFrame."""
+
+    def __init__(self, region : str = None, max_connections : int = 256):
+        session = botocore.session.get_session()
+        self.region = region or session.get_config_variable("region")
+        self.credentials = session.get_credentials() # same credentials chain as boto3, refreshed by botocore.
+        self.endpoint = f"https://runtime-medical-imaging.{self.region}.amazonaws.com"
+        self.max_connections = max_connections
+        self.session = None
+
+    async def start(self):
+        # auto_decompress off : the metadata blob is gzipped JSON, handed over as is like the boto3 client does.
+        self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.max_connections), timeout=aiohttp.ClientTimeout(total=60), auto_decompress=False)
+
+    async def close(self):
+        await self.session.close()
+
+    async def _post(self, path : str, payload : dict) -> bytes:
+        url = self.endpoint + path
+        body = orjson.dumps(payload)
+        aws_request = AWSRequest(method="POST", url=url, data=body, headers={ "Content-Type" : "application/json" })
+        SigV4Auth(self.credentials.get_frozen_credentials(), "medical-imaging", self.region).add_auth(aws_request)
+        async with self.session.post(url, data=body, headers=dict(aws_request.headers.items())) as response:
+            content = await response.read()
+            if response.status != 200:
+                raise RuntimeError(f"{path} returned HTTP {response.status} : {content[:256]}")
+            return content
+
+    async def getImageSetMetadata(self, datastore_id : str, imageset_id : str) -> bytes:
+        return await self._post(f"/datastore/{datastore_id}/imageSet/{imageset_id}/getImageSetMetadata", {})
+
+    async def getImageFrame(self, datastore_id : str, imageset_id : str, imageframe_id : str) -> bytes:
+        return await self._post(f"/datastore/{datastore_id}/imageSet/{imageset_id}/getImageFrame", { "imageFrameId" : imageframe_id })
+
+
+async def _singleFlight(inflight : dict, key : str, fetch):
+    """Runs fetch() once for the concurrent callers of a key, every caller awaits the same task and gets its result or its exception."""
+    task = inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(fetch()) # its own task : the caller that started it may be cancelled without affecting the others.
+        inflight[key] = task
+        task.add_done_callback(lambda done : inflight.pop(key, None))
+    return await asyncio.shield(task) # a cancelled caller must not cancel the fetch of the others.
+
+async def executeQuery(query : str, query_parameters):
+    async with sql_pool.acquire() as sql_conn:
+        async with sql_conn.cursor() as cursor:
+            with proxyMetrics.stage("sql"):
+                await cursor.execute("SET TRANSACTION ISOLATION LEVEL READ UNCOMMITTED")
+                await cursor.execute(query, query_parameters)
+                db_results = await cursor.fetchall()
+            field_names = [i[0] for i in cursor.description]
+        await sql_conn.commit()
+    return field_names , db_results
+
+async def fetchMetadata(datastore_id : str, imageset_id : str):
+    start = time.perf_counter()
+    metadata = metadataCache.cachedMetadata(datastore_id, imageset_id)
+    if metadata is not None:
+        proxyMetrics.observeStage("ahi_metadata", time.perf_counter() - start, "hit")
+        return metadata
+    metadata = await _singleFlight(inflight_metadata, f"{datastore_id}{imageset_id}", lambda : _loadMetadata(datastore_id, imageset_id))
+    proxyMetrics.observeStage("ahi_metadata", time.perf_counter() - start, "miss")
+    return metadata
+
+async def _loadMetadata(datastore_id : str, imageset_id : str):
+    try:
+        start = time.perf_counter()
+        async with ahi_concurrency:
+            metadata_blob = await ahi_client.getImageSetMetadata(datastore_id, imageset_id)
+        metadata = await asyncio.to_thread(metadataCache.storeMetadata, datastore_id, imageset_id, metadata_blob)
+        logger.debug(f"[{__name__}] - metadata {datastore_id}/{imageset_id} fetched in {time.perf_counter()-start:.3f}s")
+        return metadata
+    except Exception as err:
+        logger.error(f"[{__name__}] - metadata {datastore_id}/{imageset_id} could not be fetched : {err}")
+        return None
+
+async def fetchSerializedMetadata(datastore_id : str, imageset_id : str):
+    if await fetchMetadata(datastore_id, imageset_id) is None:
+        return None
+    return await asyncio.to_thread(proxy.metadatacache.getSerializedMetadata, datastore_id, imageset_id) # cache hit, serialized once per image set.
+
+async def fetchFrame(datastore_id : str, imageset_id : str, imageframe_id : str) -> bytes:
+    """Returns the frame as stored by AHI, from the disk cache when present. Fetched frames are written to the cache."""
+    start = time.perf_counter()
+    cache_object = { "datastore_id" : datastore_id , "imageset_id" : imageset_id , "imageframe_id" : imageframe_id }
+    framecache = proxy.framecache
+    if framecache is not None:
+        frame = await asyncio.to_thread(framecache.read, datastore_id, imageset_id, imageframe_id) # records the hit or the miss.
+        if frame is not None:
+            proxyMetrics.observeStage("ahi_frame", time.perf_counter() - start, "hit")
+            return frame
+    else:
+        cacheIndex.recordMiss("raw")
+    frame = await _singleFlight(inflight_frames, f"{datastore_id}/{imageset_id}/{imageframe_id}", lambda : _loadFrame(cache_object))
+    proxyMetrics.observeStage("ahi_frame", time.perf_counter() - start, "miss")
+    return frame
+
+async def _loadFrame(cache_object : dict) -> bytes:
+    try:
+        async with ahi_concurrency:
+            frame = await ahi_client.getImageFrame(cache_object["datastore_id"], cache_object["imageset_id"], cache_object["imageframe_id"])
+    except Exception as err:
+        logger.error(f"[{__name__}] - frame {cache_object['datastore_id']}/{cache_object['imageset_id']}/{cache_object['imageframe_id']} could not be fetched : {err}")
+        return None
+    if proxy.framefetcher is not None:
+        await asyncio.to_thread(proxy.framefetcher.storeFrame, cache_object, frame, False) # the caller decodes the frame itself.
+    return frame
+
+async def decodeFrame(frame : bytes) -> bytes:
+    decodepool = proxy.decodepool
+    if decodepool is not None:
+        try:
+            with proxyMetrics.stage("decode", "miss"):
+                return await asyncio.wrap_future(decodepool.submit(frame))
+        except concurrent.futures.process.BrokenProcessPool as err:
+            logger.error(f"[{__name__}] - decode pool is broken, decoding in a thread : {err}")
+    return await asyncio.to_thread(proxy.decodeFrame, frame) # timed by proxy.decodeFrame.
+
+async def getFramePixels(datastore_id : str, imageset_id : str, imageframe_id : str) -> bytes:
+    pixelcache = proxy.pixelcache
+    if pixelcache is not None:
+        start = time.perf_counter()
+        pixels = await asyncio.to_thread(pixelcache.get, datastore_id, imageset_id, imageframe_id)
+        if pixels is not None:
+            proxyMetrics.observeStage("decode", time.perf_counter() - start, "hit")
+            return pixels
+    frame = await fetchFrame(datastore_id, imageset_id, imageframe_id)
+    if frame is None:
+        return None
+    pixels = await decodeFrame(frame)
+    if pixels is None: # not an HTJ2K frame, the Flask path knows how to convert the other encodings.
+        return await asyncio.to_thread(proxy.getFramePixels, datastore_id, imageset_id, imageframe_id, proxy.ahi_client)
+    if pixelcache is not None:
+        await asyncio.to_thread(pixelcache.put, datastore_id, imageset_id, imageframe_id, pixels)
+    return pixels
+
+async def getFramePart(datastore_id : str, imageset_id : str, imageframe_id : str, transfer_syntax : str):
+    """Returns (frame bytes, transfer syntax) of a frame part, same rules as the Flask frames route."""
+    if transfer_syntax in proxy.HTJ2K_TRANSFER_SYNTAXES:
+        frame = await fetchFrame(datastore_id, imageset_id, imageframe_id)
+        if frame is not None and frame[:4] == proxy.J2K_CODESTREAM_MAGIC:
+            return frame , transfer_syntax
+        return await getFramePixels(datastore_id, imageset_id, imageframe_id) , uid.ExplicitVRLittleEndian
+    return await getFramePixels(datastore_id, imageset_id, imageframe_id) , transfer_syntax
+
+async def resolveFrameLocations(SeriesInstanceUID : str, InstanceUID : str, frame_list : list):
+    frame_locations = proxy._frameLocationsFromIndex(InstanceUID, frame_list)
+    if frame_locations is not None:
+        return frame_locations
+    fields , results = await executeQuery(sql_queries.WADO_INSTANCE_METADATA, (InstanceUID,))
+    for res in results:
+        metadata = await fetchMetadata(res[0], res[1])
+        if metadata is None:
+            continue
+        frame_locations = await asyncio.to_thread(proxy._frameLocationsFromMetadata, metadata, res[0], res[1], SeriesInstanceUID, InstanceUID, frame_list)
+        if frame_locations is not None:
+            return frame_locations
+    return None
+
+async def framesStream(frame_tasks : list, boundary : str, first_part : tuple):
+    """Yields the multipart/related parts of the frames, first_part being the result of the first task, awaited before the headers were sent."""
+    try:
+        for part_number , frame_task in enumerate(frame_tasks):
+            frame , part_transfer_syntax = first_part if part_number == 0 else await frame_task
+            if frame is None: # the headers are sent, an empty part would read as a valid frame : the response is aborted instead.
+                raise RuntimeError(f"[framesStream] - frame {part_number+1} could not be retrieved, response aborted.")
+            yield proxy.multipart_header(part_transfer_syntax, boundary, first_part=(part_number == 0))
+            yield frame
+        yield proxy.multipart_footer(boundary, b"")
+    finally:
+        for frame_task in frame_tasks: # client gone : the frames it no longer waits for are not fetched.
+            frame_task.cancel()
+
+
+async def executeQueryStream(query : str, query_parameters, batch_size : int):
+    """Yields the (field names, rows) of a query batch_size rows at a time, from a server side cursor."""
+    sql_time = 0.0
+    async with sql_pool.acquire() as sql_conn:
+        async with sql_conn.cursor(aiomysql.SSCursor) as cursor:
+            start = time.perf_counter()
+            await cursor.execute("SET TRANSACTION ISOLATION LEVEL READ UNCOMMITTED")
+            await cursor.execute(query, query_parameters)
+            field_names = [i[0] for i in cursor.description]
+            while True:
+                db_results = await cursor.fetchmany(batch_size)
+                sql_time += time.perf_counter() - start
+                if len(db_results) == 0:
+                    break
+                yield field_names , db_results
+                start = time.perf_counter()
+        await sql_conn.commit()
+    proxyMetrics.observeStage("sql", sql_time)
+
+async def qidoStream(query : str, query_parameters, parameters : dict, generation : int):
+    """Async counterpart of main._streamQIDO."""
+    qidocache = proxy.qidocache
+    cached_chunks = [] if qidocache is not None else None
+    cached_bytes = 0
+    serialize_time = 0.0
+    separator = b"["
+    async for field_names , db_results in executeQueryStream(query, query_parameters, proxy.qido_fetch_batch):
+        start = time.perf_counter()
+        chunk = separator + (await asyncio.to_thread(qidoSerializer.serialize, field_names, db_results, parameters))[1:-1]
+        serialize_time += time.perf_counter() - start
+        separator = b","
+        if cached_chunks is not None:
+            cached_bytes += len(chunk)
+            if cached_bytes <= qidocache.max_body_bytes:
+                cached_chunks.append(chunk)
+            else:
+                cached_chunks = None
+        yield chunk
+    proxyMetrics.observeStage("serialize", serialize_time, "miss")
+    chunk = b"[]" if separator == b"[" else b"]"
+    if cached_chunks is not None:
+        qidocache.put(parameters, b"".join(cached_chunks) + chunk, generation)
+    yield chunk
+
+def qidoRoute(level : str, path_parameters : dict = None):
+    """Returns the endpoint of a QIDO-RS search. path_parameters maps the path parameters to the query parameters keys."""
+    async def search(request):
+        try:
+            parameters = proxy._processParameters(level=level, args=request.query_params)
+        except proxy.QueryParameterError as err:
+            return Response(f"{HTTP_CODES[400]} : {err}", status_code=400)
+        for path_parameter , parameter in (path_parameters or {}).items():
+            parameters[parameter] = request.path_params[path_parameter]
+        qidocache = proxy.qidocache
+        start = time.perf_counter()
+        cached = None if qidocache is None else qidocache.get(parameters)
+        if cached is None:
+            generation = None if qidocache is None else qidocache.generation
+            query , query_parameters = proxy._constructQuery(parameters)
+            if parameters["limit"] == 0:
+                return StreamingResponse(qidoStream(query, query_parameters, parameters, generation), status_code=200, media_type="application/dicom+json")
+            field_names, db_results = await executeQuery(query , query_parameters)
+            with proxyMetrics.stage("serialize", "miss"):
+                body = await asyncio.to_thread(qidoSerializer.serialize, field_names, db_results, parameters)
+            next_token = proxy._nextPageToken(parameters, field_names, db_results)
+            if qidocache is not None:
+                qidocache.put(parameters, body, generation, next_token)
+        else:
+            proxyMetrics.observeStage("serialize", time.perf_counter() - start, "hit")
+            body , next_token = cached
+        headers = {} if next_token is None else { "X-Next-Page-Token" : next_token }
+        return Response(body, status_code=200, media_type="application/dicom+json", headers=headers)
+    return search
+
+def metadataRoute(query : str, path_parameter : str):
+    async def retrieve(request):
+        fields , results = await executeQuery(query, (request.path_params[path_parameter],))
+        meta_fetch = [ (res[0], res[1]) for res in results ]
+        serialized_metadatas = await asyncio.gather(*(fetchSerializedMetadata(*fetch) for fetch in meta_fetch))
+        serialized_metadatas = [ (fetch , serialized) for fetch , serialized in zip(meta_fetch, serialized_metadatas) if serialized is not None ]
+        instance_count , content , encoding = await asyncio.to_thread(proxy._metadataBody, serialized_metadatas, request.headers.get("Accept-Encoding", ""))
+        headers = { "Vary" : "Accept-Encoding" }
+        if encoding is not None:
+            headers["Content-Encoding"] = encoding
+        return Response(content, status_code=200 if instance_count > 0 else 400, media_type="application/dicom+json", headers=headers)
+    return retrieve
+
+async def retrieveFrames(request):
+    SeriesInstanceUID = request.path_params["SeriesInstanceUID"]
+    InstanceUID = request.path_params["InstanceUID"]
+    try:
+        frame_list = proxy.parseFrameList(request.path_params["Frames"])
+    except ValueError as err:
+        return Response(f"{HTTP_CODES[400]} : {err}", status_code=400)
+    frame_locations = await resolveFrameLocations(SeriesInstanceUID, InstanceUID, frame_list)
+    if frame_locations is None:
+        return Response(HTTP_CODES[404], status_code=404)
+    transfer_syntax = proxy.negotiateFrameTransferSyntax(request.headers.get("Accept", ""))
+    boundary = proxy.multipart_boundary()
+    headers = { "Content-Type" : f'multipart/related; type="{proxy.get_content_type(transfer_syntax)}"; transfer-syntax={transfer_syntax}; boundary={boundary}' , "Vary" : "Accept-Encoding" }
+    frame_tasks = [ asyncio.ensure_future(getFramePart(*location, transfer_syntax)) for location in frame_locations ]
+    try:
+        first_part = await frame_tasks[0]
+    except BaseException:
+        for frame_task in frame_tasks:
+            frame_task.cancel()
+        raise
+    if first_part[0] is None:
+        logger.error(f"[retrieveFrames] - frame {frame_locations[0]} could not be retrieved.")
+        for frame_task in frame_tasks:
+            frame_task.cancel()
+        return Response(HTTP_CODES[500], status_code=500)
+    encoding = proxy._framesEncoding(transfer_syntax, request.headers.get("Accept-Encoding", ""), len(first_part[0]))
+    if encoding is None:
+        return StreamingResponse(framesStream(frame_tasks, boundary, first_part), headers=headers)
+    # compressed bodies are built in a thread once all the frames are there, the compressors are not coroutine friendly.
+    try:
+        chunks = [ chunk async for chunk in framesStream(frame_tasks, boundary, first_part) ]
+    except RuntimeError as err:
+        logger.error(err)
+        return Response(HTTP_CODES[500], status_code=500)
+    content = await asyncio.to_thread(lambda : b"".join(responseCompression.compressStream(chunks, encoding, "frames")))
+    headers["Content-Encoding"] = encoding
+    return Response(content, status_code=200, headers=headers)
+
+async def metrics(request):
+    return Response(proxyMetrics.render(), status_code=200, media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+def _route(path : str, endpoint, name : str):
+    """name is the view name of the same route in the Flask app, used as the route label of the metrics."""
+    async def handle(request):
+        if request.method == "OPTIONS": # same as the before_request hook of the Flask app.
+            return Response()
+        proxyMetrics.setRoute(name) # each request runs in its own task, hence its own context.
+        return await endpoint(request)
+    return Route(path, handle, methods=["GET", "OPTIONS"])
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    global sql_pool, ahi_client, ahi_concurrency
+    asyncio.get_running_loop().set_default_executor(concurrent.futures.ThreadPoolExecutor(settings["threads"], thread_name_prefix="asgi"))
+    db_secret = settings["db_secret"]
+    ssl_context = ssl.create_default_context()
+    ssl_context.check_hostname = False
+    ssl_context.verify_mode = ssl.CERT_NONE # same as the mysql-connector pool : TLS without a CA bundle.
+    sql_pool = await aiomysql.create_pool(host=db_secret['host'], user=db_secret['username'], password=db_secret['password'], db=db_secret['dbname'], port=int(db_secret['port']), minsize=1, maxsize=settings["sql_pool_size"], ssl=ssl_context)
+    ahi_client = asyncAHIClient(max_connections=settings["ahi_concurrency"])
+    await ahi_client.start()
+    ahi_concurrency = asyncio.Semaphore(settings["ahi_concurrency"])
+    logger.info(f"[Startup] - Event loop routes started, {settings['ahi_concurrency']} concurrent AHI calls and {settings['sql_pool_size']} MySQL connections at most.")
+    try:
+        yield
+    finally:
+        await ahi_client.close()
+        sql_pool.close()
+        await sql_pool.wait_closed()
+
+def createApp() -> Starlette:
+    routes = [
+        _route("/metrics", metrics, "metrics"),
+        _route("/aetitle/studies", qidoRoute("STUDY"), "SearchForStudies"),
+        _route("/aetitle/studies/{studyInstanceUID}/series", qidoRoute("STUDY.SERIES", { "studyInstanceUID" : "StudyInstanceUID" }), "SearchForStudySeries"),
+        _route("/aetitle/studies/{studyInstanceUID}/instances", qidoRoute("STUDY.INSTANCE", { "studyInstanceUID" : "StudyInstanceUID" }), "SearchForStudyInstances"),
+        _route("/aetitle/series", qidoRoute("SERIES"), "SearchForSeries"),
+        _route("/aetitle/studies/{studyInstanceUID}/series/{seriesInstanceUID}/instances", qidoRoute("STUDY.SERIES.INSTANCE", { "studyInstanceUID" : "StudyInstanceUID" , "seriesInstanceUID" : "SeriesInstanceUID" }), "SearchForStudySeriesInstances"),
+        _route("/aetitle/instances", qidoRoute("INSTANCE"), "SearchForInstances"),
+        _route("/aetitle/studies/{StudyInstanceUID}/metadata", metadataRoute(sql_queries.WADO_STUDIES_METADATA, "StudyInstanceUID"), "RetrieveStudiesMetadata"),
+        _route("/aetitle/studies/{StudyInstanceUID}/series/{SeriesInstanceUID}/metadata", metadataRoute(sql_queries.WADO_SERIES_METADATA, "SeriesInstanceUID"), "RetrieveStudiesSeriesMetadata"),
+        _route("/aetitle/studies/{StudyInstanceUID}/series/{SeriesInstanceUID}/instances/{InstanceUID}/metadata", metadataRoute(sql_queries.WADO_INSTANCE_METADATA, "InstanceUID"), "RetrieveStudiesSeriesInstanceMetadata"),
+        _route("/aetitle/studies/{StudyInstanceUID}/series/{SeriesInstanceUID}/instances/{InstanceUID}/frames/{Frames}", retrieveFrames, "RetrieveStudiesSeriesInstanceFrame"),
+        # instance, series and study retrieves DICOMize in threads anyway, they are served by the Flask app.
+        Mount("/", app=WSGIMiddleware(proxy.app, workers=settings["threads"])),
+    ]
+    return Starlette(routes=routes, middleware=[Middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"], expose_headers=["X-Next-Page-Token"])], lifespan=lifespan)
+
+def serve(proxy_module , db_secret : dict, port : int, ahi_max_concurrency : int = 256, sql_pool_size : int = 100, threads : int = 100, max_connections : int = None):
+    """Serves the proxy on an event loop. proxy_module is the main module, already configured and holding the shared caches."""
+    global proxy, settings
+    proxy = proxy_module
+    settings = { "db_secret" : db_secret , "ahi_concurrency" : ahi_max_concurrency , "sql_pool_size" : sql_pool_size , "threads" : threads }
+    uvicorn.run(createApp(), host="0.0.0.0", port=int(port), limit_concurrency=max_connections, log_level="info") #nosec - binding all intefaces on purpose
@@ -0,0 +1,147 @@
+"""
+Micro-benchmark of the per instance metadata conversions : AHI JSON to DICOM-JSON (metadataCache.getJSONKeys) and
+AHI JSON to pydicom Dataset (InstanceDICOMizer.getTags), comparing the pydicom.datadict lookups used previously
+with the keyword tables of dicom_keywords.
+
+Run from the dicomweb-proxy folder : python benchmarks/benchMetadataConversion.py [number of instances]
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import base64
+import collections.abc
+import copy
+import os
+import sys
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from pydicom import datadict
+from pydicom import DataElement
+from pydicom.dataset import Dataset
+from pydicom.sequence import Sequence
+from metadataCache import metadataCache
+from InstanceDICOMizer import InstanceDICOMizer
+
+
+def legacyGet8CharTag(hex_representation : str):
+    hex_representation = hex_representation[2:]
+    for x in range(8 - len(hex_representation)):
+        hex_representation = "0" + hex_representation
+    return hex_representation.upper()
+
+def legacyGetJSONKeys(tagblock : object, depth : int = 0):
+    dicom_set = dict()
+    for key in tagblock.keys():
+        try:
+            tag = datadict.tag_for_keyword(key)
+            vr = datadict.dictionary_VR(key)
+        except Exception as err:
+            continue
+        tab = ""
+        for x in range(depth):
+            tab = tab + "\t"
+        hex_tag = legacyGet8CharTag(hex(tag))
+        if vr == "IS" and isinstance(tagblock[key], str):
+            tagblock[key] = int(tagblock[key])
+        if vr == "SQ":
+            depth = depth + 1
+            element_array = []
+            for subelement in tagblock[key]:
+                element_array.append(legacyGetJSONKeys(subelement, depth))
+            dicom_set[hex_tag] = {"vr": vr, "Value": element_array}
+        else:
+            if tagblock[key] is not None:
+                if isinstance(tagblock[key], collections.abc.Sequence) and not isinstance(tagblock[key], str):
+                    dicom_set[hex_tag] = {"vr": vr, "Value": tagblock[key]}
+                else:
+                    dicom_set[hex_tag] = {"vr": vr, "Value": [tagblock[key]]}
+            else:
+                dicom_set[hex_tag] = {"vr": vr}
+    return dicom_set
+
+
+class legacyInstanceDICOMizer(InstanceDICOMizer):
+    """getTags as it was before the keyword tables : dictionary_VR for every attribute then a scan of the VR list."""
+
+    def getTags(self, tagLevel, ds, vrlist):
+        if isinstance(vrlist, dict):
+            vrlist = [[key, vr] for key, vr in vrlist.items()]
+        for theKey in tagLevel:
+            try:
+                try:
+                    tagvr = datadict.dictionary_VR(theKey)
+                except:
+                    tagvr = None
+                    for vr in vrlist:
+                        if theKey == vr[0]:
+                            tagvr = vr[1]
+                datavalue = tagLevel[theKey]
+                if tagvr == 'SQ':
+                    seqs = []
+                    for underSeq in tagLevel[theKey]:
+                        seqds = Dataset()
+                        self.getTags(underSeq, seqds, vrlist)
+                        seqs.append(seqds)
+                    datavalue = Sequence(seqs)
+                if tagvr == 'US or SS':
+                    datavalue = tagLevel[theKey]
+                    if isinstance(datavalue, int):
+                        if int(datavalue) > 32767:
+                            tagvr = 'US'
+                        else:
+                            tagvr = 'SS'
+                    else:
+                        tagvr = 'US'
+                if tagvr in ['OB', 'OD', 'OF', 'OL', 'OW', 'UN', 'OB or OW']:
+                    datavalue = base64.b64decode(tagLevel[theKey].encode('utf-8'))
+                data_element = DataElement(theKey, tagvr, datavalue)
+                if data_element.tag.group != 2:
+                    if (data_element.tag.group % 2) == 0:
+                        try:
+                            ds.add(data_element)
+                        except:
+                            continue
+            except Exception as err:
+                continue
+
+
+def syntheticInstance(instance_number : int):
+    instance = {
+        "SOPClassUID": "1.2.840.10008.5.1.4.1.1.2", "SOPInstanceUID": f"1.2.3.4.{instance_number}", "InstanceNumber": str(instance_number),
+        "ImageType": ["ORIGINAL", "PRIMARY", "AXIAL"], "AcquisitionNumber": "1", "ContentDate": "20240101", "ContentTime": "101010",
+        "ImagePositionPatient": [-250.0, -250.0, float(instance_number)], "ImageOrientationPatient": [1, 0, 0, 0, 1, 0],
+        "SliceLocation": float(instance_number), "SliceThickness": 1.25, "KVP": 120, "XRayTubeCurrent": 300, "Exposure": 12,
+        "Rows": 512, "Columns": 512, "PixelSpacing": [0.7, 0.7], "BitsAllocated": 16, "BitsStored": 12, "HighBit": 11,
+        "PixelRepresentation": 0, "SamplesPerPixel": 1, "PhotometricInterpretation": "MONOCHROME2", "WindowCenter": 40,
+        "WindowWidth": 400, "RescaleIntercept": -1024, "RescaleSlope": 1, "RescaleType": "HU", "ConvolutionKernel": "STANDARD",
+        "ReferencedImageSequence": [{"ReferencedSOPClassUID": "1.2.840.10008.5.1.4.1.1.2", "ReferencedSOPInstanceUID": "1.2.3.4.0"}],
+    }
+    for private_element in range(20):
+        instance[f"0009{0x1000 + private_element:04X}"] = "private value"
+    return instance
+
+def syntheticVRs():
+    return { f"0009{0x1000 + private_element:04X}" : "LO" for private_element in range(20) }
+
+def timeIt(function, instances : list) -> float:
+    start = time.perf_counter()
+    for instance in instances:
+        function(instance)
+    return (time.perf_counter() - start) / len(instances) * 1000000
+
+
+if __name__ == "__main__":
+    instance_count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    instances = [syntheticInstance(instance_number) for instance_number in range(instance_count)]
+    assert legacyGetJSONKeys(copy.deepcopy(instances[0])) == metadataCache.getJSONKeys(copy.deepcopy(instances[0]))
+
+    legacy_json = timeIt(lambda instance : legacyGetJSONKeys(instance), copy.deepcopy(instances))
+    current_json = timeIt(lambda instance : metadataCache.getJSONKeys(instance), copy.deepcopy(instances))
+    print(f"getJSONKeys : {legacy_json:8.1f} us/instance before , {current_json:8.1f} us/instance after ({legacy_json/current_json:.1f}x)")
+
+    vrs = syntheticVRs()
+    legacy_dicomizer = legacyInstanceDICOMizer(header_only=True)
+    current_dicomizer = InstanceDICOMizer(header_only=True)
+    legacy_tags = timeIt(lambda instance : legacy_dicomizer.getTags(instance, Dataset(), vrs), copy.deepcopy(instances))
+    current_tags = timeIt(lambda instance : current_dicomizer.getTags(instance, Dataset(), vrs), copy.deepcopy(instances))
+    print(f"getTags     : {legacy_tags:8.1f} us/instance before , {current_tags:8.1f} us/instance after ({legacy_tags/current_tags:.1f}x)")
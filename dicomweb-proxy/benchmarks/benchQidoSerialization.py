@@ -0,0 +1,99 @@
+"""
+Micro-benchmark of the QIDO-RS rows to DICOM-JSON conversion : a pydicom Dataset built per row, as done previously by
+main._convertToJSON, against the precompiled plans of qidoSerializer, on a synthetic study level result set.
+
+Run from the dicomweb-proxy folder : python benchmarks/benchQidoSerialization.py [number of rows]
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import datetime
+import os
+import sys
+import time
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import orjson
+import pydicom
+from pydicom import Dataset, DataElement
+from db_mappings import studyTagsTofields
+from qidoSerializer import qidoSerializer
+
+
+def legacySerializeValue(obj):
+    if isinstance(obj, datetime.date):
+        return obj.strftime('%Y%m%d')
+    if isinstance(obj , datetime.timedelta):
+        return obj.strftime('%H%M%S.%f')
+    return obj
+
+def legacyConvertToJSON(column_index , db_results , params : dict):
+    tagDict = studyTagsTofields
+    json_array = []
+    for result in db_results:
+        ds = Dataset()
+        for tag in tagDict:
+            try:
+                index = column_index.index(tagDict[tag].lower())
+                tagvalue = legacySerializeValue(result[index])
+                if ( pydicom.datadict.dictionary_VR(tag) == "CS" ) and ( "/" in tagvalue):
+                    tagvalue = tagvalue.split("/")
+                ds.add(DataElement(tag, pydicom.datadict.dictionary_VR(tag) , tagvalue))
+            except BaseException as err:
+                pass
+        for tag in params["includefield"]:
+            try:
+                index = column_index.index(tagDict[tag].lower())
+                tagvalue = legacySerializeValue(result[index])
+                ds.add(DataElement(tag, pydicom.datadict.dictionary_VR(tag) , tagvalue))
+            except BaseException as err:
+                pass
+        json_array.append(ds.to_json_dict())
+    return json_array
+
+
+def syntheticStudies(row_count : int):
+    """Rows shaped like the QIDO_STUDY result : the study, patient and aggregated columns. StudyTime is stored as a
+    string here, the legacy conversion drops the TIME columns MySQL returns as timedelta."""
+    field_names = ["study_pkey", "patient_pkey"] + [field.lower() for field in studyTagsTofields.values()]
+    rows = []
+    for row_number in range(row_count):
+        values = {
+            "patientbirthdate" : datetime.date(1950 + row_number % 50, 1 + row_number % 12, 1 + row_number % 28),
+            "patientsex" : "MF"[row_number % 2],
+            "patientname" : f"DOE^JOHN{row_number}",
+            "patientid" : f"PID{row_number:06d}",
+            "issuerofpatientid" : "HOSPITAL",
+            "d00080005" : "ISO_IR 100",
+            "studydate" : datetime.date(2024, 1 + row_number % 12, 1 + row_number % 28),
+            "studytime" : f"{row_number % 24:02d}1010",
+            "accessionnumber" : f"ACC{row_number}",
+            "modalitiesinstudy" : "CT/SR" if row_number % 3 == 0 else "MR",
+            "referringphysicianname" : "" if row_number % 4 else "SMITH^ANNA",
+            "studydescription" : "CHEST WITH CONTRAST",
+            "studyinstanceuid" : f"1.2.826.0.1.3680043.8.498.{row_number}",
+            "studyid" : str(row_number),
+            "numberofstudyrelatedseries" : 1 + row_number % 5,
+            "numberofstudyrelatedinstances" : 100 + row_number,
+        }
+        rows.append(tuple([row_number, row_number] + [ values.get(field.lower()) for field in studyTagsTofields.values() ]))
+    return field_names , rows
+
+def timeIt(function, repeat : int = 3) -> float:
+    best = None
+    for attempt in range(repeat):
+        start = time.perf_counter()
+        function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+if __name__ == "__main__":
+    row_count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    field_names , rows = syntheticStudies(row_count)
+    params = { "queryLevel" : "STUDY" , "includefield" : ["00080020"] }
+    assert orjson.dumps(legacyConvertToJSON(field_names, rows, params)) == qidoSerializer.serialize(field_names, rows, params)
+
+    legacy = timeIt(lambda : orjson.dumps(legacyConvertToJSON(field_names, rows, params)))
+    current = timeIt(lambda : qidoSerializer.serialize(field_names, rows, params))
+    print(f"{row_count} studies : {legacy*1000:8.1f} ms before , {current*1000:8.1f} ms after ({legacy/current:.1f}x)")
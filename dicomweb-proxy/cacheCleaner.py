@@ -3,62 +3,71 @@ import shutil
 import time
 import threading
 import logging
+from cacheIndex import cacheIndex
+from proxyMetrics import proxyMetrics
 
 
 
 class cacheCleaner:
 
-    
+    POLICIES = tuple(cacheIndex.EVICTION_ORDER.keys())
 
-    def __init__(self, cached_items , cache_root : set, low_watermark : int = None, high_watermark : int = None) :
+    def __init__(self, frame_cache , low_watermark : int = None, high_watermark : int = None, policy : str = "lru", batch_size : int = 1000) :
         self.logger = logging.getLogger(__name__)
         if low_watermark is None:
             low_watermark = 5 #Cache cleaner will trigger when 5Gb of space remains on the cache volume.
         if high_watermark is None: #Once triggered Cache Cleaner will stop removing files when there is 15GB of free space.
             high_watermark = 15
-        self.cacheProcessor = threading.Thread(target=self.chekAndClean, args=(cached_items,cache_root, low_watermark*1024, high_watermark*1024))
+        self.policy = policy
+        self.batch_size = batch_size # files unlinked between two index transactions.
+        proxyMetrics.describe("cache_evicted_files_total", "Files removed from the disk cache by the cache cleaner, by tier.")
+        proxyMetrics.describe("cache_evicted_bytes_total", "Bytes removed from the disk cache by the cache cleaner, by tier.")
+        proxyMetrics.describe("cache_eviction_seconds", "Duration of the cache cleaner passes.")
+        self.cacheProcessor = threading.Thread(target=self.chekAndClean, args=(frame_cache, frame_cache.cache_root, low_watermark*1024, high_watermark*1024), name="cacheCleaner")
         self.cacheProcessor.start()
-    
 
-    def chekAndClean(self, cached_items : set, cache_root, low_watermark , high_watermark):
+
+    def chekAndClean(self, frame_cache , cache_root, low_watermark , high_watermark):
         while(True):
-            try: 
+            try:
                 freespace = self.getFreeSpace(cache_root)
-                while(freespace < low_watermark) :
+                if freespace < low_watermark:
                     self.logger.warning("Low watermark reached. Starting clean-up.")
-                    paths = sorted( [x[0] for x in os.walk(cache_root)], key=os.path.getctime)
-                    path=paths[1] # [0] is the cache root itself.
-                    for path in paths:
-                        try:
-                            for file in os.listdir(path):
-                                # check only text files
-                                if file.endswith('.cache'):
-                                    try:
-                                        try:
-                                            cached_items.remove(os.path.join(path[len(cache_root)+1:],file[:-6]))
-                                        except:
-                                            pass #entry is not in the cache ( could be the case if the service has rebooted)
-                                        os.remove(os.path.join(path,file))
-                                    except Exception as err:
-                                        print(err)
-                            try:
-                                os.removedirs(path)
-                            except:
-                                pass #some files could have spawned in the folder in-between, unlikely...
-                        except Exception as err:
-                            print(err)
-                        if (self.getFreeSpace(cache_root) >  high_watermark) :
-                            self.logger.warning("High watermark reached. stoping clean-up.")
-                            break 
-                    freespace = self.getFreeSpace(cache_root)
-                time.sleep(5)
-            except:
-                #catching the thread if it falls
-                self.logger.error("Cache Cleaner thread encountered an issue and will be restored in 5 seconds.")
-                time.sleep(5)
-                self.chekAndClean(cached_items , cache_root, low_watermark , high_watermark)
+                    self.evict(frame_cache, (high_watermark - freespace)*1024*1024)
+                    self.logger.warning(f"Clean-up done, {self.getFreeSpace(cache_root):.0f} MB free.")
+            except Exception as err:
+                self.logger.error(f"Cache Cleaner thread encountered an issue and will be restored in 5 seconds : {err}")
+            time.sleep(5)
+
+    def evict(self, frame_cache , bytes_to_free : int) -> int:
+        """Removes the least recently (lru) or least frequently (lfu) used frames until bytes_to_free are released, in a single
+        pass over the index. Files are unlinked in batches, each batch being dropped from the index in one transaction.
+        Returns the number of bytes released."""
+        start = time.perf_counter()
+        candidates = frame_cache.evictionCandidates(bytes_to_free, self.policy)
+        freed = 0
+        directories = set()
+        for batch_start in range(0, len(candidates), self.batch_size):
+            removed_files = {}
+            removed_bytes = {}
+            for key , tier , size in frame_cache.evict(candidates[batch_start:batch_start+self.batch_size]):
+                directories.add(os.path.dirname(frame_cache.filePath(key, tier)))
+                freed += size
+                removed_files[tier] = removed_files.get(tier, 0) + 1
+                removed_bytes[tier] = removed_bytes.get(tier, 0) + size
+            for tier , size in removed_bytes.items():
+                proxyMetrics.inc("cache_evicted_files_total", removed_files[tier], tier=tier)
+                proxyMetrics.inc("cache_evicted_bytes_total", size, tier=tier)
+        for directory in directories:
+            try:
+                os.rmdir(directory) # only succeeds once the image set has no frame left.
+            except OSError:
+                pass
+        proxyMetrics.observe("cache_eviction_seconds", time.perf_counter() - start)
+        self.logger.info(f"{len(candidates)} frames ({freed/1024/1024:.0f} MB) evicted by {self.policy} in {time.perf_counter()-start:.1f}s.")
+        return freed
 
     def getFreeSpace(self, directory):
         stat = shutil.disk_usage(directory)
         freeMB = stat.free/1024/1024 # get us the value in MBytes.
-        return freeMB
\ No newline at end of file
+        return freeMB
@@ -0,0 +1,218 @@
+"""
+cacheIndex Module : Persistent index of the frames present in the disk cache, stored in SQLite (WAL mode).
+
+Every thread gets its own connection, and WAL lets readers proceed while a writer commits, so the prefetch workers,
+the request threads and the cache cleaner can all consult and update it without sharing a Python lock. The index
+survives restarts and is reconciled with the content of CACHE_ROOT at startup.
+
+Each entry also records when the frame was last read and how many times, so that cacheCleaner can pick the least
+recently (LRU) or least frequently (LFU) used frames straight from the index, in a single ordered scan. Reads are
+accumulated in memory by the request threads and written by a flusher thread, in one transaction every flush_interval.
+
+Hits are reported by the age of the frame read (time since it was written to the cache) and misses are counted, by
+tier : the hit ratio a cache keeping frames for N seconds would achieve is the share of hits younger than N among all
+the lookups, which is how the cache volume can be sized for a target hit rate.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import os
+import sqlite3
+import threading
+import time
+import logging
+from proxyMetrics import proxyMetrics
+
+
+class cacheIndex:
+
+    SCHEMA_VERSION = 3
+    INDEX_FILE = ".cacheindex.sqlite"
+    TIERS = { ".cache" : "raw" , ".pixels" : "pixels" , ".seg" : "segment" } # file extension -> cache tier, segments hold many raw frames.
+    EXTENSIONS = { tier : extension for extension , tier in TIERS.items() }
+    EVICTION_ORDER = { "lru" : "accessed" , "lfu" : "hits, accessed" } # eviction policy -> ORDER BY of the candidates, each backed by an index.
+
+    def __init__(self, cache_root : str, index_path : str = None, flush_interval : float = 1.0):
+        self.logger = logging.getLogger(__name__)
+        self.cache_root = cache_root
+        self.hits_lock = threading.Lock()
+        self.pending_hits = {} # (key, tier) -> [last read time, reads] not written to the index yet.
+        self.flush_interval = flush_interval
+        proxyMetrics.describe("frame_cache_hit_age_seconds", "Age of the cached frames when they are read from disk, by tier.")
+        proxyMetrics.describe("frame_cache_misses_total", "Frame lookups that did not find the frame in the disk cache, by tier.")
+        if index_path is None:
+            index_path = os.path.join(cache_root, cacheIndex.INDEX_FILE)
+        self.index_path = index_path
+        self.local = threading.local()
+        connection = self._connection()
+        connection.execute("PRAGMA journal_mode=WAL")
+        if connection.execute("PRAGMA user_version").fetchone()[0] != cacheIndex.SCHEMA_VERSION:
+            connection.execute("DROP TABLE IF EXISTS frames") # the index is derived from the cache content, rebuild() repopulates it.
+        connection.execute("CREATE TABLE IF NOT EXISTS frames (key TEXT NOT NULL, tier TEXT NOT NULL, size INTEGER NOT NULL, stored REAL NOT NULL, accessed REAL NOT NULL, hits INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (key, tier)) WITHOUT ROWID")
+        connection.execute("CREATE INDEX IF NOT EXISTS frames_lru ON frames (accessed)")
+        connection.execute("CREATE INDEX IF NOT EXISTS frames_lfu ON frames (hits, accessed)")
+        connection.execute(f"PRAGMA user_version={cacheIndex.SCHEMA_VERSION}")
+        connection.commit()
+        self.flusher = threading.Thread(target=self._flushLoop, name="cacheIndexFlusher", daemon=True)
+        self.flusher.start()
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.index_path, timeout=30, check_same_thread=False)
+            connection.execute("PRAGMA synchronous=NORMAL") # WAL + NORMAL : a crash may lose the last transactions, which the startup rebuild restores.
+            self.local.connection = connection
+        return connection
+
+    @staticmethod
+    def frameKey(datastore_id : str, imageset_id : str, imageframe_id : str) -> str:
+        return datastore_id+"/"+imageset_id+"/"+imageframe_id
+
+    def contains(self, key : str, tier : str = "raw") -> bool:
+        return self._connection().execute("SELECT 1 FROM frames WHERE key = ? AND tier = ?", (key, tier)).fetchone() is not None
+
+    def containsMany(self, keys : list, tier : str = "raw") -> set:
+        """Returns the keys present in the index, in one query per batch of 500 keys."""
+        present = set()
+        connection = self._connection()
+        for batch_start in range(0, len(keys), 500):
+            batch = keys[batch_start:batch_start+500]
+            query = f"SELECT key FROM frames WHERE tier = ? AND key IN ({','.join('?' * len(batch))})"
+            present.update(key for (key,) in connection.execute(query, [tier] + batch))
+        return present
+
+    def add(self, key : str, size : int, tier : str = "raw"):
+        now = time.time()
+        connection = self._connection()
+        with connection:
+            connection.execute("INSERT OR REPLACE INTO frames (key, tier, size, stored, accessed, hits) VALUES (?, ?, ?, ?, ?, 0)", (key, tier, size, now, now))
+
+    def resize(self, key : str, size : int, tier : str = "raw"):
+        """Adds an entry or updates its size, eg. a segment growing with every frame, keeping its read count."""
+        now = time.time()
+        connection = self._connection()
+        with connection:
+            connection.execute("INSERT INTO frames (key, tier, size, stored, accessed, hits) VALUES (?, ?, ?, ?, ?, 0) ON CONFLICT (key, tier) DO UPDATE SET size = excluded.size, accessed = excluded.accessed", (key, tier, size, now, now))
+
+    def touch(self, key : str, tier : str = "raw"):
+        """Records a read of the frame, it moves to the back of the eviction order once flushed. Never touches SQLite."""
+        now = time.time()
+        with self.hits_lock:
+            pending = self.pending_hits.get((key, tier))
+            if pending is None:
+                self.pending_hits[(key, tier)] = [now, 1]
+            else:
+                pending[0] = now
+                pending[1] += 1
+
+    def recordHit(self, key : str, tier : str, stored : float):
+        """Records a read of the frame from disk, stored being the time it was written (its file mtime)."""
+        self.touch(key, tier)
+        proxyMetrics.observe("frame_cache_hit_age_seconds", max(time.time() - stored, 0), buckets=proxyMetrics.AGE_BUCKETS, tier=tier)
+
+    @staticmethod
+    def recordMiss(tier : str = "raw"):
+        proxyMetrics.inc("frame_cache_misses_total", tier=tier)
+
+    def flushHits(self) -> int:
+        """Writes the reads recorded since the previous flush in a single transaction. Returns the number of entries updated."""
+        with self.hits_lock:
+            pending = self.pending_hits
+            self.pending_hits = {}
+        if len(pending) == 0:
+            return 0
+        connection = self._connection()
+        with connection:
+            connection.executemany("UPDATE frames SET accessed = MAX(accessed, ?), hits = hits + ? WHERE key = ? AND tier = ?", [ (accessed, reads, key, tier) for (key, tier) , (accessed, reads) in pending.items() ])
+        return len(pending)
+
+    def _flushLoop(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flushHits()
+            except Exception as err:
+                self.logger.warning(f"[{__name__}] - cache hits could not be written to the index : {err}")
+
+    def remove(self, key : str, tier : str = "raw"):
+        self.removeMany([key], tier)
+
+    def removeMany(self, keys : list, tier : str = "raw"):
+        self.removeEntries([(key, tier) for key in keys])
+
+    def removeEntries(self, entries : list):
+        """Removes a list of (key, tier) in a single transaction."""
+        connection = self._connection()
+        with connection:
+            connection.executemany("DELETE FROM frames WHERE key = ? AND tier = ?", entries)
+
+    def evictionCandidates(self, bytes_to_free : int, policy : str = "lru") -> list:
+        """Returns the (key, tier, size) to evict, in eviction order, whose sizes add up to bytes_to_free or just above."""
+        self.flushHits()
+        candidates = []
+        cursor = self._connection().execute(f"SELECT key, tier, size FROM frames ORDER BY {cacheIndex.EVICTION_ORDER[policy]}") #nosec - the order comes from EVICTION_ORDER.
+        try:
+            while bytes_to_free > 0:
+                rows = cursor.fetchmany(1000)
+                if len(rows) == 0:
+                    break
+                for row in rows:
+                    candidates.append(row)
+                    bytes_to_free -= row[2]
+                    if bytes_to_free <= 0:
+                        break
+        finally:
+            cursor.close()
+        return candidates
+
+    def filePath(self, key : str, tier : str = "raw") -> str:
+        return os.path.join(self.cache_root, key + cacheIndex.EXTENSIONS[tier])
+
+    def count(self, tier : str = None) -> int:
+        if tier is None:
+            return self._connection().execute("SELECT COUNT(*) FROM frames").fetchone()[0]
+        return self._connection().execute("SELECT COUNT(*) FROM frames WHERE tier = ?", (tier,)).fetchone()[0]
+
+    def totalBytes(self, tier : str = None) -> int:
+        if tier is None:
+            return self._connection().execute("SELECT COALESCE(SUM(size), 0) FROM frames").fetchone()[0]
+        return self._connection().execute("SELECT COALESCE(SUM(size), 0) FROM frames WHERE tier = ?", (tier,)).fetchone()[0]
+
+    def rebuild(self):
+        """Reconciles the index with the .cache and .pixels files found under the cache root : adds the files missing from the index
+        and drops the entries whose file is gone, eg. removed while the service was down."""
+        start = time.time()
+        connection = self._connection()
+        with connection:
+            connection.execute("CREATE TEMP TABLE IF NOT EXISTS found (key TEXT NOT NULL, tier TEXT NOT NULL, size INTEGER NOT NULL, stored REAL NOT NULL, accessed REAL NOT NULL, PRIMARY KEY (key, tier)) WITHOUT ROWID")
+            connection.execute("DELETE FROM found")
+            batch = []
+            for entry in self._scan():
+                batch.append(entry)
+                if len(batch) == 10000:
+                    connection.executemany("INSERT OR REPLACE INTO found VALUES (?, ?, ?, ?, ?)", batch)
+                    batch = []
+            connection.executemany("INSERT OR REPLACE INTO found VALUES (?, ?, ?, ?, ?)", batch)
+            removed = connection.execute("DELETE FROM frames WHERE NOT EXISTS (SELECT 1 FROM found WHERE found.key = frames.key AND found.tier = frames.tier)").rowcount
+            added = connection.execute("INSERT OR IGNORE INTO frames (key, tier, size, stored, accessed) SELECT key, tier, size, stored, accessed FROM found").rowcount
+            connection.execute("DROP TABLE found")
+        self.logger.info(f"[{__name__}] - cache index rebuilt in {time.time()-start:.1f}s : {added} entries added, {removed} stale entries removed.")
+
+    def _scan(self):
+        root_length = len(os.path.abspath(self.cache_root)) + 1
+        for path, dirs, files in os.walk(os.path.abspath(self.cache_root)):
+            for file in files:
+                name, extension = os.path.splitext(file)
+                tier = cacheIndex.TIERS.get(extension)
+                if extension == ".tmp":
+                    try:
+                        os.remove(os.path.join(path, file)) # left by a write interrupted by the previous shutdown.
+                    except OSError:
+                        pass
+                if tier is None:
+                    continue
+                try:
+                    stat = os.stat(os.path.join(path, file))
+                except OSError:
+                    continue # removed in-between.
+                # the access time is only a hint (relatime, noatime mounts), it is never older than the write.
+                yield os.path.join(path[root_length:], name).replace(os.sep, "/"), tier, stat.st_size, stat.st_mtime, max(stat.st_atime, stat.st_mtime)
@@ -0,0 +1,110 @@
+"""
+decodePool Module : Pool of processes decoding the HTJ2K frames out of the request threads.
+
+openjpeg decoding holds the GIL for part of its work, so concurrent frame requests decoded inline serialize on a single
+core and starve the other requests served by the same process. The decoded pixels are handed back through a shared
+memory block rather than pickled through the result pipe, and copied out of it as soon as the decode completes. A pool
+whose process died, eg. killed by the OOM killer, is replaced by a new one.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import io
+import os
+import time
+import logging
+import threading
+import multiprocessing
+import concurrent.futures
+from multiprocessing import shared_memory
+from proxyMetrics import proxyMetrics
+
+
+def decodeToSharedMemory(frame : bytes, submitted : float):
+    """Runs in the pool processes. Returns (shared memory name, pixels size, submit time, start time, end time), name is None if the frame could not be decoded."""
+    from openjpeg import decode
+    started = time.time()
+    try:
+        pixels = decode(io.BytesIO(frame))
+    except Exception:
+        return None, 0, submitted, started, time.time()
+    size = pixels.nbytes
+    block = shared_memory.SharedMemory(create=True, size=max(size, 1))
+    try:
+        block.buf[:size] = pixels.reshape(-1).view("uint8")
+    finally:
+        block.close() # the request thread reads and unlinks it.
+    return block.name, size, submitted, started, time.time()
+
+
+class decodePool:
+
+    def __init__(self, workers : int = None):
+        self.logger = logging.getLogger(__name__)
+        if workers is None:
+            workers = os.cpu_count()
+        self.workers = workers
+        self.lock = threading.Lock() # guards the replacement of a broken executor.
+        self.executor = self._startExecutor()
+        proxyMetrics.describe("decode_queue_wait_seconds", "Time spent by the frames waiting for a decode process.")
+        proxyMetrics.describe("decode_seconds", "Time spent decoding the frames in the decode processes.")
+        proxyMetrics.describe("decode_failures_total", "Frames the decode processes could not decode.")
+        proxyMetrics.describe("decode_pool_restarts_total", "Decode pools replaced after one of their processes died, eg. killed by the OOM killer.")
+
+    def _startExecutor(self) -> concurrent.futures.ProcessPoolExecutor:
+        return concurrent.futures.ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+
+    def decode(self, frame : bytes) -> bytes:
+        """Decodes an HTJ2K frame in the pool and waits for it. Returns the little endian pixels, or None if the frame cannot be decoded."""
+        return self.submit(frame).result()
+
+    def submit(self, frame : bytes) -> concurrent.futures.Future:
+        """Queues an HTJ2K frame for decoding without waiting for it, which lets an event loop await it through asyncio.wrap_future.
+        The future is resolved with the pixels, None if the frame cannot be decoded, or BrokenProcessPool if the pool broke meanwhile."""
+        executor = self.executor
+        try:
+            decode_future = executor.submit(decodeToSharedMemory, frame, time.time())
+        except concurrent.futures.process.BrokenProcessPool:
+            executor = self.restart(executor)
+            decode_future = executor.submit(decodeToSharedMemory, frame, time.time())
+        pixels_future = concurrent.futures.Future()
+        decode_future.add_done_callback(lambda done : self._collect(done, pixels_future, executor))
+        return pixels_future
+
+    def _collect(self, decode_future : concurrent.futures.Future, pixels_future : concurrent.futures.Future, executor):
+        # Runs as soon as the decode is done, whether the caller still waits or not : the shared memory block is
+        # released right away, so /dev/shm only ever holds the frames being decoded, about one per process.
+        try:
+            name, size, submitted, started, finished = decode_future.result()
+        except concurrent.futures.process.BrokenProcessPool as err:
+            self.restart(executor)
+            pixels_future.set_exception(err)
+            return
+        except BaseException as err:
+            pixels_future.set_exception(err)
+            return
+        proxyMetrics.observe("decode_queue_wait_seconds", max(started - submitted, 0))
+        proxyMetrics.observe("decode_seconds", finished - started)
+        if name is None:
+            proxyMetrics.inc("decode_failures_total")
+            pixels_future.set_result(None)
+            return
+        block = shared_memory.SharedMemory(name=name)
+        try:
+            pixels = block.buf[:size].tobytes() # the only copy made in this process.
+        finally:
+            block.close()
+            block.unlink()
+        pixels_future.set_result(pixels)
+
+    def restart(self, broken_executor) -> concurrent.futures.ProcessPoolExecutor:
+        """Replaces the executor if it is still the broken one, and returns the executor to use."""
+        with self.lock:
+            if self.executor is broken_executor:
+                self.logger.error(f"[{__name__}] - a decode process died, restarting the decode pool.")
+                proxyMetrics.inc("decode_pool_restarts_total")
+                self.executor = self._startExecutor()
+                broken_executor.shutdown(wait=False, cancel_futures=True)
+            return self.executor
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
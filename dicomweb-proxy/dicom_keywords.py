@@ -0,0 +1,32 @@
+"""
+Keyword lookup tables compiled once at import from the pydicom data dictionary.
+
+AHI metadata uses DICOM keywords as attribute names. Resolving them through pydicom.datadict for every attribute of
+every instance dominates the CPU time of the metadata conversions, these tables turn it into a single dict lookup.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+from pydicom import datadict
+
+# keyword -> (8 characters upper case hex tag, VR, tag as int). Same coverage as datadict.tag_for_keyword.
+keyword_tags = { entry[4] : (f"{tag:08X}", entry[0], tag) for tag, entry in datadict.DicomDictionary.items() if entry[4] != "" }
+
+# VRs of the attribute names that are not keywords (hex tags, repeating groups...), resolved lazily through pydicom.
+# None is stored for the names pydicom does not know, eg. private tags, so that they are not looked up again.
+other_key_vrs = {}
+
+
+def dictionary_vr(key : str):
+    """Returns the VR of a keyword or hex tag from the DICOM data dictionary, or None if the dictionary does not define it."""
+    entry = keyword_tags.get(key)
+    if entry is not None:
+        return entry[1]
+    try:
+        return other_key_vrs[key]
+    except KeyError:
+        try:
+            vr = datadict.dictionary_VR(key)
+        except Exception:
+            vr = None
+        other_key_vrs[key] = vr
+        return vr
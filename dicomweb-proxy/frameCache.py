@@ -0,0 +1,135 @@
+"""
+frameCache Module : Single entry point of the raw frames disk cache.
+
+The request path (getFrame), the prefetch workers (frameFetcher) and the eviction (cacheCleaner) all go through this
+class, which owns where the frames live under CACHE_ROOT (one .cache file per frame, or packed segments with
+FRAME_CACHE_LAYOUT=segments), how they are read and written, and the hit, miss and write statistics. Frame files are
+written to a temporary file renamed over the final path once complete, so a reader never gets a partial frame.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import os
+import uuid
+import logging
+from cacheIndex import cacheIndex
+from segmentStore import segmentStore
+from proxyMetrics import proxyMetrics
+
+
+class frameCache:
+
+    LAYOUTS = segmentStore.LAYOUTS
+    TIER = "raw"
+
+    def __init__(self, cache_root : str, cache_index , layout : str = "files", segment_max_bytes : int = 64*1024*1024):
+        self.logger = logging.getLogger(__name__)
+        self.cache_root = cache_root
+        self.cache_index = cache_index
+        self.layout = layout
+        self.segment_store = None # segmentStore holding the frames with the segments layout.
+        proxyMetrics.describe("frame_cache_writes_total", "Frames written to the disk cache, by layout and result.")
+        proxyMetrics.describe("frame_cache_written_bytes_total", "Bytes of the frames written to the disk cache, by layout.")
+        if layout == "segments":
+            self.segment_store = segmentStore(cache_root, cache_index, segment_max_bytes=segment_max_bytes)
+
+    def framePath(self, datastore_id : str, imageset_id : str, imageframe_id : str) -> str:
+        return f"{self.cache_root}/{datastore_id}/{imageset_id}/{imageframe_id}.cache"
+
+    def contains(self, datastore_id : str, imageset_id : str, imageframe_id : str) -> bool:
+        """Index lookup only, the disk is not touched."""
+        if self.segment_store is not None:
+            return self.segment_store.contains(datastore_id, imageset_id, imageframe_id)
+        return self.cache_index.contains(cacheIndex.frameKey(datastore_id, imageset_id, imageframe_id), frameCache.TIER)
+
+    def cachedFrames(self, datastore_id : str, imageset_id : str, imageframe_ids : list) -> set:
+        """Returns the frames of an image set that are cached, from memory with segments or in one index query otherwise."""
+        if self.segment_store is not None:
+            return { imageframe_id for imageframe_id in imageframe_ids if self.segment_store.contains(datastore_id, imageset_id, imageframe_id) }
+        keys = self.cache_index.containsMany([ cacheIndex.frameKey(datastore_id, imageset_id, imageframe_id) for imageframe_id in imageframe_ids ], frameCache.TIER)
+        return { key[key.rindex("/")+1:] for key in keys }
+
+    def adopt(self, datastore_id : str, imageset_id : str, imageframe_id : str) -> bool:
+        """Indexes a frame file present on disk but missing from the index, eg. written before the index existed.
+        Returns True if the frame is cached."""
+        if self.contains(datastore_id, imageset_id, imageframe_id):
+            return True
+        if self.segment_store is not None:
+            return False
+        try:
+            size = os.path.getsize(self.framePath(datastore_id, imageset_id, imageframe_id))
+        except OSError:
+            return False
+        self.cache_index.add(cacheIndex.frameKey(datastore_id, imageset_id, imageframe_id), size, frameCache.TIER)
+        return True
+
+    def read(self, datastore_id : str, imageset_id : str, imageframe_id : str, count_miss : bool = True) -> bytes:
+        """Returns the frame bytes, None if the frame is not cached. The hit is recorded for the eviction and the statistics,
+        and so is the miss unless count_miss is cleared, eg. when the caller already counted it."""
+        if self.segment_store is not None:
+            return self.segment_store.read(datastore_id, imageset_id, imageframe_id, count_miss=count_miss)
+        try:
+            with open(self.framePath(datastore_id, imageset_id, imageframe_id), 'rb') as frame_file:
+                frame = frame_file.read()
+                stored = os.fstat(frame_file.fileno()).st_mtime
+        except OSError:
+            if count_miss:
+                cacheIndex.recordMiss(frameCache.TIER)
+            return None
+        self.cache_index.recordHit(cacheIndex.frameKey(datastore_id, imageset_id, imageframe_id), frameCache.TIER, stored) # queued, written by the index flusher.
+        return frame
+
+    def write(self, datastore_id : str, imageset_id : str, imageframe_id : str, frame : bytes) -> bool:
+        """Stores a frame and indexes it. Returns False if it could not be written, eg. disk full."""
+        try:
+            if self.segment_store is not None:
+                self.segment_store.append(datastore_id, imageset_id, imageframe_id, frame)
+            else:
+                self._writeFile(datastore_id, imageset_id, imageframe_id, frame)
+        except OSError as err:
+            self.logger.warning(f"[{__name__}] - {datastore_id}/{imageset_id}/{imageframe_id} could not be cached : {err}")
+            proxyMetrics.inc("frame_cache_writes_total", layout=self.layout, result="error")
+            return False
+        proxyMetrics.inc("frame_cache_writes_total", layout=self.layout, result="stored")
+        proxyMetrics.inc("frame_cache_written_bytes_total", len(frame), layout=self.layout)
+        return True
+
+    def _writeFile(self, datastore_id : str, imageset_id : str, imageframe_id : str, frame : bytes):
+        frame_file_path = self.framePath(datastore_id, imageset_id, imageframe_id)
+        temp_file_path = f"{frame_file_path}.{uuid.uuid4().hex}.tmp" # removed by cacheIndex.rebuild if the process dies before the rename.
+        os.makedirs(f"{self.cache_root}/{datastore_id}/{imageset_id}",exist_ok=True)
+        try:
+            with open(temp_file_path, 'wb') as frame_file:
+                frame_file.write(frame)
+            os.replace(temp_file_path, frame_file_path)
+        except OSError:
+            try:
+                os.remove(temp_file_path)
+            except OSError:
+                pass
+            raise
+        self.cache_index.add(cacheIndex.frameKey(datastore_id, imageset_id, imageframe_id), len(frame), frameCache.TIER)
+
+    def evictionCandidates(self, bytes_to_free : int, policy : str = "lru") -> list:
+        return self.cache_index.evictionCandidates(bytes_to_free, policy)
+
+    def evict(self, entries : list) -> list:
+        """Removes the given (key, tier, size) from the disk and from the index, whatever their tier (frames, segments or decoded pixels).
+        Returns the entries removed, the ones that could not be unlinked stay indexed."""
+        removed = []
+        for key , tier , size in entries:
+            path = self.cache_index.filePath(key, tier)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass # already gone, only the index entry is left.
+            except OSError as err:
+                self.logger.warning(f"[{__name__}] - {path} could not be removed : {err}")
+                continue
+            removed.append((key, tier, size))
+        self.cache_index.removeEntries([ (key, tier) for key , tier , size in removed ])
+        if self.segment_store is not None:
+            self.segment_store.evicted([ (key, tier) for key , tier , size in removed ])
+        return removed
+
+    def filePath(self, key : str, tier : str = TIER) -> str:
+        return self.cache_index.filePath(key, tier)
@@ -1,92 +1,242 @@
-import gzip
-import orjson
-import concurrent.futures
-from concurrent.futures import wait
+"""
+frameFetcher Module : In-process prefetch engine copying AHI image frames to the local cache.
+
+A single blocking priority queue is drained by a fixed number of worker threads, which bounds the number of concurrent
+GetImageFrame calls made against AHI. Frames a client is waiting for jump ahead of the series being viewed, which
+jump ahead of the background prefetch triggered by metadata and instance retrieves.
+
+SPDX-License-Identifier: Apache-2.0
+"""
 import os
-import io
-import sys
 import logging
-import boto3 
-import botocore
-import datetime
-from collections import deque
+import itertools
+import queue
 import threading
-import multiprocessing
-from multiprocessing import Queue , set_start_method , Manager
 import time
+from concurrent.futures import Future
+from proxyMetrics import proxyMetrics
+from cacheIndex import cacheIndex
+from lruCache import lruCache
 
 
 class frameFetcher:
-        
-    cached_items = set()
 
-    def __init__(self , frameFetcherName, getFramePixels , cache_root : str):
+    REQUEST = 0       # A client request is blocked on the frame.
+    VIEWING = 1       # The frame belongs to an image set whose frames are currently being retrieved.
+    BACKGROUND = 2    # Prefetch of the image sets whose metadata or instances were retrieved.
+    PRIORITY_NAMES = ("request", "viewing", "background")
+    ASSIGNED_TTL = 30 # Seconds during which an image set whose frames were all queued or found cached is not checked again.
+
+    def __init__(self , frameFetcherName : str, ahi_client , frame_cache , concurrency : int = 32, store_raw : bool = True, pixel_cache = None, decode_frame = None):
         self.logger = logging.getLogger(__name__)
         self.status = 1
-        multiprocessing.set_start_method("spawn", force=True)
-        self.ctx = multiprocessing.get_context('spawn')
-        self.cacheQueue = self.ctx.Queue()
-        self.cacheProcessor = self.ctx.Process(target=self.ProcessRunner, args=(self.cacheQueue, frameFetcher.fetchAndStore ,getFramePixels  , cache_root ))
-        self.cacheProcessor.start()
         self.frameFetcherName = frameFetcherName
+        self.ahi_client = ahi_client
+        self.frame_cache = frame_cache  # frameCache holding the raw frames, shared with the request path and cacheCleaner.
+        self.store_raw = store_raw      # False when the cache policy only keeps the decoded pixels.
+        self.pixel_cache = pixel_cache  # pixelCache receiving the prefetched frames decoded by decode_frame, None when the cache policy only keeps the raw frames.
+        self.decode_frame = decode_frame
+        self.store_tier = "raw" if store_raw else "pixels"
+        self.concurrency = concurrency
+        self.fetchQueue = queue.PriorityQueue()  # (priority, sequence, key). Promotions enqueue a second copy, stale copies are skipped by the workers.
+        self.sequence = itertools.count()        # FIFO order within a priority level.
+        self.lock = threading.Lock()
+        self.pending = {}    # key -> entry of the frames waiting in the queue.
+        self.inflight = {}   # key -> entry of the frames being fetched.
+        self.imagesets = {}  # "datastore_id/imageset_id" -> {"priority" , "keys"} of the pending frames of each image set.
+        self.assigned = lruCache(name="prefetchAssigned", max_entries=4096, ttl=frameFetcher.ASSIGNED_TTL) # "datastore_id/imageset_id" -> priority it was last assigned with.
+        self.depth = [0] * len(frameFetcher.PRIORITY_NAMES)
+        self.workers = []
+        for worker_id in range(concurrency):
+            worker = threading.Thread(target=self.worker, name=f"{frameFetcherName}-{worker_id}", daemon=True)
+            worker.start()
+            self.workers.append(worker)
+        proxyMetrics.describe("prefetch_queue_depth", "Frames waiting in the prefetch queue, by priority.")
+        proxyMetrics.describe("prefetch_inflight", "Frames being fetched from AHI by the prefetch workers.")
+        proxyMetrics.describe("prefetch_frames_total", "Frames processed by the prefetch workers, by priority and outcome.")
+        proxyMetrics.describe("prefetch_bytes_total", "Bytes fetched from AHI and written to the cache by the prefetch workers.")
+        proxyMetrics.describe("prefetch_promotions_total", "Queued frames moved to a more urgent priority.")
+        proxyMetrics.describe("prefetch_queue_wait_seconds", "Time spent by the frames in the prefetch queue, by priority.")
+        proxyMetrics.registerCollector(self.collectMetrics)
 
-
-    def addToCacheByMetadata(self, metadata : object):
-        print(f"[{self.frameFetcherName}] - in addToCacheByMetadata ")
-        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
-            executor.submit(self._addToCacheByMetadata, metadata)
-            executor.shutdown(wait=False)
-
-    def _addToCacheByMetadata(self,metadata):
+    def addToCacheByMetadata(self, metadata : object, priority : int = BACKGROUND):
+        """Queues the frames of an image set that are neither queued nor cached. Called for every instance of a retrieved series,
+        so the image set is skipped when it was assigned moments ago, and the cached frames are looked up in a single query."""
         try:
-            datastore_id = metadata["DatastoreID"]
-            imageset_id = metadata["ImageSetID"]
-            series_uid = next(iter(metadata["Study"]["Series"].keys()))
-            instances = iter(metadata["Study"]["Series"][series_uid]["Instances"].keys())
-            for instance in instances:
-                for frame in metadata["Study"]["Series"][series_uid]["Instances"][instance]["ImageFrames"]:
-                    frame_id = frame["ID"]
-                    if not datastore_id+imageset_id+frame_id in frameFetcher.cached_items:
-                        self.addToCache({ "status" : 0 , "datastore_id" : datastore_id , "imageset_id" : imageset_id , "imageframe_id" : frame_id})
+            imageset_key = metadata["DatastoreID"]+"/"+metadata["ImageSetID"]
+            assigned = self.assigned.get(imageset_key)
+            if assigned is not None and assigned <= priority:
+                return
+            unknown = []
+            for cache_object in frameFetcher.getFramesToCache(metadata):
+                key = imageset_key+"/"+cache_object["imageframe_id"]
+                if key in self.pending or key in self.inflight:
+                    self.addToCache(cache_object, priority, check_cache=False) # promotion only.
+                else:
+                    unknown.append(cache_object)
+            cached = self.cachedFrames(metadata["DatastoreID"], metadata["ImageSetID"], [ cache_object["imageframe_id"] for cache_object in unknown ])
+            for cache_object in unknown:
+                if not cache_object["imageframe_id"] in cached:
+                    self.addToCache(cache_object, priority, check_cache=False)
+            self.assigned.put(imageset_key, priority)
         except Exception as err:
-            self.logger.error("_addToCachebyMetadata Exception :")
-            self.logger(err)
-        
-    def addToCache(self, cache_object : dict):
+            self.logger.error(f"[{self.frameFetcherName}] - addToCacheByMetadata Exception : {err}")
+
+    def addToCache(self, cache_object : dict, priority : int = BACKGROUND, wait : bool = False, check_cache : bool = True) -> Future:
+        """Queues a frame for prefetch, or promotes it if it is already queued with a lower priority.
+        With wait set, returns a Future resolved with the frame bytes once fetched, None otherwise.
+        check_cache is cleared by the callers that already know the frame is not cached."""
+        imageset_key = cache_object["datastore_id"]+"/"+cache_object["imageset_id"]
+        key = imageset_key+"/"+cache_object["imageframe_id"]
+        if not wait and check_cache and not (key in self.pending or key in self.inflight) and self.isCached(cache_object, key): #let's not add it if this is already there...
+            return None
+        with self.lock:
+            entry = self.pending.get(key)
+            if entry is None:
+                entry = self.inflight.get(key)
+            if entry is None:
+                imageset = self.imagesets.get(imageset_key)
+                if imageset is None:
+                    imageset = { "priority" : frameFetcher.BACKGROUND , "keys" : set() } # only promoteImageSet raises the priority of a whole image set.
+                    self.imagesets[imageset_key] = imageset
+                entry = { "object" : cache_object , "priority" : min(priority, imageset["priority"]) , "queued" : time.monotonic() , "future" : None }
+                imageset["keys"].add(key)
+                self.pending[key] = entry #pending and inflight prevent an exisiting item to re-enter the processing queue until it is indexed.
+                self.depth[entry["priority"]] += 1
+                self.fetchQueue.put((entry["priority"], next(self.sequence), key))
+            elif priority < entry["priority"] and key in self.pending:
+                self._promote(key, entry, priority)
+            if wait and entry["future"] is None:
+                entry["future"] = Future()
+            return entry["future"]
+
+    def cachedFrames(self, datastore_id : str, imageset_id : str, imageframe_ids : list) -> set:
+        if self.store_raw:
+            return self.frame_cache.cachedFrames(datastore_id, imageset_id, imageframe_ids)
+        keys = self.frame_cache.cache_index.containsMany([ cacheIndex.frameKey(datastore_id, imageset_id, imageframe_id) for imageframe_id in imageframe_ids ], self.store_tier)
+        return { key[key.rindex("/")+1:] for key in keys }
+
+    def isCached(self, cache_object : dict, key : str) -> bool:
+        if self.store_raw:
+            return self.frame_cache.contains(cache_object["datastore_id"], cache_object["imageset_id"], cache_object["imageframe_id"])
+        return self.frame_cache.cache_index.contains(key, self.store_tier)
+
+    def fetchFrame(self, datastore_id : str, imageset_id : str, imageframe_id : str, priority : int = REQUEST, timeout : float = None) -> bytes:
+        """Fetches a frame through the queue with the given priority and waits for it. Concurrent requests for the same frame share a single AHI call."""
+        future = self.addToCache({ "datastore_id" : datastore_id , "imageset_id" : imageset_id , "imageframe_id" : imageframe_id }, priority, wait=True)
+        return future.result(timeout)
+
+    def promoteImageSet(self, datastore_id : str, imageset_id : str, priority : int = VIEWING):
+        """Moves the frames of an image set still waiting in the queue to the given priority. Cheap to call on every frame request."""
+        with self.lock:
+            imageset = self.imagesets.get(datastore_id+"/"+imageset_id)
+            if imageset is None or imageset["priority"] <= priority:
+                return
+            imageset["priority"] = priority
+            for key in imageset["keys"]:
+                entry = self.pending[key]
+                if priority < entry["priority"]:
+                    self._promote(key, entry, priority)
+        self.logger.debug(f"[{self.frameFetcherName}] - {datastore_id}/{imageset_id} promoted to {frameFetcher.PRIORITY_NAMES[priority]}.")
+
+    def _promote(self, key : str, entry : dict, priority : int):
+        # Must be called with the lock held and for a pending entry.
+        self.depth[entry["priority"]] -= 1
+        self.depth[priority] += 1
+        entry["priority"] = priority
+        self.fetchQueue.put((priority, next(self.sequence), key))
+        proxyMetrics.inc("prefetch_promotions_total", priority=frameFetcher.PRIORITY_NAMES[priority])
+
+    def worker(self):
+        while self.status == 1:
+            priority, sequence, key = self.fetchQueue.get() # blocks until there is something to fetch, no polling.
+            if key is None:
+                break
+            with self.lock:
+                entry = self.pending.get(key)
+                if entry is None or entry["priority"] != priority:
+                    continue # stale copy of a promoted frame.
+                del self.pending[key]
+                self.inflight[key] = entry
+                self.depth[priority] -= 1
+                imageset_key = key[:key.rindex("/")]
+                imageset = self.imagesets[imageset_key]
+                imageset["keys"].discard(key)
+                if len(imageset["keys"]) == 0:
+                    del self.imagesets[imageset_key]
+            priority_name = frameFetcher.PRIORITY_NAMES[priority]
+            proxyMetrics.observe("prefetch_queue_wait_seconds", time.monotonic() - entry["queued"], priority=priority_name)
+            frame = None
+            outcome = "error"
+            try:
+                frame, outcome = self.fetchAndStore(entry["object"], entry["future"] is not None)
+            except Exception as err:
+                self.logger.error(f"[{self.frameFetcherName}] - {key} could not be fetched : {err}")
+            finally:
+                with self.lock:
+                    del self.inflight[key]
+                    future = entry["future"]
+                if future is not None:
+                    if frame is None and outcome == "cached":
+                        frame = self.readFrame(entry["object"]) # a client started waiting while the cached file was being checked.
+                    future.set_result(frame)
+            proxyMetrics.inc("prefetch_frames_total", priority=priority_name, outcome=outcome)
+
+    def fetchAndStore(self, cache_object : dict, return_frame : bool):
+        """Copies a frame from AHI to the cache tiers of the cache policy unless it is already there.
+        Returns (raw frame bytes or None, outcome)."""
         datastore_id = cache_object["datastore_id"]
         imageset_id = cache_object["imageset_id"]
         imageframe_id = cache_object["imageframe_id"]
-        self.logger.debug(f"[{self.frameFetcherName}] - {datastore_id+imageset_id+imageframe_id } Evaluating cache need.")
-        if not datastore_id+"/"+imageset_id+"/"+imageframe_id in frameFetcher.cached_items: #let's not add it if this is already there...
-            frameFetcher.cached_items.add(datastore_id+"/"+imageset_id+"/"+imageframe_id ) #At this point this is not  hard disk cached yet... This merely prevent an exisiting item to re-enter the processing queue 
-            self.cacheQueue.put(cache_object)
-            self.logger.debug(f"[{self.frameFetcherName}] - {datastore_id+imageset_id+imageframe_id } Added to fetch queue.")
-
-    def ProcessRunner(self , cacheQueue : Queue , fetchAndStore , getFramePixels , cache_root): 
-        client_config = botocore.config.Config(max_pool_connections=100,)
-        ahi_client = boto3.client('medical-imaging', config=client_config)
-        with concurrent.futures.ThreadPoolExecutor(max_workers=100) as executor:
-            while(self.status == 1):
-                if not cacheQueue.empty():
-                    futures = []
-                    while not cacheQueue.empty():
-                        cache_it = cacheQueue.get(block=True)
-                        datastore_id = cache_it["datastore_id"]
-                        imageset_id = cache_it["imageset_id"]
-                        imageframe_id = cache_it["imageframe_id"]
-                        futures.append(executor.submit(fetchAndStore, getFramePixels, datastore_id, imageset_id, imageframe_id , ahi_client , cache_root))
-                else:
-                    time.sleep(0.01)
-    
-    @staticmethod
-    def fetchAndStore(getFramePixels, datastore_id, imageset_id, imageframe_id , ahi_client, cache_root):
-        frame_file_path =f"{cache_root}/{datastore_id}/{imageset_id}/{imageframe_id}.cache"
-        if not os.path.isfile(frame_file_path):
-            frame = getFramePixels(datastore_id, imageset_id, imageframe_id , ahi_client)
-            os.makedirs(f"{cache_root}/{datastore_id}/{imageset_id}",exist_ok=True)
-            frame_file = open(frame_file_path,'wb')
-            frame_file.write(frame)
-            frame_file.close()
+        if return_frame:
+            frame = self.readFrame(cache_object)
+            if frame is not None:
+                return frame, "cached"
+        elif self.store_raw:
+            if self.frame_cache.adopt(datastore_id, imageset_id, imageframe_id): # on disk but maybe not indexed yet.
+                return None, "cached"
+        else:
+            pixels_file_path = self.pixel_cache.framePath(datastore_id, imageset_id, imageframe_id)
+            if os.path.isfile(pixels_file_path):
+                self.frame_cache.cache_index.add(cacheIndex.frameKey(datastore_id, imageset_id, imageframe_id), os.path.getsize(pixels_file_path), self.store_tier) # on disk but not indexed yet.
+                return None, "cached"
+        res = self.ahi_client.get_image_frame(
+            datastoreId=datastore_id,
+            imageSetId=imageset_id,
+            imageFrameInformation= {'imageFrameId' :imageframe_id})
+        frame = res['imageFrameBlob'].read()
+        self.storeFrame(cache_object, frame, decode=not return_frame) # prefetched frames are decoded ahead of their first read, a waiting client decodes the frame itself.
+        proxyMetrics.inc("prefetch_bytes_total", len(frame))
+        return frame, "fetched"
+
+    def storeFrame(self, cache_object : dict, frame : bytes, decode : bool = True):
+        """Writes a frame fetched from AHI to the cache tiers of the cache policy. The decoded tier is only filled when decode is set."""
+        datastore_id = cache_object["datastore_id"]
+        imageset_id = cache_object["imageset_id"]
+        imageframe_id = cache_object["imageframe_id"]
+        if self.store_raw:
+            self.frame_cache.write(datastore_id, imageset_id, imageframe_id, frame)
+        if self.pixel_cache is not None and decode:
+            pixels = self.decode_frame(frame)
+            if pixels is not None:
+                self.pixel_cache.put(datastore_id, imageset_id, imageframe_id, pixels)
+
+    def readFrame(self, cache_object : dict) -> bytes:
+        # The miss was already counted by the request that queued the frame.
+        return self.frame_cache.read(cache_object['datastore_id'], cache_object['imageset_id'], cache_object['imageframe_id'], count_miss=False)
+
+    def collectMetrics(self) -> list:
+        with self.lock:
+            depth = list(self.depth)
+            inflight = len(self.inflight)
+        samples = [ ("prefetch_queue_depth", "gauge", { "priority" : name }, depth[priority]) for priority, name in enumerate(frameFetcher.PRIORITY_NAMES) ]
+        samples.append(("prefetch_inflight", "gauge", {}, inflight))
+        return samples
+
+    def stop(self):
+        self.status = 0
+        for worker in self.workers:
+            self.fetchQueue.put((-1, next(self.sequence), None))
 
     @staticmethod
     def getFramesToCache(metadata : object):
@@ -98,5 +248,5 @@ class frameFetcher:
         for instance in instances:
             for frame in metadata["Study"]["Series"][series_uid]["Instances"][instance]["ImageFrames"]:
                 frame_id = frame["ID"]
-                return_set.append({ "status" : 0 , "datastore_id" : datastore_id , "imageset_id" : imageset_id , "imageframe_id" : frame_id})    
+                return_set.append({ "status" : 0 , "datastore_id" : datastore_id , "imageset_id" : imageset_id , "imageframe_id" : frame_id})
         return return_set
@@ -0,0 +1,103 @@
+"""
+frameIndex Module : SOPInstanceUID -> AHI frame locations index, persisted in SQLite with a bounded LRU in front.
+
+The frames route resolves the frames of an instance from this index without querying MySQL nor loading the image set
+metadata. It is filled as soon as an image set metadata is loaded and kept on disk, so that it survives restarts. Each
+instance is a single entry holding the identifiers of all its frames, frame N being the Nth identifier. Only the
+recently used instances are kept in memory, the others are read from SQLite when requested : the index can cover more
+instances than the process could hold. Every thread gets its own SQLite connection, as for the cacheIndex.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import sys
+import sqlite3
+import threading
+import time
+import logging
+from lruCache import lruCache
+
+
+class frameIndex:
+
+    INDEX_FILE = ".frameindex.sqlite"
+    QUERY_BATCH = 500 # instances looked up per query, below the SQLite host parameters limit.
+
+    def __init__(self, index_path : str = None, max_entries : int = 100000):
+        """The index is kept in the LRU only when index_path is None, the instances it evicts are then forgotten."""
+        self.logger = logging.getLogger(__name__)
+        self.index_path = index_path
+        self.instances = lruCache(name="frameIndex", max_entries=max_entries)  # SOPInstanceUID -> (datastore_id, imageset_id, (frame ids)).
+        self.local = threading.local()
+        self.count_lock = threading.Lock()
+        self.indexed = 0 # instances in SQLite, counted at startup and kept up to date by addMetadata.
+        if index_path is not None:
+            start = time.time()
+            connection = self._connection()
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS instances (instance TEXT PRIMARY KEY, datastore_id TEXT NOT NULL, imageset_id TEXT NOT NULL, frame_ids TEXT NOT NULL) WITHOUT ROWID")
+            connection.commit()
+            self.indexed = connection.execute("SELECT COUNT(*) FROM instances").fetchone()[0]
+            self.logger.info(f"[{__name__}] - frame index opened in {time.time()-start:.1f}s : {self.indexed} instances.")
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.index_path, timeout=30, check_same_thread=False)
+            connection.execute("PRAGMA synchronous=NORMAL") # a lost write is recovered the next time the metadata is loaded.
+            self.local.connection = connection
+        return connection
+
+    def addMetadata(self, metadata : dict):
+        """Indexes the frames of every instance of an image set metadata. Only the instances that changed are written to disk."""
+        datastore_id = sys.intern(metadata["DatastoreID"])
+        imageset_id = metadata["ImageSetID"]
+        entries = {}
+        for series in metadata["Study"]["Series"].values():
+            for instance_uid , instance in series["Instances"].items():
+                entries[instance_uid] = (datastore_id, imageset_id, tuple(frame["ID"] for frame in instance["ImageFrames"]))
+        for instance_uid , entry in entries.items(): # the frames of these instances are likely to be requested next.
+            self.instances.put(instance_uid, entry)
+        if self.index_path is None or len(entries) == 0:
+            return
+        stored = self._read(list(entries))
+        rows = [ (instance_uid, datastore_id, imageset_id, ",".join(entry[2])) for instance_uid , entry in entries.items() if stored.get(instance_uid) != entry ]
+        if len(rows) == 0:
+            return
+        connection = self._connection()
+        with connection:
+            connection.executemany("INSERT OR REPLACE INTO instances VALUES (?, ?, ?, ?)", rows)
+        with self.count_lock:
+            self.indexed += sum(1 for row in rows if row[0] not in stored)
+
+    def _read(self, instance_uids : list) -> dict:
+        """Returns the entries stored in SQLite for the given instances, the ones not indexed being left out."""
+        connection = self._connection()
+        entries = {}
+        for offset in range(0, len(instance_uids), frameIndex.QUERY_BATCH):
+            batch = instance_uids[offset:offset+frameIndex.QUERY_BATCH]
+            query = f"SELECT instance, datastore_id, imageset_id, frame_ids FROM instances WHERE instance IN ({','.join('?' * len(batch))})" #nosec - placeholders only.
+            for instance , datastore_id , imageset_id , frame_ids in connection.execute(query, batch):
+                entries[instance] = (sys.intern(datastore_id), imageset_id, tuple(frame_ids.split(",")))
+        return entries
+
+    def locateFrames(self, instance_uid : str, frame_list : list):
+        """Returns the (datastore_id, imageset_id, imageframe_id) of each frame number, None if the instance or one of the frames is not indexed."""
+        entry = self.instances.get(instance_uid)
+        if entry is None and self.index_path is not None:
+            entry = self._read([instance_uid]).get(instance_uid)
+            if entry is not None:
+                self.instances.put(instance_uid, entry)
+        if entry is None:
+            return None
+        datastore_id , imageset_id , frame_ids = entry
+        if any(frame_number < 1 or frame_number > len(frame_ids) for frame_number in frame_list):
+            return None
+        return [ (datastore_id, imageset_id, frame_ids[frame_number-1]) for frame_number in frame_list ]
+
+    def count(self) -> int:
+        if self.index_path is None:
+            return self.instances.stats()["entries"]
+        return self.indexed
+
+    def stats(self) -> dict:
+        return self.instances.stats()
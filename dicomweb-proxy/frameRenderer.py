@@ -0,0 +1,177 @@
+"""
+frameRenderer Module : Rendering of the decoded frames to JPEG for the WADO-RS rendered resources.
+
+Frames are rendered straight from their decoded little endian buffer, without DICOMizing the instance : the stored
+values go through a lookup table combining the modality rescale (Rescale Slope / Intercept) and the linear VOI
+window (Window Center / Width, or the frame min / max when the instance has none), which maps every possible stored
+value to its 8 bits display value. The table is built once per window and applied to the whole frame with a single
+vectorized take. The 8 bits image is then downsampled to the requested viewport and JPEG encoded.
+
+Series and study thumbnails are rendered from a representative slice, the middle instance (by InstanceNumber) of the
+series, and for a study the series holding the most frames. Rendered images are kept in a bounded LRU keyed by the
+frame and everything that changes its rendering.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import io
+import logging
+import numpy
+from PIL import Image
+from lruCache import lruCache
+
+
+class frameRenderer:
+    logger = logging.getLogger(__name__)
+    luts = lruCache(name="frameRendererLUTs", max_entries=64)
+
+    DEFAULT_QUALITY = 75 # PIL default, what the rendered instances were encoded with so far.
+    THUMBNAIL_VIEWPORT = (256, 256) # Viewport of the series and study thumbnails when none is requested.
+    MAX_VIEWPORT = 4096
+
+    def __init__(self, cache_max_bytes : int = 0):
+        self.cache = None
+        if cache_max_bytes:
+            self.cache = lruCache(name="renderedCache", max_bytes=cache_max_bytes)
+
+    @staticmethod
+    def parseParameters(args) -> tuple:
+        """Returns the (viewport, quality) of the rendered request query parameters, viewport being None when not requested.
+        Raises ValueError if they are malformed."""
+        viewport = args.get("viewport")
+        if viewport is not None:
+            viewport = tuple(int(size) for size in viewport.split(","))
+            if len(viewport) != 2 or not all(0 < size <= frameRenderer.MAX_VIEWPORT for size in viewport):
+                raise ValueError(f"viewport must be vw,vh with sizes between 1 and {frameRenderer.MAX_VIEWPORT}")
+        quality = args.get("quality")
+        if quality is None:
+            quality = frameRenderer.DEFAULT_QUALITY
+        else:
+            quality = int(quality)
+            if not 1 <= quality <= 100:
+                raise ValueError("quality must be between 1 and 100")
+        return viewport , quality
+
+    @staticmethod
+    def imageAttributes(metadata : dict, series_uid : str, instance_uid : str) -> dict:
+        """Returns the attributes of the instance needed to render its frames, instance level values overriding the series level ones."""
+        series = metadata["Study"]["Series"][series_uid]
+        attributes = dict(series.get("DICOM", {}))
+        attributes.update(series["Instances"][instance_uid].get("DICOM", {}))
+        return attributes
+
+    @staticmethod
+    def representativeFrame(metadata : dict, series_uid : str) -> tuple:
+        """Returns the (instance uid, frame number) of the middle slice of a series, None if the series has no image."""
+        instances = [ (frameRenderer.number(instance.get("DICOM", {}).get("InstanceNumber")), instance_uid , len(instance["ImageFrames"]))
+                      for instance_uid , instance in metadata["Study"]["Series"][series_uid]["Instances"].items() if len(instance.get("ImageFrames", [])) > 0 ]
+        if len(instances) == 0:
+            return None
+        instances.sort()
+        if len(instances) == 1: # single multi-frame instance, eg. enhanced CT or MR : its middle frame.
+            return instances[0][1] , instances[0][2] // 2 + 1
+        return instances[len(instances) // 2][1] , 1
+
+    @staticmethod
+    def frameCount(metadata : dict, series_uid : str) -> int:
+        return sum(len(instance.get("ImageFrames", [])) for instance in metadata["Study"]["Series"][series_uid]["Instances"].values())
+
+    @staticmethod
+    def number(value, default : float = 0) -> float:
+        """First value of a numeric attribute as found in the AHI metadata : a number, a list, or a backslash separated string."""
+        if isinstance(value, (list, tuple)):
+            value = value[0] if len(value) > 0 else None
+        if isinstance(value, str):
+            value = value.split("\\")[0].strip()
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return default
+
+    @staticmethod
+    def renderingKey(attributes : dict, viewport : tuple, quality : int) -> tuple:
+        """Everything besides the frame itself that changes its rendering."""
+        return ( attributes.get("Rows") , attributes.get("Columns") , attributes.get("BitsAllocated") , attributes.get("PixelRepresentation") ,
+                 attributes.get("SamplesPerPixel") , attributes.get("PhotometricInterpretation") , str(attributes.get("WindowCenter")) ,
+                 str(attributes.get("WindowWidth")) , attributes.get("RescaleSlope") , attributes.get("RescaleIntercept") , viewport , quality )
+
+    def get(self, key : tuple) -> bytes:
+        if self.cache is None:
+            return None
+        return self.cache.get(key)
+
+    def put(self, key : tuple, rendered : bytes):
+        if self.cache is not None:
+            self.cache.put(key, rendered, len(rendered))
+
+    def stats(self) -> dict:
+        if self.cache is None:
+            return {}
+        return self.cache.stats()
+
+    @staticmethod
+    def render(pixels : bytes, attributes : dict, viewport : tuple = None, quality : int = DEFAULT_QUALITY) -> bytes:
+        """Returns the JPEG rendering of a decoded frame, downsampled to fit the viewport."""
+        image = frameRenderer.toImage(pixels, attributes)
+        if viewport is not None:
+            scale = min(viewport[0] / image.width, viewport[1] / image.height)
+            size = ( max(1, round(image.width * scale)) , max(1, round(image.height * scale)) )
+            if size != image.size:
+                image = image.resize(size, Image.Resampling.BILINEAR, reducing_gap=2.0) # box reduction first, then bilinear on the reduced image.
+        output = io.BytesIO()
+        image.save(output, "JPEG", quality=quality)
+        return output.getvalue()
+
+    @staticmethod
+    def toImage(pixels : bytes, attributes : dict) -> Image.Image:
+        rows = int(attributes["Rows"])
+        columns = int(attributes["Columns"])
+        samples = int(frameRenderer.number(attributes.get("SamplesPerPixel"), 1))
+        bits = 8 if int(frameRenderer.number(attributes.get("BitsAllocated"), 16)) <= 8 else 16
+        signed = int(frameRenderer.number(attributes.get("PixelRepresentation"), 0)) == 1
+        if len(pixels) != rows * columns * samples * bits // 8:
+            # not a decoded buffer, eg. a frame AHI did not store as HTJ2K and that getFramePixels passed through PIL.
+            with Image.open(io.BytesIO(pixels)) as encoded:
+                return encoded.convert("RGB" if samples == 3 else "L")
+        if samples == 3:
+            if bits != 8:
+                raise ValueError(f"{bits} bits color frames are not supported")
+            return Image.fromarray(numpy.frombuffer(pixels, dtype=numpy.uint8).reshape(rows, columns, 3), "RGB")
+        stored = numpy.frombuffer(pixels, dtype=numpy.uint8 if bits == 8 else numpy.uint16).reshape(rows, columns) # signed values are looked up by their bit pattern.
+        slope = frameRenderer.number(attributes.get("RescaleSlope"), 1) or 1
+        intercept = frameRenderer.number(attributes.get("RescaleIntercept"), 0)
+        center = frameRenderer.number(attributes.get("WindowCenter"), None)
+        width = frameRenderer.number(attributes.get("WindowWidth"), None)
+        if center is None or width is None or width < 1:
+            center , width = frameRenderer.minMaxWindow(stored, bits, signed, slope, intercept)
+        lut = frameRenderer.voiLut(bits, signed, slope, intercept, center, width, attributes.get("PhotometricInterpretation") == "MONOCHROME1")
+        return Image.fromarray(numpy.take(lut, stored), "L")
+
+    @staticmethod
+    def minMaxWindow(stored : numpy.ndarray, bits : int, signed : bool, slope : float, intercept : float) -> tuple:
+        """Window spanning the rescaled values of the frame."""
+        if signed:
+            stored = stored.view(numpy.int8 if bits == 8 else numpy.int16)
+        low , high = sorted((float(stored.min()) * slope + intercept, float(stored.max()) * slope + intercept))
+        return (low + high) / 2 + 0.5 , high - low + 1
+
+    @staticmethod
+    def voiLut(bits : int, signed : bool, slope : float, intercept : float, center : float, width : float, invert : bool) -> numpy.ndarray:
+        """Returns the table mapping every stored value (by its unsigned bit pattern) to its display value, with the linear
+        VOI function of PS3.3 C.11.2.1.2 applied to the rescaled value."""
+        key = (bits, signed, slope, intercept, center, width, invert)
+        lut = frameRenderer.luts.get(key)
+        if lut is not None:
+            return lut
+        values = numpy.arange(1 << bits, dtype=numpy.uint32).astype(numpy.uint8 if bits == 8 else numpy.uint16)
+        if signed:
+            values = values.view(numpy.int8 if bits == 8 else numpy.int16)
+        values = values * slope + intercept
+        if width <= 1:
+            lut = numpy.where(values <= center - 0.5, 0.0, 255.0)
+        else:
+            lut = numpy.clip(((values - (center - 0.5)) / (width - 1) + 0.5) * 255.0, 0.0, 255.0)
+        lut = numpy.rint(lut).astype(numpy.uint8)
+        if invert:
+            lut = 255 - lut
+        frameRenderer.luts.put(key, lut)
+        return lut
@@ -7,5 +7,6 @@ HTTP_CODES = {
     404 : "Not Found",
     406 : "Not Acceptable",
     410 : "Gone wrong",
+    500 : "Internal Server Error",
     503 : "Service Unavailable"
 }
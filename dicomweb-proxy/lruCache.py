@@ -0,0 +1,135 @@
+"""
+lruCache Module : Thread safe LRU cache bounded by entry count, approximate byte size and entry age.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+from collections import OrderedDict
+import threading
+import time
+import logging
+
+
+class lruCache:
+
+    def __init__(self, name : str = "cache", max_entries : int = None, max_bytes : int = None, ttl : float = None, on_evict = None) -> None:
+        self.logger = logging.getLogger(__name__)
+        self.name = name
+        self.max_entries = max_entries  # None or 0 means no limit on the number of entries.
+        self.max_bytes = max_bytes      # None or 0 means no limit on the cumulated size of the entries.
+        self.ttl = ttl                  # Entry age in seconds after which an entry is considered stale. None or 0 means entries never expire.
+        self.on_evict = on_evict        # Optional callback(key, value) called whenever an entry leaves the cache.
+        self.entries = OrderedDict()    # key -> [value, size, insertion time] , ordered from least to most recently used.
+        self.lock = threading.Lock()
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key, default = None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            if self.ttl and (time.monotonic() - entry[2]) > self.ttl:
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                evicted = [(key, entry[0])]
+            else:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+        self._notify(evicted)
+        return default
+
+    def peek(self, key, default = None):
+        """Returns the value without refreshing its recency nor counting a hit or a miss."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return default
+            return entry[0]
+
+    def put(self, key, value, size : int = 0):
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = [value, size, time.monotonic()]
+            self.current_bytes += size
+            evicted = self._enforceBudget()
+        self._notify(evicted)
+
+    def addSize(self, key, size : int):
+        """Accounts for extra bytes attached to an existing entry, eg. derived representations of the cached value."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return
+            entry[1] += size
+            self.current_bytes += size
+            evicted = self._enforceBudget()
+        self._notify(evicted)
+
+    def pop(self, key, default = None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return default
+            self._remove(key)
+        self._notify([(key, entry[0])])
+        return entry[0]
+
+    def clear(self):
+        with self.lock:
+            evicted = [(key, entry[0]) for key, entry in self.entries.items()]
+            self.entries.clear()
+            self.current_bytes = 0
+        self._notify(evicted)
+
+    def __contains__(self, key) -> bool:
+        with self.lock:
+            return key in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {
+                "entries" : len(self.entries),
+                "bytes" : self.current_bytes,
+                "max_entries" : self.max_entries,
+                "max_bytes" : self.max_bytes,
+                "hits" : self.hits,
+                "misses" : self.misses,
+                "evictions" : self.evictions,
+                "expirations" : self.expirations
+            }
+
+    def _remove(self, key):
+        entry = self.entries.pop(key)
+        self.current_bytes -= entry[1]
+
+    def _enforceBudget(self) -> list:
+        # Must be called with the lock held. The most recently inserted entry is never evicted by its own insertion,
+        # so a single entry larger than the byte budget is still served until something else is inserted.
+        evicted = []
+        while len(self.entries) > 1 and ((self.max_entries and len(self.entries) > self.max_entries) or (self.max_bytes and self.current_bytes > self.max_bytes)):
+            key, entry = self.entries.popitem(last=False)
+            self.current_bytes -= entry[1]
+            self.evictions += 1
+            evicted.append((key, entry[0]))
+        if len(evicted) > 0:
+            self.logger.debug(f"[{self.name}] - evicted {len(evicted)} entries, {len(self.entries)} entries / {self.current_bytes} bytes remaining.")
+        return evicted
+
+    def _notify(self, evicted : list):
+        if self.on_evict is None:
+            return
+        for key, value in evicted:
+            try:
+                self.on_evict(key, value)
+            except Exception as err:
+                self.logger.warning(f"[{self.name}] - eviction callback failed for {key} : {err}")
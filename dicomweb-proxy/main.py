@@ -17,11 +17,14 @@ import logging
 import mysqlConnectionFactory
 import datetime
 import os
+import sys
 import sql_queries
 from db_mappings import *
+from http_response_code import HTTP_CODES
 from qido_search_tags import *
 from uuid import uuid4
 import gzip
+import base64
 from openjpeg import decode
 import io
 from InstanceDICOMizer import InstanceDICOMizer
@@ -34,11 +37,46 @@ from metadataCache import metadataCache
 from werkzeug.serving import WSGIRequestHandler
 from frameFetcher import frameFetcher
 from cacheCleaner import cacheCleaner
-import multiprocessing
+from cacheIndex import cacheIndex
+from frameIndex import frameIndex
+from frameCache import frameCache
+from pixelCache import pixelCache
+from decodePool import decodePool
+from responseCompression import responseCompression
+from qidoCache import qidoCache
+from qidoSerializer import qidoSerializer
+from frameRenderer import frameRenderer
+from proxyMetrics import proxyMetrics
+import resource
+import threading
+import time
 
 app = Flask(__name__)
-cors = CORS(app)
+cors = CORS(app, expose_headers=["X-Next-Page-Token"])
 sql_pool = None
+wado_stream_window = 16 # Maximum number of instances being DICOMized at once for a single WADO-RS retrieve response.
+wado_concurrency = threading.BoundedSemaphore(64) # Maximum number of instances being DICOMized at once across all the WADO-RS retrieve responses.
+HTJ2K_TRANSFER_SYNTAXES = (uid.HTJ2KLossless, uid.HTJ2KLosslessRPCL, uid.HTJ2K)
+J2K_CODESTREAM_MAGIC = b"\xff\x4f\xff\x51" # SOC marker followed by the SIZ marker.
+framefetcher = None # Prefetch engine shared by all the requests, frames are fetched directly from AHI when it is not started.
+framecache = None # Disk cache of the raw frames, shared by getFrame, the prefetcher and the cache cleaner.
+pixelcache = None # Decoded pixels cache tier, only used when CACHE_POLICY is decoded or both.
+decodepool = None # HTJ2K decode processes, frames are decoded in the request threads when it is not started.
+qidocache = None # QIDO-RS responses cache, disabled when QIDO_CACHE_TTL is 0.
+framerenderer = frameRenderer() # Rendered resources, its cache of rendered images is sized at startup by RENDERED_CACHE_MB.
+qido_fetch_batch = 500 # Rows fetched from MySQL and serialized at once when a QIDO-RS result is streamed.
+QIDO_KEYSET_TABLES = { "STUDY" : "study_table" , "STUDY.SERIES" : "series_table" , "SERIES" : "series_table" , "STUDY.INSTANCE" : "instance_table" , "STUDY.SERIES.INSTANCE" : "instance_table" , "INSTANCE" : "instance_table" } # table whose unique key pages the results of each level.
+@app.before_request
+def bindMetricsRoute():
+    proxyMetrics.setRoute(request.endpoint or "unknown") # the stages timed while serving the request are labelled with the view name.
+
+class QueryParameterError(ValueError):
+    """A query parameter the request cannot be served with, answered 400 rather than ignored."""
+
+@app.errorhandler(QueryParameterError)
+def handleQueryParameterError(err):
+    return Response(status = 400 , response=f"{HTTP_CODES[400]} : {err}")
+
 @app.before_request
 def handle_preflight():
     if request.method == "OPTIONS":
@@ -56,60 +94,37 @@ def healthcheck():
     http_response = Response(status = httpstatus , response=orjson.dumps("OK"), mimetype=mimetype , content_type=contentType )
     return http_response   
 
+### Metrics endpoint ###
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    return Response(status = 200 , response=proxyMetrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
 ### QIDO ENDPOINTS ###
 @app.route("/aetitle/studies", methods=["GET" , "OPTIONS"])
 def SearchForStudies():
     parameters = _processParameters(level="STUDY")
-    query , query_parameters = _constructQuery(parameters)
-    field_names, db_results = _executeQuery(query , query_parameters)
-    resp = _convertToJSON(field_names , db_results , parameters)
-    httpstatus = 200
-    mimetype = "text/json"
-    contentType = "application/dicom+json"
-    http_response = Response(status = httpstatus , response=orjson.dumps(resp), mimetype=mimetype , content_type=contentType )
-    return http_response
+    return _qidoResponse(parameters)
 
 #resource Study's Series
 @app.route("/aetitle/studies/<studyInstanceUID>/series", methods=["GET" , "OPTIONS"])
 def SearchForStudySeries(studyInstanceUID : str):
     parameters = _processParameters(level="STUDY.SERIES")
     parameters["StudyInstanceUID"] = studyInstanceUID
-    query , query_parameters = _constructQuery(parameters)
-    field_names, db_results = _executeQuery(query , query_parameters)
-    resp = _convertToJSON(field_names , db_results , parameters)
-    httpstatus = 200
-    mimetype = "text/json"
-    contentType = "application/dicom+json"
-    http_response = Response(status = httpstatus , response=orjson.dumps(resp), mimetype=mimetype , content_type=contentType )
-    return http_response
+    return _qidoResponse(parameters)
 
 #Study's Instances
 @app.route("/aetitle/studies/<studyInstanceUID>/instances", methods=["GET" , "OPTIONS"])
 def SearchForStudyInstances(studyInstanceUID: str):
     parameters = _processParameters(level="STUDY.INSTANCE")
     parameters["StudyInstanceUID"] = studyInstanceUID
-    query , query_parameters = _constructQuery(parameters)
-    field_names, db_results = _executeQuery(query , query_parameters)
-    resp = _convertToJSON(field_names , db_results , parameters)
-    httpstatus = 200
-    mimetype = "text/json"
-    contentType = "application/dicom+json"
-    http_response = Response(status = httpstatus , response=orjson.dumps(resp), mimetype=mimetype , content_type=contentType )
-    return http_response
+    return _qidoResponse(parameters)
 
 #All Series
 @app.route("/aetitle/series", methods=["GET" , "OPTIONS"])
 def SearchForSeries():
     parameters = _processParameters(level="SERIES")
     logging.debug(parameters)
-    query , query_parameters = _constructQuery(parameters)
-    field_names, db_results = _executeQuery(query , query_parameters)
-    resp = _convertToJSON(field_names , db_results , parameters)
-    httpstatus = 200
-    mimetype = "text/json"
-    contentType = "application/dicom+json"
-    http_response = Response(status = httpstatus , response=orjson.dumps(resp), mimetype=mimetype , content_type=contentType )
-    return http_response
+    return _qidoResponse(parameters)
 
 #Study's Series' Instances
 @app.route("/aetitle/studies/<studyInstanceUID>/series/<seriesInstanceUID>/instances", methods=["GET" , "OPTIONS"])
@@ -117,68 +132,67 @@ def SearchForStudySeriesInstances(studyInstanceUID: str, seriesInstanceUID: str)
     parameters = _processParameters(level="STUDY.SERIES.INSTANCE")
     parameters["StudyInstanceUID"] = studyInstanceUID
     parameters["SeriesInstanceUID"] = seriesInstanceUID
-    query , query_parameters = _constructQuery(parameters)
-    field_names, db_results = _executeQuery(query , query_parameters)
-    logging.debug(field_names)
-    resp = _convertToJSON(field_names , db_results , parameters)
-    httpstatus = 200
-    mimetype = "text/json"
-    contentType = "application/dicom+json"
-    http_response = Response(status = httpstatus , response=orjson.dumps(resp), mimetype=mimetype , content_type=contentType )
-    return http_response
+    return _qidoResponse(parameters)
 
 #All Instances
 @app.route("/aetitle/instances", methods=["GET" , "OPTIONS"])
 def SearchForInstances():
     parameters = _processParameters(level="INSTANCE")
-    query , query_parameters = _constructQuery(parameters)
-    field_names, db_results = _executeQuery(query , query_parameters)
-    resp = _convertToJSON(field_names , db_results , parameters)
-    httpstatus = 200
-    mimetype = "text/json"
-    contentType = "application/dicom+json"
-    http_response = Response(status = httpstatus , response=orjson.dumps(resp), mimetype=mimetype , content_type=contentType )
+    return _qidoResponse(parameters)
 
 ### WADO ENDPOINTS ###
 @app.route('/aetitle/studies/<StudyInstanceUID>', methods=['GET' , 'OPTIONS'])
 def RetrieveStudies(StudyInstanceUID : str):
     logging.debug(request)
-    parameters = _processParameters(level="STUDY")
-    parameters["StudyInstanceUID"] = StudyInstanceUID
-    parameters["wherefields"]["0020000D"] = StudyInstanceUID
-    query , query_parameters = _constructQuery(parameters)
-    field_names, db_results = _executeQuery(query , query_parameters)
-    resp = _convertToJSON(field_names , db_results , parameters)
-    httpstatus = 200
-    mimetype = "text/json"
-    contentType = "application/dicom+json"
-    http_response = Response(status = httpstatus , response=orjson.dumps(resp), mimetype=mimetype , content_type=contentType )
-    return http_response
+    accept = request.headers.get('Accept','').lower()
+    if 'application/dicom+json' in accept and 'multipart/related' not in accept: # legacy behavior, the study is described as a QIDO result.
+        parameters = _processParameters(level="STUDY")
+        parameters["StudyInstanceUID"] = StudyInstanceUID
+        parameters["wherefields"]["0020000D"] = StudyInstanceUID
+        return _qidoResponse(parameters)
+    # WADO-RS study retrieve : every instance of every image set of the study, streamed as multipart/related.
+    fields , results = _executeQuery(sql_queries.WADO_STUDIES_METADATA , (StudyInstanceUID,) )
+    meta_fetch = [ (res[0], res[1]) for res in results ]
+    if len(meta_fetch) == 0:
+        return Response(status = 404 , response=HTTP_CODES[404])
+    with concurrent.futures.ThreadPoolExecutor(min(len(meta_fetch), 32)) as executor:
+        ahi_metadatas = list(executor.map(proxyMetrics.bind(metadatacache.getMetadataViaTuple), meta_fetch))
+    retrieve_tasks = []
+    instance_uids = set()
+    for metadata in ahi_metadatas:
+        if metadata is None:
+            continue
+        assignToCache(metadata=metadata)
+        series_uid = next(iter(metadata["Study"]["Series"].keys()))
+        for instance_uid in metadata["Study"]["Series"][series_uid]["Instances"].keys():
+            if not instance_uid in instance_uids:
+                instance_uids.add(instance_uid)
+                retrieve_tasks.append((DICOMizeInstance, (metadata, instance_uid)))
+    resp_boundary = multipart_boundary()
+    return _streamInstances(retrieve_tasks, resp_boundary, route="study") , { "Content-Type" : "multipart/related; type=\"application/dicom\"; boundary="+resp_boundary }
     
 
 
 @app.route('/aetitle/studies/<StudyInstanceUID>/metadata', methods=['GET' , 'OPTIONS'])
 def RetrieveStudiesMetadata(StudyInstanceUID : str):
-    metadata=RetrieveMetadata(sql_queries.WADO_STUDIES_METADATA , StudyInstanceUID)
-    if len(metadata) > 0:
-        http_code = 200
-    else:
-        http_code = 400
-    mimetype = "text/json"
-    contentType = "application/dicom+json"
-    if 'gzip' in request.headers.get('Accept-Encoding','').lower():
-        logging.debug("response will be gzipped")
-        content = gzip.compress(orjson.dumps(metadata),5)
-        http_response = Response(status = http_code , response=content, mimetype=mimetype , content_type=contentType )
-        http_response.headers['Content-length'] = len(content)
-        http_response.headers['Content-Encoding'] = 'gzip'
-    else:
-        http_response = Response(status = http_code , response=orjson.dumps(metadata), mimetype=mimetype , content_type=contentType )
-    return http_response
+    return _metadataResponse(sql_queries.WADO_STUDIES_METADATA , StudyInstanceUID)
 
 @app.route('/aetitle/studies/<StudyInstanceUID>/rendered', methods=['GET' , 'OPTIONS'])
 def RetrieveStudiesRendered(StudyInstanceUID : str):
-    pass
+    # thumbnail of the study : middle slice of the series holding the most frames.
+    fields , results = _executeQuery(sql_queries.WADO_STUDIES_METADATA , (StudyInstanceUID,) )
+    representative = None
+    for res in results:
+        metadata = metadatacache.getMetadata(datastore_id=res[0] , imageset_id=res[1])
+        if metadata is None:
+            continue
+        for series_uid in metadata["Study"]["Series"].keys():
+            frame_count = frameRenderer.frameCount(metadata, series_uid)
+            if representative is None or frame_count > representative[0]:
+                representative = (frame_count, metadata, series_uid)
+    if representative is None:
+        return Response(status = 404 , response=HTTP_CODES[404])
+    return _renderedThumbnailResponse(representative[1], representative[2])
 
 @app.route('/aetitle/studies/<StudyInstanceUID>/series/<SeriesInstanceUID>', methods=['GET' , 'OPTIONS'])
 def RetrieveStudiesSeries(StudyInstanceUID : str , SeriesInstanceUID : str):
@@ -190,31 +204,21 @@ def RetrieveStudiesSeries(StudyInstanceUID : str , SeriesInstanceUID : str):
     cursor.close()
     sql_conn.close()
     resp_boundary = multipart_boundary()
-    return instancesYield(results, resp_boundary) , { "Content-Type" : "multipart/related; type=\"application/dicom\"; boundary="+resp_boundary }
+    return instancesYield(results, resp_boundary, route="series") , { "Content-Type" : "multipart/related; type=\"application/dicom\"; boundary="+resp_boundary }
 
 @app.route('/aetitle/studies/<StudyInstanceUID>/series/<SeriesInstanceUID>/rendered', methods=['GET' , 'OPTIONS'])
 def RetrieveStudiesSeriesRendered(StudyInstanceUID : str , SeriesInstanceUID : str):
-    pass
+    # thumbnail of the series : its middle slice.
+    fields , results = _executeQuery(sql_queries.WADO_SERIES_METADATA , (SeriesInstanceUID,) )
+    for res in results:
+        metadata = metadatacache.getMetadata(datastore_id=res[0] , imageset_id=res[1])
+        if metadata is not None and SeriesInstanceUID in metadata["Study"]["Series"]:
+            return _renderedThumbnailResponse(metadata, SeriesInstanceUID)
+    return Response(status = 404 , response=HTTP_CODES[404])
 
 @app.route('/aetitle/studies/<StudyInstanceUID>/series/<SeriesInstanceUID>/metadata', methods=['GET' , 'OPTIONS'])
 def RetrieveStudiesSeriesMetadata(StudyInstanceUID : str , SeriesInstanceUID : str):
-    metadata=RetrieveMetadata(sql_queries.WADO_SERIES_METADATA , SeriesInstanceUID)
-    if len(metadata) > 0:
-        http_code = 200
-    else:
-        http_code = 400
-    mimetype = "text/json"
-    contentType = "application/dicom+json"
-
-    if 'gzip' in request.headers.get('Accept-Encoding','').lower():
-        logging.debug("response will be gzipped")
-        content = gzip.compress(orjson.dumps(metadata),5)
-        http_response = Response(status = http_code , response=content, mimetype=mimetype , content_type=contentType )
-        http_response.headers['Content-length'] = len(content)
-        http_response.headers['Content-Encoding'] = 'gzip'
-    else:
-        http_response = Response(status = http_code , response=orjson.dumps(metadata), mimetype=mimetype , content_type=contentType )
-    return http_response
+    return _metadataResponse(sql_queries.WADO_SERIES_METADATA , SeriesInstanceUID)
 
 @app.route('/aetitle/studies/<StudyInstanceUID>/series/<SeriesInstanceUID>/instances/<InstanceUID>', methods=['GET' , 'OPTIONS'])
 def RetrieveStudiesSeriesInstance(StudyInstanceUID : str , SeriesInstanceUID : str , InstanceUID : str):
@@ -225,74 +229,114 @@ def RetrieveStudiesSeriesInstance(StudyInstanceUID : str , SeriesInstanceUID : s
 
 @app.route('/aetitle/studies/<StudyInstanceUID>/series/<SeriesInstanceUID>/instances/<InstanceUID>/rendered', methods=['GET' , 'OPTIONS'])
 def RetrieveStudiesSeriesInstanceRendered(StudyInstanceUID : str , SeriesInstanceUID : str , InstanceUID : str):
-    sql_conn = sql_pool.get_connection()
-    cursor = sql_conn.cursor()
-    cursor.execute(sql_queries.WADO_INSTANCE_METADATA , (InstanceUID,))
-    results = cursor.fetchall()
-    cursor.close()
-    sql_conn.close()
-
-    for res in results:
-        datastore_id = res[0]
-        imageset_id = res[1] 
-        metadata = metadatacache.getMetadata(datastore_id=datastore_id , imageset_id=imageset_id)
-        assignToCache(metadata=metadata)
-        series_uid = next(iter(metadata["Study"]["Series"].keys()))
-        if InstanceUID in metadata["Study"]["Series"][series_uid]["Instances"].keys():
-            insDICOMizer = InstanceDICOMizer(ahi_client=ahi_client)
-            insDICOMizer.getFramePixels = getFramePixels
-            ds = insDICOMizer.DICOMize(InstanceUID, metadata ,first_frame_only=True )
-
-    mimetype = "image/jpeg"
-    contentType = "image/jpeg"
-    http_code = 200
-    new_image = ds.pixel_array.astype(float)
-    scaled_image = (numpy.maximum(new_image, 0) / new_image.max()) * 255.0
-    scaled_image = numpy.uint8(scaled_image)
-    final_image = Image.fromarray(scaled_image)
-    img_byte_arr = io.BytesIO()
-    final_image.save(img_byte_arr , "JPEG")
-    http_response = Response(status = http_code , response=img_byte_arr.getvalue(), mimetype=mimetype , content_type=contentType )
-    return http_response
+    try:
+        viewport , quality = frameRenderer.parseParameters(request.args)
+    except ValueError as err:
+        return Response(status = 400 , response=f"{HTTP_CODES[400]} : {err}")
+    frame_locations = _resolveFrameLocations(sql_queries.WADO_INSTANCE_METADATA , SeriesInstanceUID , InstanceUID , [1])
+    if frame_locations is None:
+        return Response(status = 404 , response=HTTP_CODES[404])
+    datastore_id , imageset_id , imageframe_id = frame_locations[0]
+    metadata = metadatacache.getMetadata(datastore_id=datastore_id , imageset_id=imageset_id)
+    if metadata is None: # eg. AHI error, or an image set deleted since it was indexed.
+        logging.error(f"[RetrieveStudiesSeriesInstanceRendered] - metadata of {datastore_id}/{imageset_id} could not be loaded for {InstanceUID}")
+        return Response(status = 404 , response=HTTP_CODES[404])
+    for series_uid , series in metadata["Study"]["Series"].items():
+        if InstanceUID in series["Instances"]:
+            return _renderedResponse(metadata, series_uid, InstanceUID, 1, viewport, quality)
+    return Response(status = 404 , response=HTTP_CODES[404])
+
+def _renderedThumbnailResponse(metadata , series_uid : str):
+    """Renders the representative slice of a series, in a thumbnail sized viewport unless one is requested.
+    Thumbnails do not queue the image set for prefetch, a study browser would otherwise prefetch every study it lists."""
+    try:
+        viewport , quality = frameRenderer.parseParameters(request.args)
+    except ValueError as err:
+        return Response(status = 400 , response=f"{HTTP_CODES[400]} : {err}")
+    representative = frameRenderer.representativeFrame(metadata, series_uid)
+    if representative is None:
+        return Response(status = 404 , response=HTTP_CODES[404])
+    instance_uid , frame_number = representative
+    return _renderedResponse(metadata, series_uid, instance_uid, frame_number, viewport or frameRenderer.THUMBNAIL_VIEWPORT, quality)
+
+def _renderedResponse(metadata , series_uid : str , instance_uid : str , frame_number : int , viewport : tuple , quality : int):
+    """JPEG rendering of a frame, rendered from its decoded pixels and kept in the rendered images cache."""
+    datastore_id = metadata["DatastoreID"]
+    imageset_id = metadata["ImageSetID"]
+    imageframe_id = metadata["Study"]["Series"][series_uid]["Instances"][instance_uid]["ImageFrames"][frame_number-1]["ID"]
+    attributes = frameRenderer.imageAttributes(metadata, series_uid, instance_uid)
+    key = (datastore_id, imageset_id, imageframe_id) + frameRenderer.renderingKey(attributes, viewport, quality)
+    start = time.perf_counter()
+    rendered = framerenderer.get(key)
+    if rendered is not None:
+        proxyMetrics.observeStage("render", time.perf_counter() - start, "hit")
+    else:
+        pixels = getFramePixels(datastore_id, imageset_id, imageframe_id , ahi_client)
+        if pixels is None:
+            return Response(status = 404 , response=HTTP_CODES[404])
+        try:
+            with proxyMetrics.stage("render", "miss"):
+                rendered = frameRenderer.render(pixels, attributes, viewport, quality)
+        except Exception as err:
+            logging.error(f"[_renderedResponse] - {datastore_id}/{imageset_id}/{imageframe_id} could not be rendered : {err}")
+            return Response(status = 500 , response=HTTP_CODES[500])
+        framerenderer.put(key, rendered)
+    return Response(status = 200 , response=rendered, mimetype="image/jpeg" , content_type="image/jpeg" )
 
 @app.route('/aetitle/studies/<StudyInstanceUID>/series/<SeriesInstanceUID>/instances/<InstanceUID>/metadata', methods=['GET' , 'OPTIONS'])
 def RetrieveStudiesSeriesInstanceMetadata(StudyInstanceUID : str , SeriesInstanceUID : str , InstanceUID : str):
-    metadata=RetrieveMetadata(sql_queries.WADO_INSTANCE_METADATA , InstanceUID)
-    if len(metadata) > 0:
-        http_code = 200
-    else:
-        http_code = 400
-    mimetype = "text/json"
-    contentType = "application/dicom+json"
-
-    if 'gzip' in request.headers.get('Accept-Encoding','').lower():
-        logging.debug("response will be gzipped")
-        content = gzip.compress(orjson.dumps(metadata),5)
-        http_response = Response(status = http_code , response=content, mimetype=mimetype , content_type=contentType )
-        http_response.headers['Content-length'] = len(content)
-        http_response.headers['Content-Encoding'] = 'gzip'
-    else:
-        http_response = Response(status = http_code , response=orjson.dumps(metadata), mimetype=mimetype , content_type=contentType )
-    return http_response
+    return _metadataResponse(sql_queries.WADO_INSTANCE_METADATA , InstanceUID)
 
 @app.route('/aetitle/studies/<StudyInstanceUID>/series/<SeriesInstanceUID>/instances/<InstanceUID>/frames/<Frames>', methods=['GET' , 'OPTIONS'])
 def RetrieveStudiesSeriesInstanceFrame(StudyInstanceUID : str , SeriesInstanceUID : str , InstanceUID : str , Frames : str):
 
-    frame_list = []
-    frame_list = [int(i) for i in Frames.split(",")]
-    frame_list = _RetrievePixelData(sql_queries.WADO_INSTANCE_METADATA , SeriesInstanceUID , InstanceUID , frame_list)
+    try:
+        frame_list = parseFrameList(Frames)
+    except ValueError as err:
+        return Response(status = 400 , response=f"{HTTP_CODES[400]} : {err}")
+    boundary = multipart_boundary()
+    transfer_syntax = negotiateFrameTransferSyntax(request.headers.get('Accept',''))
+    frame_locations = _resolveFrameLocations(sql_queries.WADO_INSTANCE_METADATA , SeriesInstanceUID , InstanceUID , frame_list)
+    if frame_locations is None:
+        return Response(status = 404 , response=HTTP_CODES[404])
+    started = framesStart(frame_locations, transfer_syntax)
+    if started is None:
+        return Response(status = 500 , response=HTTP_CODES[500])
+    executor , futures , first_part = started
+    frames = _framesParts(executor, futures, first_part, frame_locations, boundary)
     mimetype = "multipart/related"
-    contentType = 'multipart/related; type="application/octet-stream"; boundary=KOIN'
-    if 'gzip' in request.headers.get('Accept-Encoding','').lower():    
-        logging.debug("response will be gzipped")
-        content = gzip.compress(frame_list, 5)
-        http_response = Response(status = 200 , response=content, mimetype=mimetype , content_type=contentType )
-        http_response.headers['Content-length'] = len(content)
-        http_response.headers['Content-Encoding'] = 'gzip'
+    contentType = f'multipart/related; type="{get_content_type(transfer_syntax)}"; transfer-syntax={transfer_syntax}; boundary={boundary}'
+    encoding = _framesEncoding(transfer_syntax, request.headers.get('Accept-Encoding',''), len(first_part[0]))
+    if encoding is not None:
+        logging.debug(f"response will be {encoding} encoded")
+        http_response = Response(status = 200 , response=responseCompression.compressStream(frames, encoding, "frames"), mimetype=mimetype , content_type=contentType )
+        http_response.headers['Content-Encoding'] = encoding
     else:
-        http_response = Response(status = 200 , response=frame_list, mimetype=mimetype , content_type=contentType )
+        http_response = Response(status = 200 , response=frames, mimetype=mimetype , content_type=contentType )
+    http_response.headers['Vary'] = 'Accept-Encoding'
     return http_response
 
+def parseFrameList(Frames : str) -> list:
+    """Returns the frame numbers of a frames path, raises ValueError if one of them is not a frame number (1 based)."""
+    frame_list = [int(frame_number) for frame_number in Frames.split(",")]
+    if any(frame_number < 1 for frame_number in frame_list):
+        raise ValueError("frame numbers start at 1")
+    return frame_list
+
+def _framesEncoding(transfer_syntax : str, accept_encoding : str, part_size : int) -> str:
+    """Returns the Content-Encoding of a frames response, None when the frames are sent as is.
+    part_size is the size of the first frame, the frames of an instance all having the same size."""
+    if transfer_syntax in HTJ2K_TRANSFER_SYNTAXES:
+        proxyMetrics.inc("compression_skipped_total", endpoint="frames", reason="encoded_pixels") # HTJ2K frames do not compress any further.
+        return None
+    encoding = responseCompression.negotiate(accept_encoding, "frames")
+    if encoding is None:
+        proxyMetrics.inc("compression_skipped_total", endpoint="frames", reason="not_accepted")
+    elif part_size < responseCompression.PROFILES["frames"]["min_size"]:
+        proxyMetrics.inc("compression_skipped_total", endpoint="frames", reason="too_small")
+        return None
+    return encoding
+
 @app.route('/aetitle/<BulkDataURIReference>', methods=['GET' , 'OPTIONS'])
 def RetrieveBulkDataURIReference(BulkDataURIReference : str):
     mimetype = "text/json"
@@ -301,12 +345,95 @@ def RetrieveBulkDataURIReference(BulkDataURIReference : str):
     return http_response
 
 
+def _qidoResponse(parameters : dict):
+    body , next_token = _searchQIDO(parameters)
+    http_response = Response(status = 200 , response=body, mimetype="text/json" , content_type="application/dicom+json" )
+    if next_token is not None:
+        http_response.headers["X-Next-Page-Token"] = next_token
+    return http_response
+
+def _searchQIDO(parameters : dict):
+    """Returns the DICOM-JSON body of a QIDO-RS search and the token of its next page, None on the last page.
+    Pages (limit > 0) are fetched at once and cached. Unbounded searches are streamed from MySQL, the body is then a generator of chunks."""
+    generation = None
+    if qidocache is not None:
+        start = time.perf_counter()
+        cached = qidocache.get(parameters)
+        if cached is not None:
+            proxyMetrics.observeStage("serialize", time.perf_counter() - start, "hit")
+            return cached
+        generation = qidocache.generation
+    query , query_parameters = _constructQuery(parameters)
+    if parameters["limit"] == 0:
+        return _streamQIDO(query, query_parameters, parameters, generation) , None
+    field_names, db_results = _executeQuery(query , query_parameters)
+    with proxyMetrics.stage("serialize", "miss"):
+        body = qidoSerializer.serialize(field_names , db_results , parameters)
+    next_token = _nextPageToken(parameters, field_names, db_results)
+    if qidocache is not None:
+        qidocache.put(parameters, body, generation, next_token)
+    return body , next_token
+
+def _streamQIDO(query : str , query_parameters : list , parameters : dict , generation : int):
+    """Yields the DICOM-JSON array of a search batch by batch. It is cached at the end unless larger than the cache allows."""
+    cached_chunks = [] if qidocache is not None else None
+    cached_bytes = 0
+    serialize_time = 0.0
+    separator = b"["
+    for field_names , db_results in _executeQueryStream(query , query_parameters):
+        start = time.perf_counter()
+        chunk = separator + qidoSerializer.serialize(field_names , db_results , parameters)[1:-1]
+        serialize_time += time.perf_counter() - start
+        separator = b","
+        if cached_chunks is not None:
+            cached_bytes += len(chunk)
+            if cached_bytes <= qidocache.max_body_bytes:
+                cached_chunks.append(chunk)
+            else:
+                cached_chunks = None
+        yield chunk
+    proxyMetrics.observeStage("serialize", serialize_time, "miss")
+    chunk = b"[]" if separator == b"[" else b"]"
+    if cached_chunks is not None:
+        qidocache.put(parameters, b"".join(cached_chunks) + chunk, generation)
+    yield chunk
+
+def _keysetColumn(parameters : dict):
+    """Returns the (column, field name) paging a search, None when it is not paged or sorted on other fields, which falls back to LIMIT offset."""
+    if parameters["limit"] == 0 or len(parameters["orderbyfields"]) > 0:
+        return None
+    table = QIDO_KEYSET_TABLES[parameters["queryLevel"]]
+    return f"{tables[table]}.{table_unique_keys[table]}" , table_unique_keys[table]
+
+def _nextPageToken(parameters : dict, field_names : list, db_results : list):
+    """Returns the opaque token of the page following db_results : the level and the last unique key it holds."""
+    keyset = _keysetColumn(parameters)
+    if keyset is None or len(db_results) < parameters["limit"]:
+        return None
+    last_key = db_results[-1][field_names.index(keyset[1])]
+    return base64.urlsafe_b64encode(orjson.dumps({ "level" : parameters["queryLevel"] , "after" : last_key })).decode()
+
+def _pageTokenKey(level : str, token : str):
+    """Returns the unique key a page token continues after. Raises QueryParameterError if the token is invalid or from another level :
+    serving the first page instead would make a client following the tokens loop."""
+    try:
+        page = orjson.loads(base64.urlsafe_b64decode(token))
+        page_level = page["level"]
+        after = int(page["after"])
+    except Exception as err:
+        logging.warning(f"[_pageTokenKey] - invalid page token {token} : {err}")
+        raise QueryParameterError("invalid pagetoken")
+    if page_level != level:
+        raise QueryParameterError(f"pagetoken of a {page_level} search used for a {level} search")
+    return after
+
 def _executeQuery(query : str , query_parameters : array):
     sql_conn = sql_pool.get_connection()
     cursor = sql_conn.cursor()
-    cursor.execute("SET TRANSACTION ISOLATION LEVEL READ UNCOMMITTED")
-    cursor.execute(query, query_parameters)
-    db_results = cursor.fetchall()
+    with proxyMetrics.stage("sql"):
+        cursor.execute("SET TRANSACTION ISOLATION LEVEL READ UNCOMMITTED")
+        cursor.execute(query, query_parameters)
+        db_results = cursor.fetchall()
     field_names = [i[0] for i in cursor.description]
     sql_conn.commit()
     cursor.execute("SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ")
@@ -314,68 +441,102 @@ def _executeQuery(query : str , query_parameters : array):
     sql_conn.close()
     return field_names , db_results
 
-def instancesYield(results, boundary):
-    with concurrent.futures.ThreadPoolExecutor(max_workers=32) as executor:
-        futures = []
-        for res in results:
-            InstanceUID = res[0]  
-            futures.append(executor.submit(RetrieveInstance, sql_queries.WADO_INSTANCE_METADATA , InstanceUID))
-        wait(futures)
-        for future in concurrent.futures.as_completed(futures):  
-            yield( multipartEncapsulate(boundary=boundary, content_type= "application/dicom" , payload=future.result() ))
+def _executeQueryStream(query : str , query_parameters : array , batch_size : int = None):
+    """Yields the (field names, rows) of a query batch_size rows at a time. The cursor is unbuffered : the rows stay on the
+    MySQL server until fetched, so the memory used does not depend on the size of the result."""
+    sql_conn = sql_pool.get_connection()
+    cursor = sql_conn.cursor()
+    sql_time = 0.0 # time spent waiting for MySQL only, not for the consumer of the rows.
+    try:
+        start = time.perf_counter()
+        cursor.execute("SET TRANSACTION ISOLATION LEVEL READ UNCOMMITTED")
+        cursor.execute(query, query_parameters)
+        field_names = [i[0] for i in cursor.description]
+        while True:
+            db_results = cursor.fetchmany(batch_size or qido_fetch_batch)
+            sql_time += time.perf_counter() - start
+            if len(db_results) == 0:
+                break
+            yield field_names , db_results
+            start = time.perf_counter()
+        sql_conn.commit()
+        cursor.execute("SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+    finally:
+        try:
+            sql_conn.consume_results() # response abandoned by the client, the remaining rows must be read before the connection is reused.
+            cursor.close()
+        except Exception as err:
+            logging.warning(f"[_executeQueryStream] - {err}")
+        sql_conn.close()
+        proxyMetrics.observeStage("sql", sql_time)
+
+def instancesYield(results, boundary, route : str = "instance"):
+    return _streamInstances(((RetrieveInstance, (sql_queries.WADO_INSTANCE_METADATA , res[0])) for res in results), boundary, route)
+
+def _streamInstances(retrieve_tasks, boundary, route : str):
+    """Yields each instance as a multipart part as soon as it is DICOMized. retrieve_tasks is an iterable of (function, args)
+    returning the instance bytes. At most wado_stream_window instances are in flight at once, which bounds the memory used
+    by a response whatever the size of the series or study."""
+    start = time.perf_counter()
+    first_part = True
+    peak_buffered_bytes = 0
+    pending = iter(retrieve_tasks)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=wado_stream_window) as executor:
+        futures = set()
+        while True:
+            for retrieve_function , retrieve_args in pending:
+                futures.add(executor.submit(proxyMetrics.bind(retrieve_function), *retrieve_args))
+                if len(futures) >= wado_stream_window:
+                    break
+            if len(futures) == 0:
+                break
+            done , futures = wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+            completed = []
+            for future in done:
+                try:
+                    completed.append(future.result())
+                except Exception as err: # one failing instance should not abort a response already being streamed.
+                    logging.error(f"[_streamInstances] - {err}")
+            peak_buffered_bytes = max(peak_buffered_bytes, sum(len(payload) for payload in completed if payload is not None))
+            for payload in completed:
+                if payload is None:
+                    continue
+                if first_part:
+                    proxyMetrics.observe("wado_retrieve_time_to_first_byte_seconds", time.perf_counter() - start, route=route)
+                    first_part = False
+                yield from multipartEncapsulateChunks(boundary=boundary, content_type= "application/dicom" , payload=payload )
         yield(bytes("--"+boundary+"--", 'utf-8'))
-
-def _convertToJSON(column_index , db_results , params: dict):
-    level = params["queryLevel"]
-    json_array = []
-    match level:
-        case "STUDY":
-            tagDict = studyTagsTofields
-        case "SERIES":
-            tagDict = seriesTagsTofields
-        case "INSTANCE":
-            tagDict = instanceTagsTofields
-        case "STUDY.SERIES":
-            tagDict = seriesTagsTofields
-        case "STUDY.INSTANCE":
-            tagDict = instanceTagsTofields
-        case "STUDY.SERIES.INSTANCE":
-            tagDict = instanceTagsTofields
-
-    for result in db_results:
-        ds = Dataset()
-        for tag in tagDict:
-            try:
-                index = column_index.index(tagDict[tag].lower())
-                tagvalue = _serializeValue(result[index])
-                if ( pydicom.datadict.dictionary_VR(tag) == "CS" ) and ( "/" in tagvalue):
-                    tagvalue = tagvalue.split("/")
-                ds.add(DataElement(tag, pydicom.datadict.dictionary_VR(tag) , tagvalue))
-            except BaseException as err:
-                pass
-
-        for tag in params["includefield"]:
-            try:
-                index = column_index.index(tagDict[tag].lower())
-                tagvalue = _serializeValue(result[index])
-                ds.add(DataElement(tag, pydicom.datadict.dictionary_VR(tag) , tagvalue))
-            except BaseException as err:
-                pass
-        #tag = "00081190"
-        #ds.add(DataElement(tag, pydicom.datadict.dictionary_VR(tag) , "http://10.10.34.42:8080/aetitle/studies/1.2.840.113619.2.30.1.1762295590.1623.978668949.886"))
-        json_array.append(ds.to_json_dict())
-
-
-    return json_array
-
-def _serializeValue(obj : any):
-    if isinstance(obj, datetime.date):
-        return obj.strftime('%Y%m%d')
-    if isinstance(obj , datetime.timedelta):
-        return obj.strftime('%H%M%S.%f')
-    return obj
-
-def _processParameters(level : str):
+    proxyMetrics.observe("wado_retrieve_duration_seconds", time.perf_counter() - start, route=route)
+    proxyMetrics.observe("wado_retrieve_peak_buffered_bytes", peak_buffered_bytes, buckets=proxyMetrics.BYTES_BUCKETS, route=route)
+
+def _processMetrics():
+    """Process level gauges and cache statistics, evaluated when /metrics is scraped."""
+    samples = [("process_peak_resident_memory_bytes", "gauge", {}, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)] # ru_maxrss is in KB on Linux.
+    samples.append(("frame_index_instances", "gauge", {}, metadataCache.frame_index.count()))
+    samples += _cacheSamples("frame_index_cache", metadataCache.frame_index.stats())
+    samples += _cacheSamples("metadata_cache", metadataCache.getCacheStats(), counters=("hits", "misses", "evictions", "expirations", "coalesced_requests"))
+    if qidocache is not None:
+        samples += _cacheSamples("qido_cache", qidocache.stats())
+    if pixelcache is not None:
+        samples += _cacheSamples("pixel_cache_ram", pixelcache.stats())
+    samples += _cacheSamples("rendered_cache", framerenderer.stats())
+    return samples
+
+def _cacheSamples(prefix : str, stats : dict, counters : tuple = ("hits", "misses", "evictions", "expirations")) -> list:
+    """Samples of the statistics of a cache, the ones named in counters being counters and the others gauges."""
+    return [ (f"{prefix}_{stat}", "counter" if stat in counters else "gauge", {}, value) for stat , value in stats.items() if value is not None ]
+
+proxyMetrics.registerCollector(_processMetrics)
+proxyMetrics.describe("wado_retrieve_time_to_first_byte_seconds", "Time between the start of a WADO-RS retrieve response and its first instance part.")
+proxyMetrics.describe("wado_retrieve_peak_buffered_bytes", "Largest amount of DICOMized instance bytes held at once by a WADO-RS retrieve response.")
+proxyMetrics.describe("process_peak_resident_memory_bytes", "Peak resident set size of the proxy process.")
+proxyMetrics.describe("frame_index_instances", "Instances whose frames can be located without querying MySQL.")
+
+def _processParameters(level : str, args = None):
+    """Parses the QIDO-RS query parameters of the request, or of args when provided (any mapping with get, eg. the query params of the ASGI app).
+    Raises QueryParameterError when the search cannot be served as requested."""
+    if args is None:
+        args = request.args
 
     bypassOtherIncludeFields = False
     returnfields = []
@@ -384,9 +545,10 @@ def _processParameters(level : str):
     orderbyfields = []
     query_offset = 0
     query_limit = 0
-    for arg in request.args:
-        logging.info(f"Query parameter {arg} = {request.args.get(arg)}")
-        arg_value = request.args.get(arg)
+    keyset_after = None
+    for arg in args:
+        logging.info(f"Query parameter {arg} = {args.get(arg)}")
+        arg_value = args.get(arg)
         match arg:
             case "includefield":
                 if  arg_value == "all":
@@ -403,9 +565,11 @@ def _processParameters(level : str):
             case "fuzzyMatching":
                 pass
             case "limit":
-                query_limit = arg_value
+                query_limit = int(arg_value) if arg_value.isdigit() else 0
             case "offset":
-                query_offset = arg_value
+                query_offset = int(arg_value) if arg_value.isdigit() else 0
+            case "pagetoken":
+                keyset_after = _pageTokenKey(level, arg_value)
             case "orderby":
                 orderbyfields.append(arg_value)
             case other :
@@ -429,6 +593,10 @@ def _processParameters(level : str):
                         if arg == value:
                             wherefields[key] = arg_value
                             continue
+    if keyset_after is not None and len(orderbyfields) > 0:
+        raise QueryParameterError("pagetoken cannot be combined with orderby, use offset")
+    if keyset_after is not None and query_limit == 0:
+        raise QueryParameterError("pagetoken requires limit")
     if "00080061" in wherefields.keys():
         havingfields["00080061"] = wherefields["00080061"]
         del wherefields["00080061"]
@@ -436,6 +604,7 @@ def _processParameters(level : str):
         "queryLevel": level,
         "limit": query_limit,
         "offset": query_offset,
+        "after": keyset_after,
         "includefield": returnfields,
         "wherefields": wherefields,
         "havingfields" : havingfields,
@@ -509,6 +678,10 @@ def _constructQuery(params : dict):
             query_prototype = f"SELECT * FROM (({instance_table} INNER JOIN {series_table} on {series_table}.{series_ukey} = {instance_table}.{series_ukey}) INNER join {study_table} on {series_table}.{study_ukey} = {study_table}.{study_ukey}) WHERE 1=1 " #nosec - bandit confused by string literal variales in query construction.
             tagDict = instanceTagsTofields
     where_prototype , where_params = ConstructQueryFilters(params=params["wherefields"], tagDict=tagDict)
+    keyset = _keysetColumn(params)
+    if keyset is not None and params.get("after") is not None:
+        where_prototype += f" AND {keyset[0]} > %s " #nosec - the column comes from the table mappings.
+        where_params.append(params["after"])
     having_prototype , having_params = ConstructQueryFilters(params=params["havingfields"], tagDict=tagDict)
     query_parameters = query_parameters + where_params + having_params
 
@@ -539,8 +712,12 @@ def _constructQuery(params : dict):
             orderby_prototype=""
         else:
             orderby_prototype = orderby_prototype[:-1]
-    if int(params["limit"]) > 0:
-        limit_offset = f" LIMIT {str(params['offset'])} , {str(params['limit'])}"
+    if keyset is not None:
+        orderby_prototype = f" ORDER BY {keyset[0]}" # pages follow the unique key, a page token skips the previous pages through the index.
+    if keyset is not None and params.get("after") is not None:
+        limit_offset = f" LIMIT {params['limit']}"
+    elif params["limit"] > 0:
+        limit_offset = f" LIMIT {params['offset']} , {params['limit']}"
     else:
         limit_offset = ""
     if type(query_prototype) == dict:
@@ -591,76 +768,148 @@ def ConstructQueryFilters(params , tagDict):
             query_parameters.append(filter_params[2])
     return filter_prototype, query_parameters
 
-def _RetrievePixelData(query: str,  SeriesInstanceUID ,  InstanceUID : str , frame_list: list , multipart : bool = True): #right now this function only handles one frame per call... don't be fooled by frame_list being a list we will only use frame 0
-    try:
-        index = metadataCache.frame_index[InstanceUID+"_"+str(frame_list[0])]
-        frame = getFramePixels(datastore_id=index["DatastoreID"], imageset_id=index["ImageSetID"], imageframe_id=index["ImageFrameID"], client=ahi_client )
-        if multipart:
-            boundary = multipart_boundary()
-            payload = multipart_payload(uid.ExplicitVRLittleEndian, frame , boundary) #defaulting to ELE transfer syntax , the decoder has uncompressed the data. In theory we should comply to whatever is asked by the client...
-            return payload
-        else :
-            return frame        
-    except:
-        logging.debug(f"[_RetrievePixelData] - {InstanceUID} not in cache")
-    """Retieves a single DICOM object from AHI"""
+def _resolveFrameLocations(query: str,  SeriesInstanceUID ,  InstanceUID : str , frame_list: list):
+    """Returns the (datastore_id, imageset_id, imageframe_id) of each requested frame number, in the requested order."""
+    frame_locations = _frameLocationsFromIndex(InstanceUID, frame_list)
+    if frame_locations is not None:
+        return frame_locations
     sql_conn = sql_pool.get_connection()
     cursor = sql_conn.cursor()
-    cursor.execute(query , (InstanceUID,))
-    results = cursor.fetchall()
+    with proxyMetrics.stage("sql"):
+        cursor.execute(query , (InstanceUID,))
+        results = cursor.fetchall()
     cursor.close()
     sql_conn.close()
     for res in results:
         datastore_id = res[0]
         imageset_id = res[1]
         metadata = metadatacache.getMetadata(datastore_id= datastore_id , imageset_id= imageset_id)
-        assignToCache(metadata=metadata)
-        frame_id = None
-        try:
-            frame_id = metadata["Study"]["Series"][SeriesInstanceUID]["Instances"][InstanceUID]["ImageFrames"][frame_list[0]-1]["ID"] #This only honors the 1st entry of the frame list...
-            
-        except Exception as err:
-            logging.error(err)
-            continue
-        frame = getFramePixels(datastore_id=datastore_id, imageset_id=imageset_id , imageframe_id=frame_id, client=ahi_client )
-        if multipart:
-            boundary = multipart_boundary()
-            payload = multipart_payload(uid.ExplicitVRLittleEndian, frame , boundary) #defaulting to ELE transfer syntax , the decoder has uncompressed the data. In theory we should comply to whatever is asked by the client...
+        frame_locations = _frameLocationsFromMetadata(metadata, datastore_id, imageset_id, SeriesInstanceUID, InstanceUID, frame_list)
+        if frame_locations is not None:
+            return frame_locations
+    return None
 
-            return payload
-        else :
-            return frame
+def _frameLocationsFromIndex(InstanceUID : str , frame_list : list):
+    """Returns the frame locations from the frame index, None if one of the frames is not indexed."""
+    frame_locations = metadataCache.frame_index.locateFrames(InstanceUID, frame_list)
+    if frame_locations is None:
+        logging.debug(f"[_frameLocationsFromIndex] - {InstanceUID} not in the frame index")
+        return None
+    if framefetcher is not None:
+        framefetcher.promoteImageSet(frame_locations[0][0], frame_locations[0][1])
+    return frame_locations
+
+def _frameLocationsFromMetadata(metadata , datastore_id : str , imageset_id : str , SeriesInstanceUID : str , InstanceUID : str , frame_list : list):
+    """Returns the frame locations from an image set metadata and queues the image set for prefetch, None if the instance is not in it."""
+    assignToCache(metadata=metadata, priority=frameFetcher.VIEWING)
+    try:
+        image_frames = metadata["Study"]["Series"][SeriesInstanceUID]["Instances"][InstanceUID]["ImageFrames"]
+    except KeyError:
+        logging.debug(f"[_frameLocationsFromMetadata] - {InstanceUID} not in {datastore_id}/{imageset_id}")
+        return None
+    if any(frame_number < 1 or frame_number > len(image_frames) for frame_number in frame_list):
+        logging.debug(f"[_frameLocationsFromMetadata] - {InstanceUID} has {len(image_frames)} frames, {frame_list} requested")
+        return None
+    return [(datastore_id, imageset_id, image_frames[frame_number-1]["ID"]) for frame_number in frame_list]
+
+def framesStart(frame_locations : list, transfer_syntax : str = uid.ExplicitVRLittleEndian):
+    """Fetches the frames concurrently and waits for the first one, so that the request fails before its headers are sent if it
+    cannot be retrieved. Frames are decoded to ELE unless an HTJ2K transfer syntax was negotiated, in which case they are passed
+    through untouched. Returns (executor, futures, first part), the parts being yielded by _framesParts, or None."""
+    if transfer_syntax in HTJ2K_TRANSFER_SYNTAXES:
+        fetch_frame = lambda *location : getFrameEncoded(*location, transfer_syntax=transfer_syntax)
+    else:
+        fetch_frame = lambda *location : (getFramePixels(*location, client=ahi_client), transfer_syntax)
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=min(len(frame_locations), 32))
+    fetch_frame = proxyMetrics.bind(fetch_frame)
+    futures = [executor.submit(fetch_frame, *location) for location in frame_locations]
+    first_part = futures[0].result()
+    if first_part[0] is None:
+        logging.error(f"[framesStart] - frame {frame_locations[0]} could not be retrieved.")
+        _cancelFrames(executor, futures)
+        return None
+    return executor , futures , first_part
+
+def _framesParts(executor , futures : list , first_part : tuple , frame_locations : list , boundary : str):
+    try:
+        for part_number , future in enumerate(futures):
+            frame , part_transfer_syntax = first_part if part_number == 0 else future.result()
+            if frame is None: # the headers are sent, an empty part would read as a valid frame : the response is aborted instead.
+                raise RuntimeError(f"[_framesParts] - frame {frame_locations[part_number]} could not be retrieved, response aborted.")
+            # header and frame are yielded as separate chunks, the frame bytes are handed to the WSGI server without being copied.
+            yield multipart_header(part_transfer_syntax, boundary, first_part=(part_number == 0))
+            yield frame
+        yield multipart_footer(boundary, b"")
+    finally:
+        _cancelFrames(executor, futures) # client gone or response aborted : the frames not fetched yet are dropped.
+
+def _cancelFrames(executor , futures : list):
+    for future in futures:
+        future.cancel()
+    executor.shutdown(wait=False)
+
+def getFrameEncoded(datastore_id, imageset_id, imageframe_id , transfer_syntax : str = uid.HTJ2KLossless):
+    """Returns (frame bytes, transfer syntax) for an HTJ2K response : the AHI blob as is when it is a JPEG 2000 codestream,
+    decoded pixels labelled ELE otherwise, eg. for image sets imported with their original transfer syntax."""
+    frame = getFrame(datastore_id, imageset_id, imageframe_id , ahi_client)
+    if frame is not None and frame[:4] == J2K_CODESTREAM_MAGIC:
+        return frame , transfer_syntax
+    logging.debug(f"[getFrameEncoded] - {datastore_id}/{imageset_id}/{imageframe_id} is not an HTJ2K codestream, decoding it.")
+    return getFramePixels(datastore_id, imageset_id, imageframe_id , ahi_client) , uid.ExplicitVRLittleEndian
+
+def negotiateFrameTransferSyntax(accept_header : str) -> str:
+    """Picks the transfer syntax of a frames response from the Accept header media ranges, by decreasing q value then in order.
+    HTJ2K is only returned when explicitly accepted, transfer-syntax=* and */* keep the decoded ELE frames."""
+    media_ranges = []
+    for position , media_range in enumerate(accept_header.split(",")):
+        params = media_range.split(";")
+        media_type = params[0].strip().lower()
+        parameters = {}
+        for param in params[1:]:
+            if "=" in param:
+                name , value = param.split("=", 1)
+                parameters[name.strip().lower()] = value.strip().strip('"')
+        try:
+            quality = float(parameters.get("q", 1))
+        except ValueError:
+            quality = 1.0
+        if media_type == "multipart/related":
+            part_type = parameters.get("type", "application/octet-stream").lower()
+            transfer_syntax = parameters.get("transfer-syntax", uid.HTJ2KLossless if part_type == "image/jphc" else uid.ExplicitVRLittleEndian)
+        else:
+            transfer_syntax = uid.ExplicitVRLittleEndian
+        media_ranges.append((-quality, position, transfer_syntax))
+    for negative_quality , position , transfer_syntax in sorted(media_ranges):
+        if negative_quality == 0:
+            break # q=0 means not acceptable.
+        if transfer_syntax in HTJ2K_TRANSFER_SYNTAXES:
+            return transfer_syntax # AHI stores the frames as lossless HTJ2K, which is valid for each of the HTJ2K transfer syntaxes.
+        if transfer_syntax in (uid.ExplicitVRLittleEndian , "*"):
+            return uid.ExplicitVRLittleEndian
+    return uid.ExplicitVRLittleEndian
 
 def multipartEncapsulate(boundary : str, content_type: str,  payload : bytes):
-    boundary = bytes("--"+boundary, 'utf-8')
-    content_type = bytes("\r\nContent-Type: "+content_type, 'utf-8')
-    content_length = bytes("\r\nContent-Length: "+str(len(payload)), 'utf-8')
-    mime_type = bytes("\r\nMIME-Version: 1.0", 'utf-8')
-    crlf = bytes("\r\n", 'utf-8')
-    return boundary + content_type + content_length + mime_type + crlf + crlf + payload + crlf
+    return b"".join(multipartEncapsulateChunks(boundary, content_type, payload))
+
+def multipartEncapsulateChunks(boundary : str, content_type: str,  payload : bytes):
+    """Returns the (header, payload, trailer) chunks of a multipart part. The payload is passed along as is so that
+    streamed responses never copy it, the WSGI server writes the chunks one after the other."""
+    header = f"--{boundary}\r\nContent-Type: {content_type}\r\nContent-Length: {len(payload)}\r\nMIME-Version: 1.0\r\n\r\n".encode()
+    return (header, payload, b"\r\n")
 
 def multipart_boundary():
     boundary = str(uuid4().hex)+"-"+str(uuid4().hex)
     return boundary
 
-def multipart_payload(transfer_syntax, object_bytes , boundary):
-    multipart_frame = bytearray()
-    hd = '--' + boundary + '\r\nContent-Type: '
-    ct = get_content_type(transfer_syntax)
-    tshd = '; transfer-syntax="'
-    ts = transfer_syntax
-    tsft = '"'
-    crlf = '\r\n\r\n'
-    ft = '\r\n--' + boundary + '--'
-    multipart_frame+=hd.encode()
-    multipart_frame+=ct.encode()
-    multipart_frame+=tshd.encode()
-    multipart_frame+=ts.encode()
-    multipart_frame+=tsft.encode()
-    multipart_frame+=crlf.encode()
-    multipart_frame+=object_bytes
-    multipart_frame+=ft.encode()
-    return bytes(multipart_frame)
+def multipart_payload(transfer_syntax, object_bytes , boundary , footer : bool = True):
+    if footer:
+        return multipart_header(transfer_syntax, boundary) + object_bytes + multipart_footer(boundary, b"")
+    return multipart_header(transfer_syntax, boundary) + object_bytes
+
+def multipart_header(transfer_syntax, boundary , first_part : bool = True):
+    """Returns the header of a frame part. Parts after the first start with the CRLF closing the previous part's payload."""
+    separator = '' if first_part else '\r\n'
+    return f'{separator}--{boundary}\r\nContent-Type: {get_content_type(transfer_syntax)}; transfer-syntax="{transfer_syntax}"\r\n\r\n'.encode()
 
 
 def multipart_footer(boundary : str , payload : bytes):
@@ -686,6 +935,9 @@ def get_content_type (transfer_syntax):
             uid.JPEG2000:                       "image/jp2",
             uid.JPEG2000MCLossless:             "image/jpx",
             uid.JPEG2000MC:                     "image/jpx",
+            uid.HTJ2KLossless:                  "image/jphc",
+            uid.HTJ2KLosslessRPCL:              "image/jphc",
+            uid.HTJ2K:                          "image/jphc",
             uid.MPEG2MPML:                      "video/mpeg2",
             uid.MPEG2MPHL:                      "video/mpeg2",
             uid.MPEG4HP41:                      "video/mp4",
@@ -701,35 +953,59 @@ def get_content_type (transfer_syntax):
     return cont_type
 
 
-def RetrieveMetadata(query, UID : str):
-    start = datetime.datetime.now()
+def _metadataResponse(query, UID : str):
+    instance_count , content , encoding = RetrieveMetadata(query , UID , request.headers.get('Accept-Encoding',''))
+    if instance_count > 0:
+        http_code = 200
+    else:
+        http_code = 400
+    mimetype = "text/json"
+    contentType = "application/dicom+json"
+    http_response = Response(status = http_code , response=content, mimetype=mimetype , content_type=contentType )
+    http_response.headers['Vary'] = 'Accept-Encoding'
+    if encoding is not None:
+        logging.debug(f"response will be {encoding} encoded")
+        http_response.headers['Content-length'] = len(content)
+        http_response.headers['Content-Encoding'] = encoding
+    return http_response
+
+def RetrieveMetadata(query, UID : str, accept_encoding : str = ""):
+    """Returns the number of instances, the DICOM-JSON body describing them and its Content-Encoding, None if not compressed.
+    The per image set DICOM-JSON is served from the metadata cache once it has been serialized, and compressed once per encoding."""
     fields , results = _executeQuery(query , (UID,) )
-    end = datetime.datetime.now()
-    ahi_metadatas = []
-    metadata_table = []
-    #Get the metadatas from the Cache or from AHI.
-    start = datetime.datetime.now()
+    #Get the serialized metadatas from the Cache or from AHI.
     meta_fetch = []
     for res in results:
         datastore_id = res[0]
         imageset_id = res[1]  
         meta_fetch.append((datastore_id,imageset_id,))
     with concurrent.futures.ThreadPoolExecutor(100) as executor:
-        ahi_metadatas = executor.map(metadatacache.getMetadataViaTuple, meta_fetch)  
-    end = datetime.datetime.now()
+        serialized_metadatas = [ (fetch , serialized) for fetch , serialized in zip(meta_fetch, executor.map(proxyMetrics.bind(metadatacache.getSerializedMetadataViaTuple), meta_fetch)) if serialized is not None ]
+    return _metadataBody(serialized_metadatas, accept_encoding)
+
+def _metadataBody(serialized_metadatas : list, accept_encoding : str = ""):
+    """Builds the metadata response from a list of ((datastore_id, imageset_id), serialized metadata). Returns (instance count, body, encoding)."""
+    if len(serialized_metadatas) == 1: # most common case, the body is served as is from the cache.
+        (datastore_id , imageset_id) , serialized = serialized_metadatas[0]
+        encoding = responseCompression.negotiate(accept_encoding, "metadata")
+        if encoding is None or len(serialized["json"]) < responseCompression.PROFILES["metadata"]["min_size"]:
+            return len(serialized["instances"]) , serialized["json"] , None
+        body = serialized["encoded"].get(encoding)
+        if body is not None:
+            responseCompression.reused("metadata", encoding, len(body))
+        else:
+            body = responseCompression.compress(serialized["json"], encoding, "metadata")
+            metadataCache.storeEncodedMetadata(datastore_id, imageset_id, serialized, encoding, body)
+        return len(serialized["instances"]) , body , encoding
     instance_array = set()
-    for metadata in ahi_metadatas:
-        patient_dict = metadataCache.getJSONKeys(metadata["Patient"]["DICOM"])
-        study_dict = metadataCache.getJSONKeys(metadata["Study"]["DICOM"])
-        seriesinstanceuid = next(iter(metadata["Study"]["Series"].keys()))
-        series_dict = metadataCache.getJSONKeys(metadata["Study"]["Series"][seriesinstanceuid]["DICOM"])
-        iteration = iter(metadata["Study"]["Series"][seriesinstanceuid]["Instances"].keys())
-        for instance in iteration:
+    metadata_table = []
+    for fetch , serialized in serialized_metadatas:
+        for instance , instance_json in serialized["instances"]:
             if not instance in instance_array:
-                instance_meta=metadataCache.getInstancedDict(instance_uid=instance, metadata=metadata, patient_dict=patient_dict , study_dict=study_dict , series_dict=series_dict)
                 instance_array.add(instance)
-                metadata_table.append(instance_meta)
-    return metadata_table
+                metadata_table.append(instance_json)
+    content , encoding = responseCompression.compressBody(b"[" + b",".join(metadata_table) + b"]", accept_encoding, "metadata")
+    return len(metadata_table) , content , encoding
 
 
 def RetrieveInstance(query, UID : str):
@@ -740,21 +1016,30 @@ def RetrieveInstance(query, UID : str):
         imageset_id = res[1] 
         metadata = metadatacache.getMetadata(datastore_id=datastore_id , imageset_id=imageset_id)
         assignToCache(metadata=metadata)
-        series_uid = next(iter(metadata["Study"]["Series"].keys()))
-        if UID in metadata["Study"]["Series"][series_uid]["Instances"].keys():
-            insDICOMizer = InstanceDICOMizer(ahi_client=ahi_client)
-            if metadata["Study"]["Series"][series_uid]["Instances"][UID]["DICOM"]["SOPClassUID"] == "1.2.840.10008.5.1.4.1.1.66.4": # <-- jpleger : 01/09/2025 - a bit hacky, just to support binary segmentation class... Need proper SOPClassUID conditions handling... I should normally also check the Segmentation format , BINARY , FRACTIONAL or LABELMAP. At the moment this only works for BINARY
-                insDICOMizer.getFramePixels = getFrame  #getFrame merely return the bytes array as received from AHI
-            else:
-                insDICOMizer.getFramePixels = getFramePixels #getFramePixels decodes HTJ2K data and return the bytes array.
-            ds = insDICOMizer.DICOMize(UID, metadata )
-            buffer = io.BytesIO()
-            ds.save_as(buffer, enforce_file_format=True)
-            buffer.seek(0)
-            return buffer.read()
+        instance = DICOMizeInstance(metadata, UID)
+        if instance is not None:
+            return instance
     logging.error("no matching instance found")
     return None
 
+def DICOMizeInstance(metadata, UID : str):
+    """Encodes the instance UID of an image set metadata as DICOM P10 bytes, or returns None if the image set does not contain it."""
+    series_uid = next(iter(metadata["Study"]["Series"].keys()))
+    if not UID in metadata["Study"]["Series"][series_uid]["Instances"].keys():
+        return None
+    insDICOMizer = InstanceDICOMizer(ahi_client=ahi_client)
+    if metadata["Study"]["Series"][series_uid]["Instances"][UID]["DICOM"]["SOPClassUID"] == "1.2.840.10008.5.1.4.1.1.66.4": # <-- jpleger : 01/09/2025 - a bit hacky, just to support binary segmentation class... Need proper SOPClassUID conditions handling... I should normally also check the Segmentation format , BINARY , FRACTIONAL or LABELMAP. At the moment this only works for BINARY
+        insDICOMizer.getFramePixels = getFrame  #getFrame merely return the bytes array as received from AHI
+    else:
+        insDICOMizer.getFramePixels = getFramePixels #getFramePixels decodes HTJ2K data and return the bytes array.
+    with proxyMetrics.stage("dicomize"):
+        with wado_concurrency: # global cap on the instances being pulled from AHI, shared by all the retrieve requests.
+            ds = insDICOMizer.DICOMize(UID, metadata )
+        buffer = io.BytesIO()
+        ds.save_as(buffer, enforce_file_format=True)
+        buffer.seek(0)
+        return buffer.read()
+
 def _getSecret(secret_arn):
     session = boto3.session.Session()
     client = session.client(service_name='secretsmanager')
@@ -779,35 +1064,67 @@ def genMetadata(fetch_files):
 
 
 def getFrame(datastore_id, imageset_id, imageframe_id , client = None ):
+    with proxyMetrics.stage("ahi_frame", "hit") as timer:
+        return _getFrame(datastore_id, imageset_id, imageframe_id, client, timer)
+
+def _getFrame(datastore_id, imageset_id, imageframe_id , client , timer):
+    if framecache is not None:
+        frame = framecache.read(datastore_id, imageset_id, imageframe_id) # records the hit or the miss.
+        if frame is not None:
+            logging.debug(f"cache HIT    : {datastore_id}/{imageset_id}/{imageframe_id}")
+            return frame
+    else:
+        cacheIndex.recordMiss("raw")
+    timer.cache = "miss"
     try:
-        frame_cache_file = open(f"./cache/{datastore_id}/{imageset_id}/{imageframe_id}.cache", 'rb')
-        frame = frame_cache_file.read()
-        frame_cache_file.close()
-        logging.debug(f"cache HIT    : {datastore_id}/{imageset_id}/{imageframe_id}")
-        return frame
-    except:
+        logging.debug(f"cache MISSED : {datastore_id}/{imageset_id}/{imageframe_id}")
+        if framefetcher is not None: # goes through the prefetch queue ahead of the background prefetch, and joins the fetch already in flight if any.
+            return framefetcher.fetchFrame(datastore_id, imageset_id, imageframe_id, priority=frameFetcher.REQUEST)
+        if client is None :
+            client = boto3.client('medical-imaging')
+        res = client.get_image_frame(
+            datastoreId=datastore_id,
+            imageSetId=imageset_id,
+            imageFrameInformation= {'imageFrameId' :imageframe_id})
+        return res['imageFrameBlob'].read()
+    except Exception as e:
+        return None
+
+def decodeFrame(frame : bytes):
+    """Decodes an HTJ2K frame to its little endian pixels, returns None if openjpeg cannot decode it.
+    Decoding runs in the decode processes when the pool is started, inline otherwise."""
+    with proxyMetrics.stage("decode", "miss"):
+        return _decodeFrame(frame)
+
+def _decodeFrame(frame : bytes):
+    if decodepool is not None:
         try:
-            logging.debug(f"cache MISSED : {datastore_id}/{imageset_id}/{imageframe_id}")
-            if client is None :
-                client = boto3.client('medical-imaging')
-            res = client.get_image_frame(
-                datastoreId=datastore_id,
-                imageSetId=imageset_id,
-                imageFrameInformation= {'imageFrameId' :imageframe_id})
-            return res['imageFrameBlob'].read()
-        except Exception as e:
-            return None
+            return decodepool.decode(frame)
+        except concurrent.futures.process.BrokenProcessPool as e: # the pool is restarted for the next frames.
+            logging.error(f"[decodeFrame] - decode pool is broken, decoding inline : {e}")
+    try:
+        return decode(io.BytesIO(frame)).tobytes()
+    except Exception as e:
+        return None
 
 def getFramePixels(datastore_id, imageset_id, imageframe_id , client = None ):
     try:
+        if pixelcache is not None:
+            start = time.perf_counter()
+            pixels = pixelcache.get(datastore_id, imageset_id, imageframe_id)
+            if pixels is not None: # zero decode hit.
+                proxyMetrics.observeStage("decode", time.perf_counter() - start, "hit")
+                return pixels
         b = getFrame(datastore_id, imageset_id, imageframe_id , client)
         b = io.BytesIO(b)
 
         if b.getvalue():
-            try:
-                d = decode(b)
-                return d.tobytes()
-            except Exception as e:
+            pixels = decodeFrame(b.getvalue())
+            if pixels is not None:
+                if pixelcache is not None:
+                    pixelcache.put(datastore_id, imageset_id, imageframe_id, pixels)
+                return pixels
+            else:
                 with Image.open(b) as img:
                     output = io.BytesIO()
                     img.save(output, format='JPEG')
@@ -826,15 +1143,10 @@ def getFramePixels(datastore_id, imageset_id, imageframe_id , client = None ):
         return None
 
 
-def assignToCache(metadata : object = None , frame_dict : object =None):
-    frames_dict = frameFetcher.getFramesToCache(metadata=metadata)
-    ff_count = len(framefetchers)
-    ff_selected = 0
-    for frame in frames_dict:
-        framefetchers[ff_selected].addToCache(frame)
-        ff_selected+=1
-        if ff_selected == ff_count:
-            ff_selected=0
+def assignToCache(metadata : object = None , priority : int = frameFetcher.BACKGROUND):
+    if framefetcher is None or metadata is None:
+        return
+    framefetcher.addToCacheByMetadata(metadata, priority)
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO)
@@ -861,24 +1173,131 @@ if __name__ == '__main__':
         logging.warning("No cache location provided, defaulting to "+os.curdir+"/cache/")
         cache_root = './cache'
         os.makedirs(cache_root,exist_ok=True)
-        
-    if config_good == True:    
+    try:
+        metadata_cache_max_entries = int(os.environ['METADATA_CACHE_MAX_ENTRIES'])
+    except:
+        metadata_cache_max_entries = 2000 # Maximum number of image set metadata kept in memory.
+    try:
+        frame_index_max_entries = int(os.environ['FRAME_INDEX_MAX_ENTRIES'])
+    except:
+        frame_index_max_entries = 100000 # Maximum number of instances of the frame index kept in memory, the others are read from disk.
+    try:
+        metadata_cache_max_mb = int(os.environ['METADATA_CACHE_MAX_MB'])
+    except:
+        metadata_cache_max_mb = 2048 # Approximate memory budget of the metadata cache, measured as uncompressed JSON size.
+    try:
+        metadata_cache_ttl = int(os.environ['METADATA_CACHE_TTL'])
+    except:
+        metadata_cache_ttl = 3600 # Seconds after which a cached metadata is fetched again from AHI. 0 disables the expiration.
+    try:
+        wado_stream_window = int(os.environ['WADO_STREAM_WINDOW'])
+    except:
+        wado_stream_window = 16
+    try:
+        wado_concurrency = threading.BoundedSemaphore(int(os.environ['WADO_MAX_CONCURRENCY']))
+    except:
+        wado_concurrency = threading.BoundedSemaphore(64)
+    try:
+        prefetch_concurrency = int(os.environ['PREFETCH_CONCURRENCY'])
+    except:
+        prefetch_concurrency = 32 # Maximum number of concurrent GetImageFrame calls made against AHI by the proxy.
+    try:
+        cache_policy = os.environ['CACHE_POLICY']
+        if not cache_policy in pixelCache.POLICIES:
+            config_good = False
+            logging.error(f"{cache_policy} is not a valid cache policy. Valid policies are : {pixelCache.POLICIES}")
+    except:
+        cache_policy = "raw" # raw : HTJ2K frames as received from AHI , decoded : decoded pixels only , both : raw and decoded.
+    try:
+        pixel_cache_ram_mb = int(os.environ['PIXEL_CACHE_RAM_MB'])
+    except:
+        pixel_cache_ram_mb = 0 # In-memory LRU in front of the decoded pixels files. 0 disables it.
+    try:
+        frame_cache_layout = os.environ['FRAME_CACHE_LAYOUT']
+        if not frame_cache_layout in frameCache.LAYOUTS:
+            config_good = False
+            logging.error(f"{frame_cache_layout} is not a valid frame cache layout. Valid layouts are : {frameCache.LAYOUTS}")
+    except:
+        frame_cache_layout = "files" # files : one .cache file per frame , segments : frames packed in .seg files per image set.
+    try:
+        frame_cache_segment_mb = int(os.environ['FRAME_CACHE_SEGMENT_MB'])
+    except:
+        frame_cache_segment_mb = 64 # Size above which a new segment is started, also the eviction granularity.
+    try:
+        cache_eviction_policy = os.environ['CACHE_EVICTION_POLICY']
+        if not cache_eviction_policy in cacheCleaner.POLICIES:
+            config_good = False
+            logging.error(f"{cache_eviction_policy} is not a valid eviction policy. Valid policies are : {cacheCleaner.POLICIES}")
+    except:
+        cache_eviction_policy = "lru" # lru : least recently read frames first , lfu : least read frames first, ties by recency.
+    try:
+        decode_workers = int(os.environ['DECODE_WORKERS'])
+    except:
+        decode_workers = os.cpu_count() # Number of HTJ2K decode processes. 0 decodes the frames in the request threads.
+    try:
+        qido_cache_ttl = int(os.environ['QIDO_CACHE_TTL'])
+    except:
+        qido_cache_ttl = 30 # Seconds a QIDO-RS response is served from the cache. 0 disables the cache.
+    try:
+        qido_cache_max_mb = int(os.environ['QIDO_CACHE_MAX_MB'])
+    except:
+        qido_cache_max_mb = 64
+    try:
+        qido_cache_queue_url = os.environ['QIDO_CACHE_INVALIDATION_QUEUE_URL']
+    except:
+        qido_cache_queue_url = None # SQS queue receiving the StudyInstanceUIDs updated by the metadata indexer.
+    try:
+        qido_fetch_batch = int(os.environ['QIDO_FETCH_BATCH'])
+    except:
+        qido_fetch_batch = 500
+    try:
+        rendered_cache_mb = int(os.environ['RENDERED_CACHE_MB'])
+    except:
+        rendered_cache_mb = 32 # In-memory LRU of the rendered JPEGs and thumbnails. 0 disables it.
+    try:
+        serving_mode = os.environ['SERVING_MODE']
+        if not serving_mode in ("wsgi", "asgi"):
+            config_good = False
+            logging.error(f"{serving_mode} is not a valid serving mode. Valid modes are : ('wsgi', 'asgi')")
+    except:
+        serving_mode = "wsgi" # wsgi : waitress threads , asgi : event loop for the QIDO, metadata and frames routes.
+    try:
+        asgi_ahi_concurrency = int(os.environ['ASGI_AHI_CONCURRENCY'])
+    except:
+        asgi_ahi_concurrency = 256 # Maximum number of AHI calls in flight on the event loop.
+    try:
+        asgi_max_connections = int(os.environ['ASGI_MAX_CONNECTIONS'])
+    except:
+        asgi_max_connections = 4096 # Concurrent connections above which the event loop answers 503.
+
+    if config_good == True:
         ahi_client = boto3.client('medical-imaging', config=botocore.config.Config(max_pool_connections=100))
-        metadatacache = metadataCache(ahi_client)
-        framefetchers: list[frameFetcher] = []
-        cpu_count = multiprocessing.cpu_count()
-        if cpu_count > 1:
-            spare = 1
-        else:
-            spare = 0
-        for ff_id in range(cpu_count-spare):
-            logging.info(f"[Startup] - Forking FrameFetcher FF{ff_id}")
-            framefetchers.append(frameFetcher(f"FF{ff_id}",getFrame, cache_root)) #first fetcher also embedds the cache cleaner
-        cCleaner = cacheCleaner(framefetchers[0].cached_items , cache_root=cache_root)
+        if decode_workers > 0:
+            logging.info(f"[Startup] - Starting {decode_workers} decode processes")
+            decodepool = decodePool(decode_workers)
+        metadatacache = metadataCache(ahi_client, max_entries=metadata_cache_max_entries, max_bytes=metadata_cache_max_mb*1024*1024, ttl=metadata_cache_ttl)
+        metadataCache.frame_index = frameIndex(os.path.join(cache_root, frameIndex.INDEX_FILE), max_entries=frame_index_max_entries)
+        logging.info(f"[Startup] - Starting FrameFetcher with {prefetch_concurrency} workers")
+        cache_index = cacheIndex(cache_root)
+        cache_index.rebuild()
+        if pixelCache.storesDecoded(cache_policy):
+            pixelcache = pixelCache(cache_root, cache_index, ram_max_bytes=pixel_cache_ram_mb*1024*1024)
+        framecache = frameCache(cache_root, cache_index, layout=frame_cache_layout if pixelCache.storesRaw(cache_policy) else "files", segment_max_bytes=frame_cache_segment_mb*1024*1024)
+        framefetcher = frameFetcher("FF", ahi_client, framecache, concurrency=prefetch_concurrency, store_raw=pixelCache.storesRaw(cache_policy), pixel_cache=pixelcache, decode_frame=decodeFrame)
+        cCleaner = cacheCleaner(framecache, policy=cache_eviction_policy)
+        framerenderer = frameRenderer(cache_max_bytes=rendered_cache_mb*1024*1024)
+        if qido_cache_ttl > 0:
+            qidocache = qidoCache(ttl=qido_cache_ttl, max_bytes=qido_cache_max_mb*1024*1024)
+            if qido_cache_queue_url is not None:
+                logging.info(f"[Startup] - Listening to QIDO-RS cache invalidations on {qido_cache_queue_url}")
+                qidocache.listen(qido_cache_queue_url)
         db_secret = _getSecret(secret_arn)
         sql_pool = mysqlConnectionFactory.mysqlConnectionFactory(hostname=db_secret['host'], username=db_secret['username'], password=db_secret['password'], database=db_secret['dbname'], port=int(db_secret['port']), pool_size=100)
         logging.info("QIDO/WADO-RS service started.")
-   
+        if serving_mode == "asgi":
+            import asgiApp
+            asgiApp.serve(sys.modules[__name__], db_secret, port, ahi_max_concurrency=asgi_ahi_concurrency, sql_pool_size=100, threads=100, max_connections=asgi_max_connections)
+            exit(0)
 
         WSGIRequestHandler.protocol_version = "HTTP/2"
 
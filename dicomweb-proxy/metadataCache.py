@@ -8,19 +8,27 @@ import logging
 import datetime
 import botocore
 import time
-from pydicom import datadict
+from dicom_keywords import keyword_tags
 import collections.abc
-
+from lruCache import lruCache
+from frameIndex import frameIndex
+from proxyMetrics import proxyMetrics
 
 
 
 class metadataCache:
     logger = logging.getLogger(__name__)
     metadata_to_cache = orjson.loads("{}")
-    metadata_cache = orjson.loads("{}")
-    frame_index = orjson.loads("{}")
+    metadata_cache = lruCache(name="metadataCache")
+    frame_index = frameIndex()          # SOPInstanceUID -> frame locations, filled whenever a metadata is loaded. Replaced by a persistent one at startup.
+    inflight_fetches = {}               # cache key -> Future of the AHI fetch currently running for this key.
+    inflight_lock = threading.Lock()
+    coalesced_requests = 0              # Number of cache misses served by joining a fetch already in flight.
+    serialize_lock = threading.Lock()
 
-    def __init__(self , ahi_client : object = None):
+    def __init__(self , ahi_client : object = None, max_entries : int = None, max_bytes : int = None, ttl : float = None):
+        # The cache is shared at the class level, the budget provided here applies to every metadataCache instance.
+        metadataCache.metadata_cache = lruCache(name="metadataCache", max_entries=max_entries, max_bytes=max_bytes, ttl=ttl)
         self.cacheQueue = deque()
         self.cacheProcessor = threading.Thread(target=self.getMetadata)
         if ahi_client == None:
@@ -42,31 +50,79 @@ class metadataCache:
                 executor.submit(self.fetchMetadata(item["datastore_id"] , item["imageset_id"]))
 
     def fetchMetadata(self, datastore_id : str , imageset_id : str ):
+        start = time.perf_counter()
+        cache_key = f"{datastore_id}{imageset_id}"
+        entry = metadataCache.metadata_cache.get(cache_key)
+        if entry is not None:
+            metadataCache.logger.debug(f"[{__name__}] - CACHE HIT : {cache_key}")
+            proxyMetrics.observeStage("ahi_metadata", time.perf_counter() - start, "hit")
+            return entry["metadata"]
+        # Single flight : the 1st thread missing on a key fetches it from AHI, the concurrent ones wait for its result.
+        with metadataCache.inflight_lock:
+            pending_fetch = metadataCache.inflight_fetches.get(cache_key)
+            if pending_fetch is None:
+                pending_fetch = concurrent.futures.Future()
+                metadataCache.inflight_fetches[cache_key] = pending_fetch
+                fetch_owner = True
+            else:
+                metadataCache.coalesced_requests += 1
+                fetch_owner = False
+        if not fetch_owner:
+            metadataCache.logger.debug(f"[{__name__}] - CACHE PENDING : {cache_key}")
+            metadata = pending_fetch.result()
+            proxyMetrics.observeStage("ahi_metadata", time.perf_counter() - start, "miss")
+            return metadata
+        metadata = None
+        try:
+            metadata = self._loadMetadata(datastore_id, imageset_id)
+        finally:
+            # The entry is already in the cache at this point, late arrivals hit the cache instead of the in-flight map.
+            with metadataCache.inflight_lock:
+                del metadataCache.inflight_fetches[cache_key]
+            pending_fetch.set_result(metadata)
+            proxyMetrics.observeStage("ahi_metadata", time.perf_counter() - start, "miss")
+        return metadata
+
+    def _loadMetadata(self, datastore_id : str , imageset_id : str ):
+        cache_key = f"{datastore_id}{imageset_id}"
         try:
-            # jpleger : 02/15/2023 - was not the best idea....
-            # grace_before_fetch = 0
-            # while (metadataCache.metadata_cache[f"{datastore_id}{imageset_id}"] == {}) and ( grace_before_fetch < 10 ): # 1 seconds grace period in case another workflow requests the same metadata pending for retrieval. 
-            #     time.sleep(0.1)
-            #     grace_before_fetch+=1
-            #    metadataCache.logger.debug(f"[{__name__}] - CACHE PENDING : {datastore_id}{imageset_id}")
-            metadata = metadataCache.metadata_cache[f"{datastore_id}{imageset_id}"]["metadata"]
-            metadataCache.logger.debug(f"[{__name__}] - CACHE HIT : {datastore_id}{imageset_id}")
+            start = time.perf_counter()
+            metadata_blob = self.ahi_client.get_image_set_metadata(datastoreId=datastore_id , imageSetId=imageset_id)["imageSetMetadataBlob"]
+            metadata = metadataCache.storeMetadata(datastore_id, imageset_id, metadata_blob.read())
+            metadataCache.logger.debug(f"[{__name__}] - CACHE MISSED : {cache_key} fetch : {time.perf_counter()-start:.3f}s")
             return metadata
-        except:
-            try:
-                metadataCache.metadata_cache[f"{datastore_id}{imageset_id}"] = {}
-                start = datetime.datetime.now()
-                metadata = self.ahi_client.get_image_set_metadata(datastoreId=datastore_id , imageSetId=imageset_id)["imageSetMetadataBlob"]
-                metadata = gzip.decompress(metadata.read())
-                metadata = orjson.loads(metadata)
-                metadataCache.metadata_cache[f"{datastore_id}{imageset_id}"] = {"metadata" : metadata , "dt" : datetime.datetime.now()} 
-                end = datetime.datetime.now()
-                metadataCache.logger.debug(f"[{__name__}] - CACHE MISSED : {datastore_id}{imageset_id} fetch : {end-start}")
-                return metadata
-            except Exception as AHIErr :
-                self.logger.error(f"[{__name__}] - {AHIErr}")
-                return None
-            
+        except Exception as AHIErr :
+            self.logger.error(f"[{__name__}] - {AHIErr}")
+            return None
+
+    @staticmethod
+    def storeMetadata(datastore_id : str , imageset_id : str , metadata_blob : bytes):
+        """Parses the gzipped JSON returned by GetImageSetMetadata and stores it in the cache. Returns the parsed metadata."""
+        metadata = gzip.decompress(metadata_blob)
+        metadata_size = len(metadata) # The uncompressed JSON size is used as the approximate footprint of the entry.
+        metadata = orjson.loads(metadata)
+        metadataCache.metadata_cache.put(f"{datastore_id}{imageset_id}", {"metadata" : metadata}, metadata_size)
+        try:
+            metadataCache.frame_index.addMetadata(metadata)
+        except Exception as err:
+            metadataCache.logger.warning(f"[{__name__}] - {datastore_id}/{imageset_id} could not be added to the frame index : {err}")
+        return metadata
+
+    @staticmethod
+    def cachedMetadata(datastore_id : str , imageset_id : str):
+        """Returns the metadata of the image set if it is in the cache, None otherwise. Never calls AHI."""
+        entry = metadataCache.metadata_cache.get(f"{datastore_id}{imageset_id}")
+        if entry is None:
+            return None
+        return entry["metadata"]
+
+    @staticmethod
+    def getCacheStats() -> dict:
+        stats = metadataCache.metadata_cache.stats()
+        stats["coalesced_requests"] = metadataCache.coalesced_requests
+        stats["inflight_fetches"] = len(metadataCache.inflight_fetches)
+        return stats
+
     def getMetadata(self, datastore_id : str, imageset_id : str):
         metadata = self.fetchMetadata(datastore_id, imageset_id  )
         return metadata
@@ -77,6 +133,54 @@ class metadataCache:
         metadata = self.fetchMetadata(datastore_id, imageset_id  )
         return metadata
 
+    def getSerializedMetadata(self, datastore_id : str, imageset_id : str):
+        """Returns the DICOM-JSON of every instance of the image set as a dict with the keys :
+        instances : list of (SOPInstanceUID, instance DICOM-JSON bytes) , json : DICOM-JSON array bytes ,
+        encoded : Content-Encoding -> compressed json, filled on demand by storeEncodedMetadata.
+        The result is stored in the metadata cache entry of the image set so that it is evicted together with the metadata."""
+        metadata = self.fetchMetadata(datastore_id, imageset_id)
+        if metadata is None:
+            return None
+        cache_key = f"{datastore_id}{imageset_id}"
+        entry = metadataCache.metadata_cache.peek(cache_key)
+        if entry is not None and "serialized" in entry:
+            proxyMetrics.observeStage("serialize", 0.0, "hit")
+            return entry["serialized"]
+        with proxyMetrics.stage("serialize", "miss"):
+            serialized = metadataCache.serializeMetadata(metadata)
+        if entry is not None:
+            with metadataCache.serialize_lock:
+                if not "serialized" in entry: # another thread may have serialized the same image set concurrently.
+                    entry["serialized"] = serialized
+                    serialized_size = len(serialized["json"]) * 2 # the per instance fragments hold a 2nd copy of the json.
+                    metadataCache.metadata_cache.addSize(cache_key, serialized_size)
+        return serialized
+
+    def getSerializedMetadataViaTuple(self, fetch_tuple : tuple ):
+        return self.getSerializedMetadata(fetch_tuple[0], fetch_tuple[1])
+
+    @staticmethod
+    def storeEncodedMetadata(datastore_id : str, imageset_id : str, serialized : dict, encoding : str, body : bytes):
+        """Keeps the compressed DICOM-JSON of an image set next to its serialized metadata, so that it is compressed once per encoding."""
+        with metadataCache.serialize_lock:
+            if encoding in serialized["encoded"]:
+                return
+            serialized["encoded"][encoding] = body
+            metadataCache.metadata_cache.addSize(f"{datastore_id}{imageset_id}", len(body))
+
+    @staticmethod
+    def serializeMetadata(metadata : object):
+        patient_dict = metadataCache.getJSONKeys(metadata["Patient"]["DICOM"])
+        study_dict = metadataCache.getJSONKeys(metadata["Study"]["DICOM"])
+        series_uid = next(iter(metadata["Study"]["Series"].keys()))
+        series_dict = metadataCache.getJSONKeys(metadata["Study"]["Series"][series_uid]["DICOM"])
+        instances = []
+        for instance_uid in metadata["Study"]["Series"][series_uid]["Instances"].keys():
+            instance_dict = metadataCache.getInstancedDict(instance_uid=instance_uid, metadata=metadata, patient_dict=patient_dict , study_dict=study_dict , series_dict=series_dict)
+            instances.append((instance_uid, orjson.dumps(instance_dict)))
+        json_bytes = b"[" + b",".join([instance_json for instance_uid, instance_json in instances]) + b"]"
+        return { "instances" : instances , "json" : json_bytes , "encoded" : {} }
+
     @staticmethod 
     def metadataToDict(metadata : object ,  instance_uid : str = None):
         series_uid = next(iter(metadata["Study"]["Series"].keys()))
@@ -112,11 +216,6 @@ class metadataCache:
         complete_instance.update(series_dict)
         complete_instance.update(instance_dict)
         complete_instance = dict(sorted(complete_instance.items()))
-        #Attempt to populate the frame index...
-        frame_number = 1
-        for frame in metadata["Study"]["Series"][series_uid]["Instances"][instance_uid]["ImageFrames"]:
-            metadataCache.frame_index[instance_uid+"_"+str(frame_number)] = { "DatastoreID" : metadata["DatastoreID"], "ImageSetID" : metadata["ImageSetID"] , "ImageFrameID" : frame["ID"] }
-            frame_number = frame_number + 1     
         return complete_instance
 
     @staticmethod
@@ -136,22 +235,16 @@ class metadataCache:
     def getJSONKeys(tagblock : object, depth : int = 0 ):
         dicom_set = dict()
         for key in tagblock.keys():
-            try:
-                tag = datadict.tag_for_keyword(key)
-                vr = datadict.dictionary_VR(key)
-            except Exception as err:
+            tag_entry = keyword_tags.get(key)
+            if tag_entry is None: # not a DICOM keyword, eg. private tags.
                 continue
-            tab = ""
-            for x in range(depth):
-                tab = tab+"\t"
-            hex_tag = metadataCache.get8CharTag(hex(tag)) 
+            hex_tag , vr , tag = tag_entry
             if vr == "IS" and isinstance( tagblock[key] , str):
                 tagblock[key] = int(tagblock[key])
             if vr == "SQ":
-                depth=depth+1
                 element_array = []
                 for subelement in tagblock[key]:
-                    element_array.append(metadataCache.getJSONKeys(subelement, depth))
+                    element_array.append(metadataCache.getJSONKeys(subelement, depth+1))
                 dicom_set[hex_tag] = { "vr" : vr , "Value" : element_array}
             else:
                 if tagblock[key] is not None:
@@ -0,0 +1,87 @@
+"""
+pixelCache Module : Optional second cache tier holding decoded little endian pixel buffers.
+
+Hits on this tier skip the HTJ2K decoding. Decoded frames are written next to the raw frames as .pixels files and read
+back with a single read into a bytes object, optionally fronted by a bounded in-memory LRU.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import os
+import uuid
+import logging
+from lruCache import lruCache
+from proxyMetrics import proxyMetrics
+
+
+class pixelCache:
+
+    POLICIES = ("raw", "decoded", "both")
+    TIER = "pixels"
+
+    def __init__(self, cache_root : str, cache_index , ram_max_bytes : int = 0):
+        self.logger = logging.getLogger(__name__)
+        self.cache_root = cache_root
+        self.cache_index = cache_index
+        self.ram_cache = None
+        proxyMetrics.describe("pixel_cache_requests_total", "Decoded pixels lookups, by result : ram_hit , disk_hit or miss.")
+        if ram_max_bytes:
+            self.ram_cache = lruCache(name="pixelCache", max_bytes=ram_max_bytes)
+
+    @staticmethod
+    def storesRaw(policy : str) -> bool:
+        return policy in ("raw", "both")
+
+    @staticmethod
+    def storesDecoded(policy : str) -> bool:
+        return policy in ("decoded", "both")
+
+    def framePath(self, datastore_id : str, imageset_id : str, imageframe_id : str) -> str:
+        return f"{self.cache_root}/{datastore_id}/{imageset_id}/{imageframe_id}.pixels"
+
+    def get(self, datastore_id : str, imageset_id : str, imageframe_id : str) -> bytes:
+        key = datastore_id+"/"+imageset_id+"/"+imageframe_id
+        if self.ram_cache is not None:
+            pixels = self.ram_cache.get(key)
+            if pixels is not None:
+                proxyMetrics.inc("pixel_cache_requests_total", result="ram_hit")
+                self.cache_index.touch(key, tier=pixelCache.TIER) # keeps the disk copy of the frames hot in RAM away from eviction.
+                return pixels
+        try:
+            with open(self.framePath(datastore_id, imageset_id, imageframe_id), 'rb') as pixels_file:
+                pixels = pixels_file.read()
+                stored = os.fstat(pixels_file.fileno()).st_mtime
+        except OSError:
+            pixels = None
+        if not pixels: # missing, or empty and never a valid frame.
+            proxyMetrics.inc("pixel_cache_requests_total", result="miss")
+            self.cache_index.recordMiss(pixelCache.TIER)
+            return None
+        proxyMetrics.inc("pixel_cache_requests_total", result="disk_hit")
+        self.cache_index.recordHit(key, pixelCache.TIER, stored)
+        if self.ram_cache is not None:
+            self.ram_cache.put(key, pixels, len(pixels))
+        return pixels
+
+    def put(self, datastore_id : str, imageset_id : str, imageframe_id : str, pixels : bytes):
+        key = datastore_id+"/"+imageset_id+"/"+imageframe_id
+        if self.ram_cache is not None:
+            self.ram_cache.put(key, pixels, len(pixels))
+        frame_file_path = self.framePath(datastore_id, imageset_id, imageframe_id)
+        temp_file_path = f"{frame_file_path}.{uuid.uuid4().hex}.tmp" # readers must never see the file half written.
+        try:
+            os.makedirs(f"{self.cache_root}/{datastore_id}/{imageset_id}",exist_ok=True)
+            with open(temp_file_path, 'wb') as pixels_file:
+                pixels_file.write(pixels)
+            os.replace(temp_file_path, frame_file_path)
+            self.cache_index.add(key, len(pixels), tier=pixelCache.TIER)
+        except OSError as err:
+            self.logger.warning(f"[{__name__}] - {key} decoded pixels could not be stored : {err}")
+            try:
+                os.remove(temp_file_path)
+            except OSError:
+                pass
+
+    def stats(self) -> dict:
+        if self.ram_cache is None:
+            return {}
+        return self.ram_cache.stats()
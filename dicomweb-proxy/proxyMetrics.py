@@ -0,0 +1,181 @@
+"""
+proxyMetrics Module : In-process counters, gauges and histograms rendered in the Prometheus text exposition format.
+
+The hot path stages (sql, ahi_metadata, ahi_frame, decode, dicomize, serialize, compress) are timed in the single
+request_stage_seconds histogram, labelled with the stage, the route being served and whether the stage was answered
+from a cache (hit), had to do the work (miss) or has no cache (none). The route is held in a context variable set when
+a request starts, functions handed to thread pools are wrapped with bind to keep it.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import bisect
+import contextvars
+import threading
+import time
+import logging
+
+
+class stageTimer:
+    """Context manager observing the duration of a stage. cache may be updated inside the block once the outcome is known."""
+    __slots__ = ("stage", "cache", "start")
+
+    def __init__(self, stage : str, cache : str):
+        self.stage = stage
+        self.cache = cache
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        proxyMetrics.observeStage(self.stage, time.perf_counter() - self.start, self.cache)
+        return False
+
+
+class proxyMetrics:
+    logger = logging.getLogger(__name__)
+    STAGE_METRIC = "request_stage_seconds"
+    route = contextvars.ContextVar("proxy_metrics_route", default="other") # route label of the stages observed in this context.
+    DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+    BYTES_BUCKETS = (1024, 16384, 65536, 262144, 1048576, 4194304, 16777216, 67108864, 268435456, 1073741824)
+    AGE_BUCKETS = (60, 300, 900, 3600, 14400, 43200, 86400, 259200, 604800, 1209600, 2592000, 7776000) # 1 minute to 90 days, in seconds.
+    lock = threading.Lock()
+    counters = {}       # (name, labels) -> value
+    gauges = {}         # (name, labels) -> value
+    histograms = {}     # (name, labels) -> [buckets, bucket counts, sum, count]
+    descriptions = {}   # name -> help text
+    collectors = []     # callables returning a list of (name, type, labels dict, value) evaluated at scrape time.
+
+    @staticmethod
+    def describe(name : str, description : str):
+        proxyMetrics.descriptions[name] = description
+
+    @staticmethod
+    def inc(name : str, value : float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with proxyMetrics.lock:
+            proxyMetrics.counters[key] = proxyMetrics.counters.get(key, 0) + value
+
+    @staticmethod
+    def setGauge(name : str, value : float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with proxyMetrics.lock:
+            proxyMetrics.gauges[key] = value
+
+    @staticmethod
+    def addGauge(name : str, value : float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with proxyMetrics.lock:
+            proxyMetrics.gauges[key] = proxyMetrics.gauges.get(key, 0) + value
+
+    @staticmethod
+    def maxGauge(name : str, value : float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with proxyMetrics.lock:
+            if value > proxyMetrics.gauges.get(key, float("-inf")):
+                proxyMetrics.gauges[key] = value
+
+    @staticmethod
+    def observe(name : str, value : float, buckets : tuple = None, **labels):
+        proxyMetrics._observeKey((name, tuple(sorted(labels.items()))), value, buckets)
+
+    @staticmethod
+    def observeStage(stage : str, seconds : float, cache : str = "none"):
+        # the key is built in sorted label order directly, this is called several times per frame.
+        proxyMetrics._observeKey((proxyMetrics.STAGE_METRIC, (("cache", cache), ("route", proxyMetrics.route.get()), ("stage", stage))), seconds)
+
+    @staticmethod
+    def stage(stage : str, cache : str = "none") -> stageTimer:
+        return stageTimer(stage, cache)
+
+    @staticmethod
+    def setRoute(route : str):
+        proxyMetrics.route.set(route)
+
+    @staticmethod
+    def bind(function):
+        """Wraps function so that the stages it observes, eg. in a thread pool worker, are labelled with the route of the caller."""
+        route = proxyMetrics.route.get()
+        def bound(*args, **kwargs):
+            token = proxyMetrics.route.set(route)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                proxyMetrics.route.reset(token)
+        return bound
+
+    @staticmethod
+    def _observeKey(key : tuple, value : float, buckets : tuple = None):
+        with proxyMetrics.lock:
+            histogram = proxyMetrics.histograms.get(key)
+            if histogram is None:
+                if buckets is None:
+                    buckets = proxyMetrics.DEFAULT_BUCKETS
+                histogram = [buckets, [0] * len(buckets), 0.0, 0]
+                proxyMetrics.histograms[key] = histogram
+            index = bisect.bisect_left(histogram[0], value)
+            if index < len(histogram[1]):
+                histogram[1][index] += 1
+            histogram[2] += value
+            histogram[3] += 1
+
+    @staticmethod
+    def registerCollector(collector):
+        proxyMetrics.collectors.append(collector)
+
+    @staticmethod
+    def render() -> str:
+        lines = []
+        with proxyMetrics.lock:
+            counters = list(proxyMetrics.counters.items())
+            gauges = list(proxyMetrics.gauges.items())
+            histograms = [(key, (value[0], list(value[1]), value[2], value[3])) for key, value in proxyMetrics.histograms.items()]
+        for collector in proxyMetrics.collectors:
+            try:
+                for name, metric_type, labels, value in collector():
+                    key = (name, tuple(sorted(labels.items())))
+                    if metric_type == "counter":
+                        counters.append((key, value))
+                    else:
+                        gauges.append((key, value))
+            except Exception as err:
+                proxyMetrics.logger.warning(f"[{__name__}] - metrics collector failed : {err}")
+        proxyMetrics._renderSamples(lines, counters, "counter")
+        proxyMetrics._renderSamples(lines, gauges, "gauge")
+        declared = set()
+        for (name, labels), (buckets, bucket_counts, total, count) in sorted(histograms, key=lambda item: item[0]):
+            proxyMetrics._declare(lines, declared, name, "histogram")
+            cumulated = 0
+            for bound, bucket_count in zip(buckets, bucket_counts):
+                cumulated += bucket_count
+                lines.append(f"{name}_bucket{proxyMetrics._labels(labels + (('le', repr(float(bound))),))} {cumulated}")
+            lines.append(f"{name}_bucket{proxyMetrics._labels(labels + (('le', '+Inf'),))} {count}")
+            lines.append(f"{name}_sum{proxyMetrics._labels(labels)} {total}")
+            lines.append(f"{name}_count{proxyMetrics._labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _renderSamples(lines : list, samples : list, metric_type : str):
+        declared = set()
+        for (name, labels), value in sorted(samples, key=lambda item: item[0]):
+            proxyMetrics._declare(lines, declared, name, metric_type)
+            lines.append(f"{name}{proxyMetrics._labels(labels)} {value}")
+
+    @staticmethod
+    def _declare(lines : list, declared : set, name : str, metric_type : str):
+        if name in declared:
+            return
+        declared.add(name)
+        if name in proxyMetrics.descriptions:
+            lines.append(f"# HELP {name} {proxyMetrics.descriptions[name]}")
+        lines.append(f"# TYPE {name} {metric_type}")
+
+    @staticmethod
+    def _labels(labels : tuple) -> str:
+        if len(labels) == 0:
+            return ""
+        escaped = [ label + '="' + str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"' for label, value in labels ]
+        return "{" + ",".join(escaped) + "}"
+
+
+proxyMetrics.describe(proxyMetrics.STAGE_METRIC, "Time spent in each hot path stage, by stage, route and cache outcome (hit, miss or none).")
@@ -0,0 +1,134 @@
+"""
+qidoCache Module : Cache of the QIDO-RS responses, keyed on the normalized query parameters.
+
+Worklists poll the same searches every few seconds. The DICOM-JSON bodies are kept for a short TTL and dropped as soon
+as the metadata indexer reports a change on a study : searches scoped to that study are invalidated, as well as every
+search that is not scoped to a study, whose results may include it. Changes are received from an SQS queue subscribed
+to the SNS topic on which the AHItoRDBMS Lambda publishes the StudyInstanceUIDs it indexed (or fed by an EventBridge
+rule), each proxy container listening to its own queue.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import threading
+import time
+import logging
+import orjson
+import boto3
+from lruCache import lruCache
+from proxyMetrics import proxyMetrics
+
+
+class qidoCache:
+
+    def __init__(self, ttl : float, max_bytes : int = None, max_entries : int = None):
+        self.logger = logging.getLogger(__name__)
+        self.cache = lruCache(name="qidoCache", max_entries=max_entries, max_bytes=max_bytes, ttl=ttl, on_evict=self._forget)
+        self.lock = threading.RLock()  # reentrant : evictions triggered under the lock call back _forget.
+        self.study_keys = {}           # StudyInstanceUID -> keys of the cached searches scoped to this study.
+        self.unscoped_keys = set()     # keys of the cached searches matching any study.
+        self.generation = 0            # bumped by every invalidation, results computed before it are not cached.
+        self.max_body_bytes = max_bytes // 16 if max_bytes else 8*1024*1024 # streamed results larger than this are not collected for the cache.
+        proxyMetrics.describe("qido_cache_invalidations_total", "QIDO-RS cache invalidations, by source.")
+
+    @staticmethod
+    def queryKey(parameters : dict) -> bytes:
+        normalized = dict(parameters)
+        normalized["includefield"] = sorted(set(parameters["includefield"]))
+        normalized["wherefields"] = { tag : str(value).strip() for tag , value in parameters["wherefields"].items() }
+        return orjson.dumps(normalized, option=orjson.OPT_SORT_KEYS)
+
+    @staticmethod
+    def queryStudies(parameters : dict) -> tuple:
+        """Returns the StudyInstanceUIDs a search is restricted to, an empty tuple when it may match any study."""
+        study_uid = parameters.get("StudyInstanceUID") or parameters["wherefields"].get("0020000D")
+        if study_uid is None or "*" in study_uid or "?" in study_uid:
+            return ()
+        return tuple(study.strip() for study in study_uid.split(","))
+
+    def get(self, parameters : dict) -> tuple:
+        """Returns the (body, next page token) of a cached search, None if it is not cached."""
+        entry = self.cache.get(qidoCache.queryKey(parameters))
+        if entry is None:
+            return None
+        return entry[0] , entry[2]
+
+    def put(self, parameters : dict, body : bytes, generation : int, next_token : str = None):
+        """Caches the body of a search and the token of its next page, unless an invalidation happened since generation was read, before running the query."""
+        key = qidoCache.queryKey(parameters)
+        studies = qidoCache.queryStudies(parameters)
+        with self.lock:
+            if generation != self.generation:
+                return
+            if len(studies) == 0:
+                self.unscoped_keys.add(key)
+            for study in studies:
+                self.study_keys.setdefault(study, set()).add(key)
+            self.cache.put(key, (body, studies, next_token), len(body) + len(key))
+
+    def _forget(self, key : bytes, entry : tuple):
+        with self.lock:
+            if len(entry[1]) == 0:
+                self.unscoped_keys.discard(key)
+            for study in entry[1]:
+                keys = self.study_keys.get(study)
+                if keys is not None:
+                    keys.discard(key)
+                    if len(keys) == 0:
+                        del self.study_keys[study]
+
+    def invalidateStudies(self, study_uids : list, source : str = "api"):
+        with self.lock:
+            self.generation += 1
+            keys = set(self.unscoped_keys)
+            for study in study_uids:
+                keys.update(self.study_keys.get(study, ()))
+            for key in keys:
+                self.cache.pop(key)
+        proxyMetrics.inc("qido_cache_invalidations_total", source=source)
+        self.logger.debug(f"[{__name__}] - {len(keys)} searches invalidated for {len(study_uids)} studies.")
+
+    def flush(self, source : str = "api"):
+        with self.lock:
+            self.generation += 1
+            self.cache.clear()
+        proxyMetrics.inc("qido_cache_invalidations_total", source=source)
+
+    def processMessage(self, body : str):
+        """Applies an invalidation message : {"StudyInstanceUIDs" : [...]} , optionally wrapped in an SNS notification (subscription
+        without raw message delivery) or in an EventBridge "detail". A message without study flushes the whole cache."""
+        message = orjson.loads(body)
+        if message.get("Type") == "Notification":
+            message = orjson.loads(message["Message"])
+        message = message.get("detail", message)
+        study_uids = message.get("StudyInstanceUIDs") or ([message["StudyInstanceUID"]] if "StudyInstanceUID" in message else [])
+        if len(study_uids) == 0:
+            self.flush(source="sqs")
+        else:
+            self.invalidateStudies(study_uids, source="sqs")
+
+    def listen(self, queue_url : str, sqs_client = None):
+        """Starts a thread applying the invalidation messages received on an SQS queue."""
+        if sqs_client is None:
+            sqs_client = boto3.client("sqs")
+        listener = threading.Thread(target=self._poll, args=(queue_url, sqs_client), name="qidoCacheInvalidation", daemon=True)
+        listener.start()
+        return listener
+
+    def _poll(self, queue_url : str, sqs_client):
+        while True:
+            try:
+                response = sqs_client.receive_message(QueueUrl=queue_url, MaxNumberOfMessages=10, WaitTimeSeconds=20)
+            except Exception as err:
+                self.logger.error(f"[{__name__}] - invalidation queue could not be read : {err}")
+                time.sleep(5)
+                continue
+            for message in response.get("Messages", []):
+                try:
+                    self.processMessage(message["Body"])
+                except Exception as err:
+                    self.logger.error(f"[{__name__}] - invalidation message could not be processed, flushing the cache : {err}")
+                    self.flush(source="sqs")
+                sqs_client.delete_message(QueueUrl=queue_url, ReceiptHandle=message["ReceiptHandle"])
+
+    def stats(self) -> dict:
+        return self.cache.stats()
@@ -0,0 +1,184 @@
+"""
+qidoSerializer Module : Conversion of the QIDO-RS database rows to DICOM-JSON without pydicom.
+
+For a query level, the result columns and the requested includefields, a plan listing the (tag, VR, column index,
+converter) of every attribute to emit is compiled once, in the order of the db_mappings table of the level. Each row
+is then turned into its DICOM-JSON dict by running the converters over the tuple, which is an order of magnitude
+faster than building a pydicom Dataset per row.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import datetime
+import decimal
+import logging
+import orjson
+from db_mappings import studyTagsTofields, seriesTagsTofields, instanceTagsTofields
+from dicom_keywords import dictionary_vr
+from lruCache import lruCache
+
+NUMBER_VRS = ("US", "SS", "UL", "SL", "FL", "FD", "UV", "SV")
+PN_GROUPS = ("Alphabetic", "Ideographic", "Phonetic")
+
+
+class qidoSerializer:
+    logger = logging.getLogger(__name__)
+    plans = lruCache(name="qidoSerializerPlans", max_entries=256)
+
+    LEVEL_TAGS = {
+        "STUDY" : studyTagsTofields,
+        "SERIES" : seriesTagsTofields,
+        "INSTANCE" : instanceTagsTofields,
+        "STUDY.SERIES" : seriesTagsTofields,
+        "STUDY.INSTANCE" : instanceTagsTofields,
+        "STUDY.SERIES.INSTANCE" : instanceTagsTofields,
+    }
+
+    @staticmethod
+    def toJSON(field_names : list, db_results : list, params : dict) -> list:
+        """Returns the DICOM-JSON dict of each row."""
+        plan = qidoSerializer.getPlan(params["queryLevel"], field_names, params["includefield"])
+        json_array = []
+        for row in db_results:
+            dataset = {}
+            for tag , vr , index , convert in plan:
+                try:
+                    element = convert(vr, row[index])
+                except (ValueError, TypeError, AttributeError):
+                    continue # value that cannot be encoded with the VR of the tag, the attribute is left out.
+                if element is not None:
+                    dataset[tag] = element
+            json_array.append(dataset)
+        return json_array
+
+    @staticmethod
+    def serialize(field_names : list, db_results : list, params : dict) -> bytes:
+        return orjson.dumps(qidoSerializer.toJSON(field_names, db_results, params))
+
+    @staticmethod
+    def getPlan(level : str, field_names : list, includefield : list) -> tuple:
+        tag_fields = qidoSerializer.LEVEL_TAGS[level]
+        included = frozenset(tag for tag in includefield if tag in tag_fields)
+        key = (level, tuple(field_names), included)
+        plan = qidoSerializer.plans.get(key)
+        if plan is None:
+            plan = qidoSerializer.compilePlan(tag_fields, field_names, included)
+            qidoSerializer.plans.put(key, plan)
+        return plan
+
+    @staticmethod
+    def compilePlan(tag_fields : dict, field_names : list, included : frozenset) -> tuple:
+        columns = {}
+        for index , name in enumerate(field_names):
+            columns.setdefault(name, index) # first column of that name, eg. the joined tables share some column names.
+        plan = {}
+        for tag , field in tag_fields.items():
+            index = columns.get(field.lower())
+            vr = dictionary_vr(tag)
+            if index is None or vr is None:
+                continue
+            if tag in included:
+                plan[tag] = (tag, vr, index, qidoSerializer.converter(vr, split_slash=False))
+            else:
+                plan[tag] = (tag, vr, index, qidoSerializer.converter(vr, split_slash=True))
+        return tuple(plan.values())
+
+    @staticmethod
+    def converter(vr : str, split_slash : bool):
+        """Returns the function turning a column value into the DICOM-JSON element of the VR, None meaning no element.
+        CS columns holding several values separated by "/" (eg. ModalitiesInStudy) are split unless requested as includefield."""
+        if vr == "SQ":
+            return qidoSerializer.sequenceElement
+        if vr == "PN":
+            return qidoSerializer.personNameElement
+        if vr == "IS":
+            return qidoSerializer.integerStringElement
+        if vr == "DS":
+            return qidoSerializer.decimalStringElement
+        if vr in NUMBER_VRS:
+            return qidoSerializer.numberElement
+        if vr == "CS" and split_slash:
+            return qidoSerializer.codeStringElement
+        return qidoSerializer.stringElement
+
+    @staticmethod
+    def toString(value) -> str:
+        if isinstance(value, str):
+            return value
+        if isinstance(value, datetime.date):
+            return value.strftime('%Y%m%d')
+        if isinstance(value, datetime.timedelta): # MySQL TIME columns.
+            seconds = int(value.total_seconds())
+            time_string = f"{seconds // 3600:02d}{seconds % 3600 // 60:02d}{seconds % 60:02d}"
+            if value.microseconds:
+                time_string += f".{value.microseconds:06d}"
+            return time_string
+        if isinstance(value, (bytes, bytearray)):
+            return value.decode()
+        return str(value)
+
+    @staticmethod
+    def values(value) -> list:
+        """Returns the values of a column as a list of strings, [] if it is empty."""
+        if value is None:
+            return []
+        value = qidoSerializer.toString(value)
+        if value == "":
+            return []
+        return value.split("\\")
+
+    @staticmethod
+    def stringElement(vr : str, value):
+        values = qidoSerializer.values(value)
+        if len(values) == 0:
+            return { "vr" : vr }
+        return { "vr" : vr , "Value" : values }
+
+    @staticmethod
+    def codeStringElement(vr : str, value):
+        if value is None:
+            raise TypeError("empty code string") # an empty multi valued CS column is left out rather than sent empty.
+        value = qidoSerializer.toString(value)
+        if "/" in value:
+            return { "vr" : vr , "Value" : value.split("/") }
+        return qidoSerializer.stringElement(vr, value)
+
+    @staticmethod
+    def personNameElement(vr : str, value):
+        values = qidoSerializer.values(value)
+        if len(values) == 0:
+            return { "vr" : vr }
+        return { "vr" : vr , "Value" : [ { group : component for group , component in zip(PN_GROUPS, name.split("=")) if component != "" } for name in values ] }
+
+    @staticmethod
+    def integerStringElement(vr : str, value):
+        if isinstance(value, int):
+            return { "vr" : vr , "Value" : [value] }
+        values = qidoSerializer.values(value)
+        if len(values) == 0:
+            return { "vr" : vr }
+        return { "vr" : vr , "Value" : [ int(number) for number in values ] }
+
+    @staticmethod
+    def decimalStringElement(vr : str, value):
+        if isinstance(value, (int, float)):
+            return { "vr" : vr , "Value" : [value] }
+        values = qidoSerializer.values(value)
+        if len(values) == 0:
+            return { "vr" : vr }
+        return { "vr" : vr , "Value" : [ float(number) for number in values ] }
+
+    @staticmethod
+    def numberElement(vr : str, value):
+        if value is None:
+            return { "vr" : vr }
+        if isinstance(value, (int, float)):
+            return { "vr" : vr , "Value" : [value] }
+        if isinstance(value, decimal.Decimal):
+            return { "vr" : vr , "Value" : [int(value) if vr not in ("FL", "FD") else float(value)] }
+        raise TypeError(f"{vr} column holds a {type(value).__name__}")
+
+    @staticmethod
+    def sequenceElement(vr : str, value):
+        if value is None:
+            return { "vr" : vr , "Value" : [] }
+        raise TypeError("sequences are not stored in the database")
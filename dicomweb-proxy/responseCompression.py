@@ -0,0 +1,143 @@
+"""
+responseCompression Module : Content-Encoding negotiation and compression of the HTTP responses, per kind of content.
+
+Each profile lists the encodings worth using for a kind of content in order of preference, their compression level
+and the size under which the body, or each part of a frames response, is sent as is. zstd and brotli are used when
+their packages are installed.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import gzip
+import time
+import zlib
+import logging
+from proxyMetrics import proxyMetrics
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class responseCompression:
+    logger = logging.getLogger(__name__)
+
+    AVAILABLE = tuple(encoding for encoding, module in (("zstd", zstandard), ("br", brotli), ("gzip", gzip)) if module is not None)
+
+    PROFILES = {
+        # DICOM-JSON compresses 10 to 20 times and is often served from a pre-compressed body, a good ratio is worth the CPU.
+        "metadata" : { "encodings" : ("zstd", "br", "gzip") , "levels" : { "zstd" : 9 , "br" : 5 , "gzip" : 6 } , "min_size" : 1024 },
+        # Decoded pixels are noisy and compressed on every request, only the fastest levels pay off. min_size applies to each
+        # frame : a response of small frames (eg. thumbnails sized) is not worth compressing whatever its frame count.
+        "frames" : { "encodings" : ("zstd", "gzip") , "levels" : { "zstd" : 1 , "gzip" : 1 } , "min_size" : 16384 },
+    }
+
+    proxyMetrics.describe("compression_cpu_seconds_total", "Thread CPU time spent compressing the response bodies, by endpoint and encoding.")
+    proxyMetrics.describe("compression_bytes_in_total", "Response bytes before compression, by endpoint and encoding.")
+    proxyMetrics.describe("compression_bytes_out_total", "Response bytes after compression, by endpoint and encoding.")
+    proxyMetrics.describe("compression_reused_bytes_total", "Pre-compressed response bytes served without compressing them again.")
+    proxyMetrics.describe("compression_skipped_total", "Responses sent without Content-Encoding, by endpoint and reason.")
+
+    @staticmethod
+    def negotiate(accept_encoding : str, profile : str) -> str:
+        """Returns the encoding of the profile the client accepts with the highest q value, ties going to the profile
+        preference order. Returns None when the body should be sent as is."""
+        accepted = {}
+        for coding in accept_encoding.split(","):
+            params = coding.split(";")
+            name = params[0].strip().lower()
+            if name == "":
+                continue
+            quality = 1.0
+            for param in params[1:]:
+                if param.strip().startswith("q="):
+                    try:
+                        quality = float(param.strip()[2:])
+                    except ValueError:
+                        quality = 0.0
+            accepted[name] = quality
+        best = None
+        best_quality = 0.0
+        for encoding in responseCompression.PROFILES[profile]["encodings"]:
+            if encoding not in responseCompression.AVAILABLE:
+                continue
+            quality = accepted.get(encoding, accepted.get("*", 0.0))
+            if quality > best_quality:
+                best = encoding
+                best_quality = quality
+        return best
+
+    @staticmethod
+    def compress(data : bytes, encoding : str, profile : str, endpoint : str = None) -> bytes:
+        level = responseCompression.PROFILES[profile]["levels"][encoding]
+        start = time.thread_time()
+        if encoding == "zstd":
+            compressed = zstandard.ZstdCompressor(level=level).compress(data)
+        elif encoding == "br":
+            compressed = brotli.compress(data, quality=level)
+        else:
+            compressed = gzip.compress(data, level)
+        responseCompression._observe(endpoint or profile, encoding, time.thread_time() - start, len(data), len(compressed))
+        return compressed
+
+    @staticmethod
+    def compressBody(data : bytes, accept_encoding : str, profile : str, endpoint : str = None):
+        """Returns (body, encoding) , encoding being None when the body is not compressed."""
+        endpoint = endpoint or profile
+        encoding = responseCompression.negotiate(accept_encoding, profile)
+        if encoding is None:
+            proxyMetrics.inc("compression_skipped_total", endpoint=endpoint, reason="not_accepted")
+            return data , None
+        if len(data) < responseCompression.PROFILES[profile]["min_size"]:
+            proxyMetrics.inc("compression_skipped_total", endpoint=endpoint, reason="too_small")
+            return data , None
+        return responseCompression.compress(data, encoding, profile, endpoint) , encoding
+
+    @staticmethod
+    def compressStream(chunks, encoding : str, profile : str, endpoint : str = None):
+        """Compresses a stream of chunks as a single encoded body, chunk by chunk, without joining them first."""
+        endpoint = endpoint or profile
+        level = responseCompression.PROFILES[profile]["levels"][encoding]
+        if encoding == "zstd":
+            compressor = zstandard.ZstdCompressor(level=level).compressobj()
+            process , finish = compressor.compress , compressor.flush
+        elif encoding == "br":
+            compressor = brotli.Compressor(quality=level)
+            process , finish = compressor.process , compressor.finish
+        else:
+            compressor = zlib.compressobj(level, zlib.DEFLATED, 31) # wbits 31 : gzip header and trailer.
+            process , finish = compressor.compress , compressor.flush
+        cpu_time = 0.0
+        bytes_in = 0
+        bytes_out = 0
+        try:
+            for chunk in chunks:
+                start = time.thread_time()
+                compressed = process(chunk)
+                cpu_time += time.thread_time() - start
+                bytes_in += len(chunk)
+                if compressed:
+                    bytes_out += len(compressed)
+                    yield compressed
+            start = time.thread_time()
+            compressed = finish()
+            cpu_time += time.thread_time() - start
+            bytes_out += len(compressed)
+            yield compressed
+        finally:
+            responseCompression._observe(endpoint, encoding, cpu_time, bytes_in, bytes_out)
+
+    @staticmethod
+    def reused(endpoint : str, encoding : str, size : int):
+        proxyMetrics.inc("compression_reused_bytes_total", size, endpoint=endpoint, encoding=encoding)
+        proxyMetrics.observeStage("compress", 0.0, "hit")
+
+    @staticmethod
+    def _observe(endpoint : str, encoding : str, cpu_time : float, bytes_in : int, bytes_out : int):
+        proxyMetrics.inc("compression_cpu_seconds_total", cpu_time, endpoint=endpoint, encoding=encoding)
+        proxyMetrics.inc("compression_bytes_in_total", bytes_in, endpoint=endpoint, encoding=encoding)
+        proxyMetrics.inc("compression_bytes_out_total", bytes_out, endpoint=endpoint, encoding=encoding)
+        proxyMetrics.observeStage("compress", cpu_time, "miss") # CPU time : a streamed body is compressed while its chunks are produced.
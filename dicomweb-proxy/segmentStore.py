@@ -0,0 +1,172 @@
+"""
+segmentStore Module : Append-only packed segment files holding the raw frames of the disk cache.
+
+With FRAME_CACHE_LAYOUT=segments, the frames of an image set are appended to {cache_root}/{datastore}/{imageset}/{n}.seg
+files instead of being written one file per frame, which keeps the number of inodes, opens and closes proportional to
+the number of image sets. Every record starts with a header holding the frame id, its length and the time it was stored,
+so the in-memory offset index is rebuilt by scanning the segment headers at startup. A record is only published in the
+offset index once fully written, and frames are read back with a single pread.
+
+Segments are rolled over at segment_max_bytes. They are indexed in cacheIndex as "segment" entries and evicted as a
+whole by cacheCleaner, which hands the evicted segments back to forgetSegments.
+
+SPDX-License-Identifier: Apache-2.0
+"""
+import os
+import struct
+import threading
+import time
+import logging
+from cacheIndex import cacheIndex
+
+
+class segmentStore:
+
+    LAYOUTS = ("files", "segments")
+    TIER = "segment"
+    MAGIC = b"FSG1"
+    HEADER = struct.Struct("<4sHId") # magic, frame id length, frame length, stored time.
+
+    def __init__(self, cache_root : str, cache_index , segment_max_bytes : int = 64*1024*1024):
+        self.logger = logging.getLogger(__name__)
+        self.cache_root = cache_root
+        self.cache_index = cache_index
+        self.segment_max_bytes = segment_max_bytes
+        self.lock = threading.Lock()  # guards imagesets, each image set has its own lock for the appends.
+        self.imagesets = {}           # "datastore_id/imageset_id" -> {"frames" : {frame id : (segment, offset, length, stored)}, "segment" , "size" , "fd" , "lock"}
+        self.load()
+
+    @staticmethod
+    def segmentKey(imageset_key : str, segment : int) -> str:
+        return f"{imageset_key}/{segment:06d}"
+
+    def _imageset(self, imageset_key : str) -> dict:
+        with self.lock:
+            imageset = self.imagesets.get(imageset_key)
+            if imageset is None:
+                imageset = { "frames" : {} , "segment" : 0 , "size" : 0 , "fd" : None , "lock" : threading.Lock() }
+                self.imagesets[imageset_key] = imageset
+            return imageset
+
+    def contains(self, datastore_id : str, imageset_id : str, imageframe_id : str) -> bool:
+        imageset = self.imagesets.get(datastore_id+"/"+imageset_id)
+        return imageset is not None and imageframe_id in imageset["frames"]
+
+    def append(self, datastore_id : str, imageset_id : str, imageframe_id : str, frame : bytes):
+        """Appends a frame to the active segment of its image set, rolling over to a new segment when it is full."""
+        imageset_key = datastore_id+"/"+imageset_id
+        imageset = self._imageset(imageset_key)
+        frame_id = imageframe_id.encode()
+        stored = time.time()
+        header = segmentStore.HEADER.pack(segmentStore.MAGIC, len(frame_id), len(frame), stored) + frame_id
+        with imageset["lock"]:
+            if imageset["fd"] is None or imageset["size"] >= self.segment_max_bytes:
+                self._rollOver(imageset_key, imageset)
+            segment = imageset["segment"]
+            written = os.writev(imageset["fd"], [header, frame])
+            if written != len(header) + len(frame):
+                os.close(imageset["fd"]) # short write, eg. disk full : the record is left unpublished and the segment closed.
+                imageset["fd"] = None
+                raise OSError(f"short write on segment {segmentStore.segmentKey(imageset_key, segment)}")
+            imageset["frames"][imageframe_id] = (segment, imageset["size"] + len(header), len(frame), stored)
+            imageset["size"] += written
+            segment_size = imageset["size"]
+        self.cache_index.resize(segmentStore.segmentKey(imageset_key, segment), segment_size, segmentStore.TIER)
+
+    def _rollOver(self, imageset_key : str, imageset : dict):
+        # Must be called with the image set lock held. Segments written before a restart are never appended to.
+        if imageset["fd"] is not None:
+            os.close(imageset["fd"])
+        os.makedirs(os.path.join(self.cache_root, imageset_key), exist_ok=True)
+        imageset["segment"] += 1
+        imageset["size"] = 0
+        path = self.cache_index.filePath(segmentStore.segmentKey(imageset_key, imageset["segment"]), segmentStore.TIER)
+        imageset["fd"] = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND | os.O_TRUNC, 0o644)
+
+    def read(self, datastore_id : str, imageset_id : str, imageframe_id : str, count_miss : bool = True) -> bytes:
+        """Returns the frame bytes, None if the frame is not in a segment."""
+        imageset_key = datastore_id+"/"+imageset_id
+        imageset = self.imagesets.get(imageset_key)
+        location = None if imageset is None else imageset["frames"].get(imageframe_id)
+        if location is None:
+            if count_miss:
+                cacheIndex.recordMiss(segmentStore.TIER)
+            return None
+        segment , offset , length , stored = location
+        segment_key = segmentStore.segmentKey(imageset_key, segment)
+        try:
+            fd = os.open(self.cache_index.filePath(segment_key, segmentStore.TIER), os.O_RDONLY)
+        except FileNotFoundError: # evicted, or removed while the service was down.
+            self.forgetSegments([segment_key])
+            if count_miss:
+                cacheIndex.recordMiss(segmentStore.TIER)
+            return None
+        try:
+            frame = os.pread(fd, length, offset)
+        finally:
+            os.close(fd)
+        if len(frame) != length:
+            self.logger.warning(f"[{__name__}] - {segment_key} is truncated, {imageframe_id} cannot be read.")
+            if count_miss:
+                cacheIndex.recordMiss(segmentStore.TIER)
+            return None
+        self.cache_index.recordHit(segment_key, segmentStore.TIER, stored)
+        return frame
+
+    def forgetSegments(self, segment_keys : list):
+        """Drops the frames of the given segments from the offset index, eg. once cacheCleaner removed them."""
+        for segment_key in segment_keys:
+            imageset_key , segment = segment_key.rsplit("/", 1)
+            segment = int(segment)
+            imageset = self.imagesets.get(imageset_key)
+            if imageset is None:
+                continue
+            with imageset["lock"]:
+                imageset["frames"] = { frame_id : location for frame_id , location in imageset["frames"].items() if location[0] != segment }
+                if imageset["segment"] == segment and imageset["fd"] is not None:
+                    os.close(imageset["fd"]) # the next append starts a new segment.
+                    imageset["fd"] = None
+
+    def evicted(self, entries : list):
+        """cacheCleaner callback, entries being the (key, tier) it removed."""
+        self.forgetSegments([ key for key , tier in entries if tier == segmentStore.TIER ])
+
+    def load(self):
+        """Rebuilds the offset index from the segment record headers."""
+        start = time.time()
+        frame_count = 0
+        extension = cacheIndex.EXTENSIONS[segmentStore.TIER]
+        root_length = len(os.path.abspath(self.cache_root)) + 1
+        for path, dirs, files in os.walk(os.path.abspath(self.cache_root)):
+            for file in files:
+                name , file_extension = os.path.splitext(file)
+                if file_extension != extension or not name.isdigit():
+                    continue
+                imageset = self._imageset(path[root_length:].replace(os.sep, "/"))
+                segment = int(name)
+                imageset["segment"] = max(imageset["segment"], segment)
+                try:
+                    frame_count += self._scanSegment(os.path.join(path, file), segment, imageset["frames"])
+                except OSError as err:
+                    self.logger.warning(f"[{__name__}] - segment {os.path.join(path, file)} could not be read : {err}")
+        self.logger.info(f"[{__name__}] - segment index loaded in {time.time()-start:.1f}s : {frame_count} frames in {len(self.imagesets)} image sets.")
+
+    def _scanSegment(self, path : str, segment : int, frames : dict) -> int:
+        frame_count = 0
+        segment_size = os.path.getsize(path)
+        with open(path, 'rb') as segment_file:
+            offset = 0
+            while offset + segmentStore.HEADER.size <= segment_size:
+                magic , frame_id_length , length , stored = segmentStore.HEADER.unpack(segment_file.read(segmentStore.HEADER.size))
+                if magic != segmentStore.MAGIC:
+                    self.logger.warning(f"[{__name__}] - {path} is corrupted at offset {offset}, the following records are ignored.")
+                    break
+                frame_id = segment_file.read(frame_id_length).decode()
+                offset += segmentStore.HEADER.size + frame_id_length
+                if offset + length > segment_size:
+                    break # record interrupted by a shutdown.
+                frames[frame_id] = (segment, offset, length, stored)
+                frame_count += 1
+                offset += length
+                segment_file.seek(offset)
+        return frame_count
@@ -100,6 +100,12 @@ class BackendStack(Stack):
             sqs_event_source = lambda_event_source.SqsEventSource(sqs_queues.getQueue() , batch_size=40 , enabled=True , max_batching_window=Duration.seconds(2) , max_concurrency=100 , report_batch_item_failures=True )
             fn_ahi_to_rdbms.getFn().add_event_source(sqs_event_source)
 
+            #Studies indexed by the Lambda, fanned out to the queue of each dicomweb-proxy container to invalidate their QIDO-RS caches.
+            qido_invalidation_topic = sns.Topic(self, "qido-cache-invalidation-topic", topic_name=stack_name+"-qido-cache-invalidation", master_key=sqs_key, enforce_ssl=True)
+            qido_invalidation_topic.grant_publish(rdbms_lambda_role.getLambdaRole())
+            sqs_key.grant(rdbms_lambda_role.getLambdaRole(), "kms:Decrypt", "kms:GenerateDataKey*") # publishing to the encrypted topic.
+            fn_ahi_to_rdbms.getFn().add_environment(key="QIDO_CACHE_INVALIDATION_TOPIC_ARN", value=qido_invalidation_topic.topic_arn)
+
         if config.OPENSEARCH_CONFIG["enabled"] == True:
             opensearch_lambda_role  = LambdaRoles(self, 'ahi-to-opensearch-lambda-role', db_secret_arn=db_secret_arn , datastore_arn=ahi_datastore_arn )
             fn_ahi_to_opensearch = PythonLambda(self, "ahi-to-opensearch", lambda_config["AHItoOpenSearch"], opensearch_lambda_role.getLambdaRole(), vpc=vpc, vpc_subnets=ec2.SubnetSelection(subnet_type=ec2.SubnetType.PRIVATE_WITH_EGRESS) , security_group=sec_groups.getLambdaSecGroup() )
@@ -142,6 +148,7 @@ class BackendStack(Stack):
             CfnOutput(self, "rdbms-database-secret-arn", export_name=f"{stack_name}-rdbms-database-secret-arn", value=db_secret_arn)
             CfnOutput(self, "rdbms-database-name", export_name=f"{stack_name}-rdbms-database-name", value=db_name)
             CfnOutput(self, "rdbms-database-security-group", export_name=f"{stack_name}-rdbms-database-security-group", value=aurora_security_group.security_group_id)  
+            CfnOutput(self, "qido-cache-invalidation-topic-arn", export_name=f"{stack_name}-qido-cache-invalidation-topic-arn", value=qido_invalidation_topic.topic_arn)
         if config.DATALAKE_CONFIG["enabled"] == True:
             CfnOutput(self, "datalake-destination-bucket", export_name=f"{stack_name}-datalake-destination-bucket", value=destination_bucket.bucket_name)
             
\ No newline at end of file
@@ -16,6 +16,7 @@ logger = logging.getLogger()
 
 secret_name = os.environ["DB_SECRET"]
 region_name =  os.environ['AWS_REGION']
+invalidation_topic_arn = os.environ.get("QIDO_CACHE_INVALIDATION_TOPIC_ARN") # optional, SNS topic fanned out to the queue of each dicomweb-proxy QIDO-RS cache.
 
 def lambda_handler(event, context):
     ahi_client = AHIClientFactory.AHIClientFactory()
@@ -72,6 +73,7 @@ def lambda_handler(event, context):
     metadatas = getMetadatas(datastoreIdAndImageSetIds, ahi_client)
     print("metadatas: %s" % (metadatas))
     
+    changed_studies = set()
     for metadata in metadatas:
         datastore_id = metadata["DatastoreID"]
         imageset_id = metadata["ImageSetID"]
@@ -86,6 +88,7 @@ def lambda_handler(event, context):
         study_tags["patient_pkey"] = patient_pkey
         study_values = generateSQLValues(study_tags, study_datamodel)
         study_pkey = InsertEntry(study_values, cnx)
+        changed_studies.add(study_tags["StudyInstanceUID"])
     
         series_tags = getSeriesTags(metadata)
         for series in series_tags:
@@ -138,8 +141,20 @@ def lambda_handler(event, context):
             UpdateNumberOfSeriesRelatedInstances(series_pkey, cnx)
             UpdateNumberOfStudyRelatedSeriesInstances(study_pkey, cnx)
             cnx.close()
+    notifyStudiesChanged(changed_studies)
             
 
+def notifyStudiesChanged(study_uids : set):
+    """Publishes the StudyInstanceUIDs indexed by this invocation to the QIDO-RS cache invalidation topic, if configured.
+    Every dicomweb-proxy container subscribes its own queue to the topic, so that all of them receive the message."""
+    if invalidation_topic_arn is None or len(study_uids) == 0:
+        return
+    try:
+        sns_client = boto3.client("sns", region_name=region_name)
+        sns_client.publish(TopicArn=invalidation_topic_arn, Message=json.dumps({"StudyInstanceUIDs" : sorted(study_uids)}))
+    except Exception as err:
+        print("QIDO-RS cache invalidation could not be sent: %s" % (err))
+
 def InsertImageSet(series_pkey : int, imageset_id : str, datastore_id :  str, cnx):
     print("InsertImageSet:IN")
     """ Insert the ImagesetId and datastoreId in the imageset table, like to the series_pkey. If more than 1 entry for the same series_pkey is found in this table the function